@@ -0,0 +1,335 @@
+"""Drive simulated students through an exam, and report the latency and throughput of each route
+
+The server is started against the local stand-ins, unless the URL of a running one is given::
+
+    python benchmarks/load.py --students 500 --concurrency 50 --workers 4
+    python benchmarks/load.py --url http://127.0.0.1:8000 --flow lite
+
+With the `nicegui` flow, a student loads `/accueil`, each page of `/run`, then `/results`,
+and connects its websocket so that the submission is recorded. With the `lite` flow, a student
+fetches `/lite/quiz` and posts to `/lite/submit`. `--quizz banque_10k` takes the generated bank of
+10000 questions, 20 of them being drawn per student.
+
+With `--workers N`, the server listens on N consecutive ports, one per worker. Each simulated
+student sticks to one of them for its whole exam, as behind a reverse proxy pinning the clients:
+the NiceGUI pages only work in the worker which rendered them. A running server given with
+`--url` must be such a proxy when it has several workers.
+
+"""
+
+import argparse
+import ast
+import asyncio
+from collections import Counter, defaultdict
+from contextlib import AsyncExitStack
+import json
+import os
+from pathlib import Path
+import random
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+from urllib.parse import urlencode
+import uuid
+
+import httpx
+import socketio
+
+from standins import StandInServer, configure_environment, prepare_workdir
+
+
+class Recorder:
+    """Latencies of the successful requests, and number of failed ones, by route"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+
+    async def timed(self, route: str, awaitable) -> Any:
+        start = time.perf_counter()
+        try:
+            result = await awaitable
+        except Exception:
+            self.errors[route] += 1
+            raise
+        self.latencies[route].append(time.perf_counter() - start)
+        return result
+
+    def report(self, elapsed: float) -> List[Dict[str, Any]]:
+        rows = []
+        for route in sorted(set(self.latencies) | set(self.errors)):
+            latencies = sorted(self.latencies[route])
+            if len(latencies) >= 2:
+                centiles = statistics.quantiles(latencies, n=100, method="inclusive")
+                p50, p95, p99 = centiles[49], centiles[94], centiles[98]
+            else:
+                p50 = p95 = p99 = latencies[0] if latencies else float("nan")
+            rows.append(
+                dict(
+                    route=route,
+                    count=len(latencies),
+                    errors=self.errors[route],
+                    p50_ms=1000 * p50,
+                    p95_ms=1000 * p95,
+                    p99_ms=1000 * p99,
+                    rps=len(latencies) / elapsed,
+                )
+            )
+        return rows
+
+
+async def get_page(client: httpx.AsyncClient, recorder: Recorder, route: str, **params) -> str:
+    response = await recorder.timed(route, client.get(route, params=params))
+    response.raise_for_status()
+    return response.text
+
+
+async def connect_page(base_url: str, html: str):
+    """Connect the websocket of a NiceGUI page, as its javascript does"""
+    match = re.search(r"query: (\{.*?\}),\s*$", html, re.MULTILINE)
+    if match is None:
+        raise ValueError("No socket.io query in the page")
+    query = ast.literal_eval(match.group(1))
+
+    sio = socketio.AsyncClient(reconnection=False)
+    await sio.connect(
+        f"{base_url}?{urlencode(query)}",
+        socketio_path="/_nicegui_ws/socket.io",
+        transports=["websocket"],
+    )
+    try:
+        ok = await sio.call(
+            "handshake",
+            dict(
+                client_id=query["client_id"],
+                document_id=uuid.uuid4().hex,
+                tab_id=uuid.uuid4().hex,
+                old_tab_id=None,
+                next_message_id=query["next_message_id"],
+            ),
+            timeout=30,
+        )
+        if not ok:
+            raise ValueError(f"Handshake refused for client {query['client_id']}")
+    finally:
+        await sio.disconnect()
+
+
+async def nicegui_student(
+    client: httpx.AsyncClient, recorder: Recorder, token: str, quiz, rng: random.Random
+):
+    from quizzy.Quiz import FilledQuiz
+
+    await get_page(client, recorder, "/accueil", token=token)
+
+    # Each question page is rendered from its URL, as when the student reloads it
+    user_results = FilledQuiz(quiz, token)
+    for page, question in enumerate(user_results.questions):
+        answers = user_results.serialize_answers()
+        await get_page(client, recorder, "/run", token=token, page=page, answers=answers)
+        user_results.toggle(page, rng.randrange(question.number_of_answers))
+
+    answers = user_results.serialize_answers()
+    html = await get_page(client, recorder, "/results", token=token, answers=answers)
+    await recorder.timed("/results websocket", connect_page(str(client.base_url), html))
+
+
+async def lite_student(
+    client: httpx.AsyncClient, recorder: Recorder, token: str, quiz, rng: random.Random
+):
+    from quizzy.Quiz import FilledQuiz
+
+    await get_page(client, recorder, "/lite/quiz", token=token)
+
+    questions = FilledQuiz(quiz, token).questions
+    answers = [[rng.randrange(q.number_of_answers)] for q in questions]
+    response = await recorder.timed(
+        "/lite/submit", client.post("/lite/submit", json=dict(token=token, answers=answers))
+    )
+    response.raise_for_status()
+
+
+async def run_students(
+    base_urls: List[str], tokens: List[str], quiz, flow: str, concurrency: int, seed: int
+) -> Dict[str, Any]:
+    student = nicegui_student if flow == "nicegui" else lite_student
+    recorder = Recorder()
+    queue: asyncio.Queue = asyncio.Queue()
+    for token in tokens:
+        queue.put_nowait(token)
+    failures = []
+
+    async with AsyncExitStack() as stack:
+        clients = [
+            await stack.enter_async_context(
+                httpx.AsyncClient(
+                    base_url=base_url,
+                    timeout=60,
+                    limits=httpx.Limits(max_connections=concurrency),
+                    headers={"Accept": "application/json"} if flow == "lite" else None,
+                )
+            )
+            for base_url in base_urls
+        ]
+
+        async def worker(idx: int):
+            rng = random.Random(seed + idx)
+            # Always the same server worker, as behind a pinning proxy
+            client = clients[idx % len(clients)]
+            while not queue.empty():
+                token = queue.get_nowait()
+                try:
+                    await student(client, recorder, token, quiz, rng)
+                except Exception as error:
+                    failures.append(repr(error))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(idx) for idx in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return dict(
+        students=len(tokens),
+        failed_students=len(failures),
+        first_failures=failures[:5],
+        concurrency=concurrency,
+        elapsed_s=elapsed,
+        students_per_s=(len(tokens) - len(failures)) / elapsed,
+        routes=recorder.report(elapsed),
+    )
+
+
+def free_ports(count: int) -> int:
+    """First of *count* consecutive free ports"""
+    while True:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        if port + count > 65535:
+            continue
+        try:
+            for idx in range(1, count):
+                with socket.socket() as sock:
+                    sock.bind(("127.0.0.1", port + idx))
+        except OSError:
+            continue
+        return port
+
+
+def start_server(workdir: Path, workers: int, port: int) -> subprocess.Popen:
+    """Migrate the schema, then start quizzy and wait for the health check of each worker"""
+    env = dict(os.environ, LOGLEVEL=os.environ.get("LOGLEVEL", "warning"))
+    subprocess.run([sys.executable, "-m", "quizzy", "migrate"], cwd=workdir, env=env, check=True)
+
+    log = open(workdir / "server.log", "w")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "quizzy", "serve", "--workers", str(workers), "--port", str(port)],
+        cwd=workdir,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+    # The working directory is removed afterwards, so the log is part of the error
+    def failure(message: str) -> RuntimeError:
+        return RuntimeError(f"{message}:\n{(workdir / 'server.log').read_text()[-4000:]}")
+
+    pending = list(range(port, port + workers))
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise failure("The server exited")
+        try:
+            if httpx.get(f"http://127.0.0.1:{pending[0]}/health", timeout=1).status_code == 200:
+                pending.pop(0)
+                if not pending:
+                    return process
+                continue
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+
+    process.terminate()
+    raise failure("The server did not start")
+
+
+def print_report(result: Dict[str, Any]):
+    print(
+        f"{result['students']} students ({result['failed_students']} failed), "
+        f"concurrency {result['concurrency']}, {result['elapsed_s']:.1f} s, "
+        f"{result['students_per_s']:.1f} students/s"
+    )
+    for failure in result["first_failures"]:
+        print(f"  {failure}")
+
+    print(
+        f"{'route':<22}{'count':>8}{'errors':>8}"
+        f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}"
+    )
+    for row in result["routes"]:
+        print(
+            f"{row['route']:<22}{row['count']:>8}{row['errors']:>8}{row['p50_ms']:>10.1f}"
+            f"{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}{row['rps']:>10.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--students", type=int, default=200)
+    parser.add_argument("-c", "--concurrency", type=int, default=20)
+    parser.add_argument("--flow", choices=["nicegui", "lite"], default="nicegui")
+    parser.add_argument("--quizz", default="example", help="Name of the quiz taken")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Workers of the server")
+    parser.add_argument("--url", help="Benchmark this running server instead of starting one")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", type=Path, help="Also write the report to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="quizzy-bench-") as tmpdir:
+        workdir = Path(tmpdir)
+        standins = StandInServer(workdir / "standins")
+        standins.start()
+        configure_environment(standins)
+        prepare_workdir(workdir)
+
+        # The tokens are signed with the secrets of the environment, shared with the server
+        from quizzy.Quiz import Quiz
+        from quizzy.config import Examen
+
+        quiz = Quiz.from_yaml(workdir / "quizzes" / f"{args.quizz}.yml")
+        tokens = [
+            Examen(
+                quizz=args.quizz, email=f"etudiant{i}@bench.quizzy", nom=f"Nom{i}", prenom="Bench"
+            ).get_encrypted()
+            for i in range(args.students)
+        ]
+
+        process = None
+        base_urls = [args.url]
+        if args.url is None:
+            port = free_ports(args.workers)
+            process = start_server(workdir, args.workers, port)
+            base_urls = [f"http://127.0.0.1:{port + idx}" for idx in range(args.workers)]
+
+        try:
+            result = asyncio.run(
+                run_students(base_urls, tokens, quiz, args.flow, args.concurrency, args.seed)
+            )
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=30)
+            standins.stop()
+
+    result.update(flow=args.flow, workers=args.workers if args.url is None else None)
+    print_report(result)
+    if args.json is not None:
+        args.json.write_text(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Micro-benchmarks of the hot paths of an exam, against the local stand-ins
+
+    python benchmarks/micro.py
+    python benchmarks/micro.py --no-db
+
+Each function is run as many times as fit in about 0.2 s, and this is repeated: the best and
+the median time per call over the repeats are reported. The per-request functions are also run
+on the generated question bank, to compare with the quiz of `--quizz`.
+
+"""
+
+import argparse
+import json
+import os
+from pathlib import Path
+import secrets
+import statistics
+import tempfile
+import timeit
+from typing import Any, Callable, Dict, List
+
+from standins import BANK_NAME, StandInServer, configure_environment, prepare_workdir
+
+
+def bench(name: str, func: Callable[[], Any], repeat: int) -> Dict[str, Any]:
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(repeat, number)]
+    return dict(
+        name=name,
+        calls=number * repeat,
+        best_us=1e6 * min(times),
+        median_us=1e6 * statistics.median(times),
+    )
+
+
+def benchmarks(quizz: str, with_db: bool) -> List[tuple]:
+    """The benchmarked functions, to import quizzy once the environment is configured"""
+    from quizzy.Quiz import FilledQuiz, Quiz
+    from quizzy.config import Examen, examen_cache
+
+    pth = Path("quizzes") / f"{quizz}.yml"
+    quiz = Quiz.from_yaml(pth)
+    examen = Examen(quizz=quizz, email="etudiant@bench.quizzy", nom="Nom", prenom="Bench")
+    token = examen.get_encrypted()
+
+    user_results = FilledQuiz(quiz, token)
+    for page, question in enumerate(user_results.questions):
+        user_results.toggle(page, page % question.number_of_answers)
+
+    # A page of the exam builds the answers of the student, drawing their questions if any
+    bank = Quiz.from_yaml(Path("quizzes") / f"{BANK_NAME}.yml")
+    bank_results = FilledQuiz(bank, token)
+    for page, question in enumerate(bank_results.questions):
+        bank_results.toggle(page, page % question.number_of_answers)
+
+    def from_encrypted_cold():
+        examen_cache.clear()
+        Examen.from_encrypted(token)
+
+    cases = [
+        ("Quiz.from_yaml", lambda: Quiz.from_yaml(pth)),
+        ("Examen.from_encrypted", from_encrypted_cold),
+        ("Examen.from_encrypted (cached)", lambda: Examen.from_encrypted(token)),
+        ("FilledQuiz", lambda: FilledQuiz(quiz, token)),
+        (f"FilledQuiz ({BANK_NAME})", lambda: FilledQuiz(bank, token)),
+        ("FilledQuiz.get_score", user_results.get_score),
+        (f"FilledQuiz.get_score ({BANK_NAME})", bank_results.get_score),
+    ]
+
+    if with_db:
+        from quizzy.config import config
+        from quizzy.database import enregistre_examen, migrate
+
+        config.refresh_geoip()
+        migrate()
+
+        def enregistre():
+            # A new token each time, or the submission is recognised as a duplicate
+            user_results.token = secrets.token_urlsafe(12)
+            enregistre_examen(examen, user_results, "127.0.0.1")
+
+        cases.append(("enregistre_examen", enregistre))
+
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quizz", default="micronutrition", help="Name of the quiz")
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("--no-db", action="store_true", help="Skip the database benchmarks")
+    parser.add_argument("--json", type=Path, help="Also write the report to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="quizzy-bench-") as tmpdir:
+        workdir = Path(tmpdir)
+        standins = StandInServer(workdir / "standins")
+        standins.start()
+        configure_environment(standins)
+        prepare_workdir(workdir)
+
+        # quizzy finds its quizzes and cached files in the current directory
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            rows = [
+                bench(name, func, args.repeat)
+                for name, func in benchmarks(args.quizz, not args.no_db)
+            ]
+        finally:
+            os.chdir(cwd)
+            standins.stop()
+
+    print(f"{'function':<34}{'calls':>10}{'best µs':>12}{'median µs':>12}")
+    for row in rows:
+        print(
+            f"{row['name']:<34}{row['calls']:>10}{row['best_us']:>12.1f}{row['median_us']:>12.1f}"
+        )
+    if args.json is not None:
+        args.json.write_text(json.dumps(rows, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""Local stand-ins for the services quizzy depends on, so that the benchmarks run offline
+
+The OIDC discovery document and the GeoIP database are served by a small HTTP server, and the
+GeoIP database is generated: it only knows a few private and loopback networks.
+The database must be a local PostgreSQL, as quizzy relies on its upserts.
+
+"""
+
+from functools import partial
+import gzip
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import ipaddress
+import json
+import os
+from pathlib import Path
+import shutil
+import struct
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+
+# Root of the repository, where the benchmarked quizzes are
+ROOT = Path(__file__).resolve().parents[1]
+
+# Networks known to the generated GeoIP database, with the location of their addresses
+STAND_IN_NETWORKS: List[Tuple[str, Dict[str, Any]]] = [
+    (
+        "127.0.0.0/8",
+        dict(
+            city=dict(names=dict(en="Toulouse")),
+            country=dict(iso_code="FR", names=dict(en="France")),
+            location=dict(latitude=43.6045, longitude=1.444, accuracy_radius=20),
+        ),
+    ),
+    (
+        "10.0.0.0/8",
+        dict(
+            city=dict(names=dict(en="Paris")),
+            country=dict(iso_code="FR", names=dict(en="France")),
+            location=dict(latitude=48.8566, longitude=2.3522, accuracy_radius=50),
+        ),
+    ),
+    (
+        "192.168.0.0/16",
+        dict(
+            city=dict(names=dict(en="Lyon")),
+            country=dict(iso_code="FR", names=dict(en="France")),
+            location=dict(latitude=45.764, longitude=4.8357, accuracy_radius=100),
+        ),
+    ),
+]
+
+
+class Uint16(int):
+    """Integer stored as a uint16, some metadata fields require it"""
+
+    TYPE = 5
+
+
+class Uint64(int):
+    TYPE = 9
+
+
+def _control(type_: int, size: int) -> bytes:
+    """Control byte(s) of a field of the MaxMind DB data section"""
+    if size < 29:
+        prefix, extra = size, b""
+    elif size < 285:
+        prefix, extra = 29, bytes([size - 29])
+    elif size < 65821:
+        prefix, extra = 30, (size - 285).to_bytes(2, "big")
+    else:
+        prefix, extra = 31, (size - 65821).to_bytes(3, "big")
+
+    if type_ <= 7:
+        return bytes([(type_ << 5) | prefix]) + extra
+    return bytes([prefix, type_ - 7]) + extra
+
+
+def encode_mmdb_value(value: Any) -> bytes:
+    """Encode *value* in the MaxMind DB data section format"""
+    if isinstance(value, str):
+        data = value.encode("utf-8")
+        return _control(2, len(data)) + data
+    if isinstance(value, bool):
+        return _control(14, int(value))
+    if isinstance(value, float):
+        return _control(3, 8) + struct.pack(">d", value)
+    if isinstance(value, int):
+        data = value.to_bytes((value.bit_length() + 7) // 8, "big")
+        # Plain integers are stored as uint32
+        return _control(getattr(value, "TYPE", 6), len(data)) + data
+    if isinstance(value, dict):
+        return _control(7, len(value)) + b"".join(
+            encode_mmdb_value(k) + encode_mmdb_value(v) for k, v in value.items()
+        )
+    if isinstance(value, list):
+        return _control(11, len(value)) + b"".join(encode_mmdb_value(v) for v in value)
+    raise TypeError(f"Cannot encode {value!r}")
+
+
+def write_mmdb(
+    pth: Path,
+    networks: List[Tuple[str, Dict[str, Any]]] = STAND_IN_NETWORKS,
+    database_type: str = "GeoLite2-City",
+):
+    """Write an IPv4 MaxMind DB file mapping each network to its record, with 24 bits records"""
+    data = b""
+    offsets = []
+    for _, record in networks:
+        offsets.append(len(data))
+        data += encode_mmdb_value(record)
+
+    # Binary trie on the bits of the addresses: a child is a node index, or ("data", offset)
+    nodes: List[List[Any]] = [[None, None]]
+    for (network, _), offset in zip(networks, offsets):
+        net = ipaddress.IPv4Network(network)
+        bits = int(net.network_address)
+        node = 0
+        for depth in range(net.prefixlen):
+            bit = (bits >> (31 - depth)) & 1
+            if depth == net.prefixlen - 1:
+                nodes[node][bit] = ("data", offset)
+            else:
+                if nodes[node][bit] is None:
+                    nodes.append([None, None])
+                    nodes[node][bit] = len(nodes) - 1
+                node = nodes[node][bit]
+
+    node_count = len(nodes)
+
+    def record_value(child: Any) -> int:
+        if child is None:
+            return node_count
+        if isinstance(child, tuple):
+            return node_count + 16 + child[1]
+        return child
+
+    tree = b"".join(
+        record_value(left).to_bytes(3, "big") + record_value(right).to_bytes(3, "big")
+        for left, right in nodes
+    )
+
+    metadata = dict(
+        node_count=node_count,
+        record_size=Uint16(24),
+        ip_version=Uint16(4),
+        database_type=database_type,
+        languages=["en"],
+        binary_format_major_version=Uint16(2),
+        binary_format_minor_version=Uint16(0),
+        build_epoch=Uint64(int(time.time())),
+        description=dict(en="quizzy benchmark stand-in"),
+    )
+    pth.write_bytes(
+        tree + b"\x00" * 16 + data + b"\xab\xcd\xefMaxMind.com" + encode_mmdb_value(metadata)
+    )
+
+
+class StandInServer:
+    """HTTP server of the stand-in OIDC discovery document and GeoIP database, in a thread
+
+    Args:
+        root: Directory where the served files are written
+
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self._server: ThreadingHTTPServer | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        mmdb = self.root / "GeoLite2-City.mmdb"
+        write_mmdb(mmdb)
+        (self.root / "GeoLite2-City.mmdb.gz").write_bytes(gzip.compress(mmdb.read_bytes()))
+        mmdb.unlink()
+
+        handler = partial(QuietHandler, directory=str(self.root))
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+
+        well_known = self.root / ".well-known"
+        well_known.mkdir(exist_ok=True)
+        discovery = dict(
+            issuer=self.url,
+            authorization_endpoint=f"{self.url}/authorize",
+            token_endpoint=f"{self.url}/token",
+            userinfo_endpoint=f"{self.url}/userinfo",
+            jwks_uri=f"{self.url}/jwks",
+        )
+        (well_known / "openid-configuration").write_text(json.dumps(discovery))
+
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format: str, *args: Any):
+        pass
+
+
+def configure_environment(server: StandInServer):
+    """Point quizzy at the stand-ins. Must be called before quizzy is imported
+
+    The secrets and the database settings keep the values already in the environment, if any.
+
+    """
+    os.environ["OPENID_CONFIG_URL"] = f"{server.url}/.well-known/openid-configuration"
+    os.environ["GEOIP2_DB_URL"] = f"{server.url}/GeoLite2-City.mmdb.gz"
+
+    defaults = dict(
+        AES_SECRET="0123456789abcdef0123456789abcdef",
+        JWT_SECRET="benchmark-jwt-secret",
+        COOKIE_SECRET="benchmark-cookie-secret",
+        CLIENT_ID="benchmark",
+        CLIENT_SECRET="benchmark",
+        REDIRECT_URI="http://127.0.0.1:8000/auth/callback",
+        POSTGRES_HOST="127.0.0.1",
+        POSTGRES_USER="quizzy",
+        POSTGRES_PASSWORD="quizzy",
+        POSTGRES_DB="quizzy",
+        SERVICE_USER_POSTGRESQL="quizzy",
+        SERVICE_PASSWORD_POSTGRESQL="quizzy",
+    )
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+
+
+# Question bank generated next to the quizzes: number of questions, and number drawn per student
+BANK_NAME = "banque_10k"
+BANK_SIZE = 10000
+BANK_DRAWN = 20
+
+
+def write_bank(pth: Path, size: int = BANK_SIZE, drawn: int = BANK_DRAWN):
+    """Write a quiz with a bank of *size* questions, *drawn* of them being asked to each student"""
+    dat = dict(
+        message_accueil="# Banque de questions\n\nBonjour {prenom}",
+        text_bouton="C'est parti !",
+        tirage=drawn,
+        questions=[
+            dict(
+                text=f"Question {i} ?",
+                answers=[f"Réponse {i}.{a}" for a in range(4)],
+                good_answers=[i % 4],
+            )
+            for i in range(size)
+        ],
+        echelle_scores={100: "BRAVO !", 50: "Pas mal", 0: "Encore un petit effort"},
+    )
+    # JSON is valid YAML, and much faster to write
+    pth.write_text(json.dumps(dat, ensure_ascii=False), encoding="utf-8")
+
+
+def prepare_workdir(workdir: Path, quizzes: Path = ROOT / "quizzes"):
+    """Copy the quizzes to the directory the application runs from, which gets its cached files,
+    and add the generated question bank"""
+    shutil.copytree(quizzes, workdir / "quizzes", dirs_exist_ok=True)
+    write_bank(workdir / "quizzes" / f"{BANK_NAME}.yml")
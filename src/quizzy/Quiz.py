@@ -1,45 +1,304 @@
+from base64 import b64decode, urlsafe_b64decode, urlsafe_b64encode
+from functools import cached_property
 import hashlib
-from pathlib import Path
-from typing import Dict, List, Optional, Set
 import json
+from pathlib import Path
+import random
+from typing import Dict, List, Sequence
 
 import yaml
-from yaml import BaseLoader
-from pydantic import BaseModel
+from nicegui import events
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr
+
+from .cache import TTLCache
+
+# libyaml's loader is an order of magnitude faster than the pure Python one
+BaseLoader = getattr(yaml, "CBaseLoader", yaml.BaseLoader)
+
+active_color = "blue"
+inactive_color = "grey"
+
+# Questions drawn for the students taking a quiz with a bank, by quiz version and token.
+# Drawing costs more than building the rest of a page's state
+draw_cache = TTLCache(16384, 3600.0)
+
+
+def mask_to_indices(mask: int) -> List[int]:
+    """Return the indices of the bits set in *mask*, in increasing order"""
+    indices = []
+    idx = 0
+    while mask:
+        if mask & 1:
+            indices.append(idx)
+        mask >>= 1
+        idx += 1
+    return indices
+
+
+def indices_to_mask(indices: List[int]) -> int:
+    mask = 0
+    for idx in indices:
+        mask |= 1 << idx
+    return mask
+
+
+# Prefix of the answers encoded by `encode_answers`. It is neither in the base64 alphabet of the
+# legacy encoding, nor in the URL safe one
+ANSWERS_V1 = "1."
+
+# Bounds of the decoded answers, which come from the URL: the masks must fit in 64 bits signed
+# integers, and a submission is far shorter than the longest URL browsers accept
+MAX_MASK_BITS = 63
+MAX_ANSWERS_LENGTH = 16384
+
+
+def encode_answers(masks: List[int]) -> str:
+    """Encode answer masks as unsigned LEB128 varints, in URL safe base64 without padding"""
+    data = bytearray()
+    for mask in masks:
+        while mask > 0x7F:
+            data.append(mask & 0x7F | 0x80)
+            mask >>= 7
+        data.append(mask)
+
+    return ANSWERS_V1 + urlsafe_b64encode(bytes(data)).rstrip(b"=").decode("ascii")
+
+
+def decode_answers(answers: str) -> List[int]:
+    """Decode the answer masks of `encode_answers`, or of the legacy base64 JSON encoding
+
+    Raises:
+        ValueError: If *answers* is malformed, too long, or has a mask of more than
+            `MAX_MASK_BITS` bits
+
+    """
+    if len(answers) > MAX_ANSWERS_LENGTH:
+        raise ValueError(f"Answers longer than {MAX_ANSWERS_LENGTH} characters")
+
+    if not answers.startswith(ANSWERS_V1):
+        pages = json.loads(b64decode(answers))
+        if not isinstance(pages, list) or not all(
+            isinstance(indices, list) and all(type(idx) is int for idx in indices)
+            for indices in pages
+        ):
+            raise ValueError("Legacy answers are not a list of lists of indices")
+        if any(idx < 0 or idx >= MAX_MASK_BITS for indices in pages for idx in indices):
+            raise ValueError(f"Answer index out of [0, {MAX_MASK_BITS}[")
+        return [indices_to_mask(indices) for indices in pages]
+
+    payload = answers[len(ANSWERS_V1) :]
+    data = urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+
+    masks = []
+    mask = 0
+    shift = 0
+    for byte in data:
+        mask |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            if shift >= MAX_MASK_BITS:
+                raise ValueError(f"Answer mask of more than {MAX_MASK_BITS} bits")
+        else:
+            masks.append(mask)
+            mask = 0
+            shift = 0
+    if shift:
+        raise ValueError("Truncated answer mask")
+
+    return masks
 
 
 class Question(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     text: str
     answers: List[str]
     good_answers: List[int]
-    user_answers: Set[int] = set()
 
     @property
     def number_of_answers(self) -> int:
         return len(self.answers)
 
+    @cached_property
+    def good_mask(self) -> int:
+        return indices_to_mask(self.good_answers)
+
 
 class Quiz(BaseModel):
-    token: Optional[str] = ""
+    """Content of a quiz, shared read-only between all the students taking it
+
+    With `tirage`, `questions` is a bank from which each student gets `tirage` questions,
+    drawn from their token. Otherwise every student gets all the questions, in order.
+
+    """
+
+    model_config = ConfigDict(frozen=True)
+
     message_accueil: str
     text_bouton: str
     questions: List[Question]
     echelle_scores: Dict[int, str]
+    tirage: int | None = Field(default=None, ge=1)
+
+    _hash: str = PrivateAttr("")
+
+    def model_post_init(self, __context):
+        self._hash = self.content_hash()
 
     @property
     def number_of_questions(self) -> int:
         return len(self.questions)
 
+    @property
+    def number_drawn(self) -> int:
+        """Number of questions asked to each student"""
+        if self.tirage is None:
+            return self.number_of_questions
+        return min(self.tirage, self.number_of_questions)
+
+    def draw(self, token: str) -> Sequence[int]:
+        """Indices of the questions asked to the student of *token*, in the order they are asked
+
+        The draw only depends on the token, so that it is the same for every page of the exam.
+        It costs the same whatever the size of the bank.
+
+        """
+        if self.tirage is None:
+            return range(self.number_of_questions)
+
+        key = (self._hash, token)
+        drawn = draw_cache.get(key)
+        if drawn is None:
+            seed = int.from_bytes(hashlib.sha256(token.encode("utf-8")).digest(), "big")
+            rng = random.Random(seed)
+            drawn = tuple(rng.sample(range(self.number_of_questions), self.number_drawn))
+            draw_cache.set(key, drawn)
+
+        return drawn
+
     @classmethod
     def from_yaml(cls, yml_pth: Path):
         with open(yml_pth, "r") as f:
-            dat = yaml.load(f, Loader=BaseLoader)
-        quiz = cls.model_validate_json(json.dumps(dat))
+            raw = f.read()
+        # A generated bank may be written as JSON, which is valid YAML and parsed much faster
+        try:
+            dat = json.loads(raw) if raw.lstrip().startswith("{") else None
+        except ValueError:
+            dat = None
+        if dat is None:
+            dat = yaml.load(raw, Loader=BaseLoader)
+        quiz = cls.model_validate(dat)
         return quiz
 
-    @property
-    def hash(self) -> str:
+    def score_comment(self, score: float) -> str:
+        """Return the comment of the score scale matching *score*"""
+        for score_key in self.echelle_scores.keys():
+            if score >= score_key:
+                return self.echelle_scores[score_key]
+        return ""
+
+    def content_hash(self) -> str:
+        """SHA-256 of a canonical serialization of the questions, answers, good answers and
+        score scale. Texts that do not change the grading (welcome message, button) are left out"""
+        content = dict(
+            questions=[
+                dict(text=q.text, answers=q.answers, good_answers=sorted(set(q.good_answers)))
+                for q in self.questions
+            ],
+            echelle_scores={str(k): v for k, v in sorted(self.echelle_scores.items())},
+        )
+        # Left out when unset, so that the quizzes without a bank keep their version
+        if self.tirage is not None:
+            content["tirage"] = self.number_drawn
+        raw = json.dumps(content, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
         m = hashlib.sha256()
-        raw = self.model_dump_json().encode("utf-8")
-        m.update(raw)
+        m.update(raw.encode("utf-8"))
         return m.hexdigest()
+
+    @property
+    def hash(self) -> str:
+        """Version of the quiz, computed once at load time"""
+        return self._hash
+
+
+class FilledQuiz:
+    """Answers of one student to a quiz
+
+    The `Quiz` is shared, the only state of an attempt is the indices of the questions drawn
+    for the student, and one bitmask of the selected answers per drawn question. The pages
+    are numbered in the order of the draw.
+
+    """
+
+    __slots__ = ("quiz", "token", "tirage", "questions", "masks")
+
+    def __init__(self, quiz: Quiz, token: str = ""):
+        self.quiz = quiz
+        self.token = token
+        self.tirage = quiz.draw(token)
+        if quiz.tirage is None:
+            self.questions = quiz.questions
+        else:
+            self.questions = [quiz.questions[idx] for idx in self.tirage]
+        self.masks = [0] * len(self.tirage)
+
+    @classmethod
+    def from_yaml(cls, yml_pth: Path) -> "FilledQuiz":
+        return cls(Quiz.from_yaml(yml_pth))
+
+    @property
+    def number_of_questions(self) -> int:
+        return len(self.masks)
+
+    def is_selected(self, page: int, idx: int) -> bool:
+        return bool(self.masks[page] >> idx & 1)
+
+    def toggle(self, page: int, idx: int) -> bool:
+        """Select or unselect the answer *idx* of question *page*, and return the new state"""
+        self.masks[page] ^= 1 << idx
+        return self.is_selected(page, idx)
+
+    def on_chip_click(self, page: int, idx: int):
+        def callback(e: events.ClickEventArguments):
+            state = self.toggle(page, idx)
+            e.sender.props(f"color={active_color if state else inactive_color}")
+
+        return callback
+
+    def extract_answers(self) -> List[List[int]]:
+        uans = [mask_to_indices(mask) for mask in self.masks]
+        return uans
+
+    def submission_key(self) -> str:
+        """Idempotency key of the submission, the same for every reload of the results"""
+        masks = ",".join(str(mask) for mask in self.masks)
+        return hashlib.sha256(f"{self.token}:{masks}".encode("utf-8")).hexdigest()
+
+    def serialize_answers(self) -> str:
+        return encode_answers(self.masks)
+
+    def serialize_tirage(self) -> str | None:
+        """The drawn indices, in the encoding of the answers, or None if there is no bank"""
+        if self.quiz.tirage is None:
+            return None
+        return encode_answers(self.tirage)
+
+    def decode_answer(self, answers: str) -> List[List[int]]:
+        return [mask_to_indices(mask) for mask in decode_answers(answers)]
+
+    def set_answers_from_serialzed(self, answers: str):
+        """Restore the answers of a URL, dropping the bits beyond the answers of each question"""
+        for page, mask in enumerate(decode_answers(answers)[: len(self.masks)]):
+            self.masks[page] = mask & ((1 << self.questions[page].number_of_answers) - 1)
+
+    def verdicts(self) -> List[bool]:
+        return [mask == q.good_mask for q, mask in zip(self.questions, self.masks)]
+
+    def get_score(self) -> float:
+        verdicts = self.verdicts()
+        count_ok = sum(verdicts)
+        count_total = len(verdicts)
+
+        score = int(100 * count_ok / count_total)
+
+        return score
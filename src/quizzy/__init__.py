@@ -20,22 +20,47 @@ To run tests, just run:
 
 """
 
-import sys
+import atexit
 import os
 import logging
+import sys
+
+from .logs import LogPipeline, configure_loggers
+from .metrics import metrics
 
 
 # création de l'objet logger qui va nous servir à écrire dans les logs
 logger = logging.getLogger("uvicorn.error")
-logger.setLevel(os.environ.get("LOGLEVEL", "info").upper())
 
-# Create stream handler for stdout
-logHandler = logging.StreamHandler(sys.stdout)
+# The records are written to stdout by a background thread, so that a slow log collector
+# does not block the requests
+log_pipeline = LogPipeline(sys.stdout, int(os.environ.get("LOG_QUEUE_SIZE", "10000")))
+log_pipeline.start()
+atexit.register(log_pipeline.stop)
 
-# JSON formatter
-formatter = logging.Formatter(
-    '{"time": "%(asctime)s", "level": "%(levelname)s", "message": "%(message)s", "name": "%(name)s"}'
-)
 
-logHandler.setFormatter(formatter)
-logger.addHandler(logHandler)
+def setup_logging():
+    """Route the logs of quizzy and of the server through the pipeline
+
+    Called again once the server has started, as uvicorn replaces the handlers.
+
+    """
+    for name in ("uvicorn.error", "uvicorn.access"):
+        log_pipeline.attach(logging.getLogger(name))
+    logger.setLevel(os.environ.get("LOGLEVEL", "info").upper())
+
+    # For instance LOG_LEVELS="uvicorn.access=warning" and LOG_SAMPLING="uvicorn.access=0.1"
+    configure_loggers(os.environ.get("LOG_LEVELS", ""), os.environ.get("LOG_SAMPLING", ""))
+
+
+setup_logging()
+
+metrics.gauge(
+    "quizzy_log_records",
+    "Log records waiting to be written, and dropped as the queue was full",
+    lambda: {
+        ("queued",): log_pipeline.handler.queue.qsize(),
+        ("dropped",): log_pipeline.handler.dropped,
+    },
+    ("state",),
+)
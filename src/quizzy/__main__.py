@@ -1,28 +1,48 @@
+import argparse
+import asyncio
 from datetime import datetime
+import io
 from pathlib import Path
-from base64 import b64decode, b64encode
-import json
-from typing import List
+import sys
 
-from fastapi.responses import RedirectResponse
+from fastapi.responses import PlainTextResponse, RedirectResponse
 from fastapi_sso import OpenID
-from sqlmodel import select, Session
 import uvicorn
 from fastapi import Depends, FastAPI, Request, Response
-from nicegui import Client, ui, events
+from nicegui import Client, app, background_tasks, run, ui, events
 from starlette.middleware.sessions import SessionMiddleware
 
-from .Quiz import Quiz
-from .database import Geoip, Passage, engine, Etudiant
+from .Quiz import FilledQuiz, active_color, inactive_color
+from .registry import registry
+from .database import (
+    LEGACY_VERSION,
+    async_engine,
+    migrate,
+    statistiques_quiz,
+    versions_quiz,
+    issue_token,
+    resolve_token_async,
+    revoke_token,
+)
 from .config import config, Examen
-from . import logger
-from .auth import auth_router, get_logged_user, RequiresLoginException
+from . import logger, setup_logging
+from .auth import auth_router, get_logged_user, oidc, RequiresLoginException
+from .export import export_query, export_router, iter_export
+from .lite import lite_router
+from .metrics import MetricsMiddleware, metrics
+from .rescore import migrate_answers, rebuild_stats, rescore_quiz
+from .roster import generate_links, iter_links_csv, read_roster
+from .server import serve
+from .writer import enregistre_soumission, passage_writer
 
 
 fastapi_app = FastAPI()
 fastapi_app.add_middleware(SessionMiddleware, secret_key=config.JWT_SECRET)
+fastapi_app.add_middleware(MetricsMiddleware)
 
 fastapi_app.include_router(auth_router)
+fastapi_app.include_router(lite_router)
+fastapi_app.include_router(export_router)
 
 
 @fastapi_app.exception_handler(RequiresLoginException)
@@ -30,108 +50,6 @@ async def exception_handler(request: Request, exc: RequiresLoginException) -> Re
     return RedirectResponse(url="/auth/login")
 
 
-class FilledQuiz(Quiz):
-    def on_chip_click(self, page: int, idx: int):
-        def callback(e: events.ClickEventArguments):
-            status = self.update_color(e)
-            if status:
-                self.questions[page].user_answers.add(idx)
-            else:
-                self.questions[page].user_answers.remove(idx)
-
-        return callback
-
-    def update_color(self, e: events.ClickEventArguments) -> bool:
-        color = e.sender._props.get("color", active_color)
-        state = color == inactive_color
-        e.sender.props(f"color={active_color if state else inactive_color}")
-
-        return state
-
-    def extract_answers(self) -> List[List[int]]:
-        uans = [list(a.user_answers) for a in self.questions]
-        return uans
-
-    def serialize_answers(self) -> str:
-        uans = self.extract_answers()
-        jans = json.dumps(uans).encode("utf-8")
-        return b64encode(jans).decode("utf-8")
-
-    def decode_answer(self, answers: str) -> str:
-        sans = b64decode(answers)
-        ans_obj = json.loads(sans)
-        return ans_obj
-
-    def set_answers_from_serialzed(self, answers: str):
-        ans_obj = self.decode_answer(answers)
-        for page, qans in enumerate(ans_obj):
-            self.questions[page].user_answers = set()
-            for idx in qans:
-                self.questions[page].user_answers.add(idx)
-
-    def get_score(self) -> float:
-        count_ok = 0
-        count_total = 0
-        for q, sans in zip(self.questions, self.extract_answers()):
-            verdict = set(q.good_answers) == set(sans)
-            count_ok += 1 if verdict else 0
-            count_total += 1
-
-        score = int(100 * count_ok / count_total)
-
-        return score
-
-
-active_color = "blue"
-inactive_color = "grey"
-
-
-def enregistre_examen(examen: Examen, quizz: FilledQuiz, client_ip: str):
-    with Session(engine) as session:
-        # Upserting Etudiant
-        query = select(Etudiant).where(Etudiant.email == examen.email)
-        results = session.exec(query).all()
-
-        if len(results) == 0:
-            e = Etudiant(nom=examen.nom, prenom=examen.prenom, email=examen.email)
-            session.add(e)
-            session.commit()
-        else:
-            e = results[0]
-
-        # Upserting Geoip
-        query = select(Geoip).where(Geoip.ip_origine == client_ip)
-        results = session.exec(query).all()
-
-        if len(results) == 0:
-            gip = Geoip.from_ip_addr(client_ip)
-            session.add(gip)
-            session.commit()
-        else:
-            gip = results[0]
-
-        p = Passage(
-            quiz_nom=examen.quizz,
-            quiz_hash=quizz.hash,
-            etudiant_id=e.id,
-            date=datetime.now(),
-            reponses=quizz.serialize_answers(),
-            score=quizz.get_score(),
-            ip_origine=client_ip,
-        )
-        session.add(p)
-
-        session.commit()
-
-
-def on_click(user_results: FilledQuiz, page: int):
-    def callback(e: events.ClickEventArguments):
-        sans = user_results.serialize_answers()
-        ui.navigate.to(f"/run?token={user_results.token}&page={page}&answers={sans}", new_tab=False)
-
-    return callback
-
-
 def on_submit(user_results: FilledQuiz):
     def callback(e: events.ClickEventArguments):
         sans = user_results.serialize_answers()
@@ -145,13 +63,18 @@ def health_check():
     return {"status": "healthy"}
 
 
+@fastapi_app.get("/metrics")
+def get_metrics():
+    """Metrics in the Prometheus text format, added up over the workers"""
+    return PlainTextResponse(
+        metrics.render(max_age=4 * config.METRICS_INTERVAL),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
 @ui.page("/admin")
-def display_admin(user: OpenID = Depends(get_logged_user)):
-    qpth = Path("quizzes")
-    choices = []
-    for file in qpth.glob("*.yml"):
-        quizz_name = file.stem
-        choices.append(quizz_name)
+async def display_admin(user: OpenID = Depends(get_logged_user)):
+    choices = registry.names()
 
     ui.markdown("# Administration\n## Création d'un lien")
     select = ui.select(choices, label="Nom du quiz", value=choices[0])
@@ -165,14 +88,15 @@ def display_admin(user: OpenID = Depends(get_logged_user)):
         def __init__(self):
             self.token = ""
 
-        def on_create(self, e: events.ClickEventArguments):
+        async def on_create(self, e: events.ClickEventArguments):
             if select.value is None or email.value == "" or nom.value == "" or prenom.value == "":
                 ui.notify("Remplir le questionnaire")
                 return
 
             exam = Examen(quizz=select.value, email=email.value, nom=nom.value, prenom=prenom.value)
 
-            m = exam.get_encrypted()
+            # An opaque token is written to the database, in a thread as the other queries
+            m = await run.io_bound(issue_token, exam)
 
             token_label.set_text(m)
             self.token = m
@@ -188,18 +112,119 @@ def display_admin(user: OpenID = Depends(get_logged_user)):
         goto_btn = ui.button("Aller au quiz", on_click=ld.on_goto)
         goto_btn.disable()
 
+    ui.markdown("## Création des liens d'une promotion")
+    ui.label("Fichier CSV avec les colonnes nom, prénom et email, pour le quiz choisi ci-dessus")
+
+    async def on_roster(e: events.UploadEventArguments):
+        try:
+            examens = read_roster(select.value, io.StringIO(e.content.read().decode("utf-8-sig")))
+        except ValueError as error:
+            ui.notify(str(error))
+            return
+
+        links = await run.io_bound(generate_links, examens)
+        data = "".join(iter_links_csv(links, config.public_url)).encode("utf-8")
+        ui.download(data, f"liens_{select.value}.csv", media_type="text/csv")
+        ui.notify(f"{len(links)} liens créés")
+
+    ui.upload(on_upload=on_roster, auto_upload=True, label="Promotion (CSV)")
+
+    ui.markdown("## Correction des scores")
+    ui.label(
+        "Recalcule les scores des passages du quiz choisi, et de ses anciennes versions "
+        "dont seules les bonnes réponses ont été corrigées"
+    )
+    versions = ui.select({}, multiple=True, label="Anciennes versions aux mêmes questions")
+
+    # The queries of the page run in a thread, not to hold up the students served by the worker
+    async def show_versions():
+        quiz = registry.get(select.value)
+        nombres = await run.io_bound(versions_quiz, select.value)
+        options = {
+            quiz_hash: f"{quiz_hash[:12]} ({nombre} passages)"
+            for quiz_hash, nombre in nombres.items()
+            if quiz_hash not in (quiz.hash, LEGACY_VERSION)
+        }
+        if LEGACY_VERSION in nombres:
+            nombre = nombres[LEGACY_VERSION]
+            options[LEGACY_VERSION] = f"Antérieurs aux versions ({nombre} passages)"
+        versions.set_options(options, value=[])
+
+    async def on_rescore(e: events.ClickEventArguments):
+        nb_scored, nb_changed = await run.io_bound(rescore_quiz, select.value, versions.value)
+        ui.notify(f"{nb_scored} passages recalculés, {nb_changed} scores modifiés")
+        await show_versions()
+        show_stats.refresh()
+
+    await show_versions()
+    select.on_value_change(show_versions)
+    ui.button("Recalculer les scores", on_click=on_rescore)
+
+    ui.markdown("## Statistiques")
+
+    @ui.refreshable
+    async def show_stats():
+        quiz = registry.get(select.value)
+        options, reussites, scores, tirages = await run.io_bound(statistiques_quiz, quiz.hash)
+        total = sum(scores.values())
+
+        ui.label(f"{total} passages de la version actuelle du quiz")
+        if total == 0:
+            return
+
+        # Only the questions of the bank which were drawn, as a share of the passages which had them
+        rows = []
+        for num in sorted(tirages):
+            question = quiz.questions[num]
+            nombre = tirages[num]
+            choix = ", ".join(
+                f"{answer} : {100 * options.get((num, idx), 0) / nombre:.0f}%"
+                for idx, answer in enumerate(question.answers)
+            )
+            reussite = f"{100 * reussites.get(num, 0) / nombre:.0f}%"
+            rows.append(
+                {"question": question.text, "tirages": nombre, "reussite": reussite, "choix": choix}
+            )
+
+        columns = [
+            {"label": "Question", "field": "question", "align": "left"},
+            {"label": "Passages", "field": "tirages", "align": "center"},
+            {"label": "Réussite", "field": "reussite", "align": "center"},
+            {"label": "Réponses choisies", "field": "choix", "align": "left"},
+        ]
+        ui.table(columns=columns, rows=rows, row_key="question")
+
+        columns = [
+            {"label": "Score", "field": "score", "align": "center"},
+            {"label": "Passages", "field": "nombre", "align": "center"},
+        ]
+        rows = [{"score": score, "nombre": scores[score]} for score in sorted(scores)]
+        ui.table(columns=columns, rows=rows, row_key="score")
+
+    await show_stats()
+    select.on_value_change(lambda e: show_stats.refresh())
+    ui.button("Actualiser", on_click=show_stats.refresh)
+
+    ui.markdown("## Révocation d'un lien")
+    revoked = ui.input(label="Jeton")
+
+    async def on_revoke(e: events.ClickEventArguments):
+        if await run.io_bound(revoke_token, revoked.value):
+            ui.notify("Lien révoqué")
+        else:
+            ui.notify("Jeton inconnu")
+
+    ui.button("Révoquer", on_click=on_revoke)
+
 
 @ui.page("/results")
 async def display_results(client: Client, token: str, answers: str):
     await client.connected()
     client_ip: str = client.environ["asgi.scope"]["client"][0]
 
-    examen = Examen.from_encrypted(token)
-    quizz = examen.quizz
-    qpth = Path(f"quizzes/{quizz}.yml")
-    user_results = FilledQuiz.from_yaml(qpth)
+    examen = await resolve_token_async(token)
+    user_results = FilledQuiz(registry.get(examen.quizz), token)
     user_results.set_answers_from_serialzed(answers)
-    user_results.token = token
 
     columns = [
         {"label": "Question", "field": "question", "align": "left"},
@@ -207,8 +232,7 @@ async def display_results(client: Client, token: str, answers: str):
     ]
     rows = []
 
-    for q, sans in zip(user_results.questions, user_results.extract_answers()):
-        verdict = set(q.good_answers) == set(sans)
+    for q, verdict in zip(user_results.questions, user_results.verdicts()):
         symb = "✅" if verdict else "❌"
         rows.append({"question": q.text, "verdict": symb})  # type: ignore
 
@@ -219,25 +243,17 @@ async def display_results(client: Client, token: str, answers: str):
         ui.table(columns=columns, rows=rows, row_key="question")
         ui.markdown(f"### Bonnes réponses : {score}%")
 
-        for score_key in user_results.echelle_scores.keys():
-            if score >= score_key:
-                ui.markdown(f"#### {user_results.echelle_scores[score_key]}")
-                break
+        comment = user_results.quiz.score_comment(score)
+        if comment != "":
+            ui.markdown(f"#### {comment}")
 
-    enregistre_examen(examen, user_results, client_ip)
-    logger.info(
-        f"Exam taken: {examen.prenom} {examen.nom} <{examen.email}> @ {client_ip} - answers: {user_results.serialize_answers()} - token: {user_results.token} - score: {user_results.get_score()}"
-    )
+    await enregistre_soumission(examen, user_results, client_ip)
 
 
 @ui.page("/run")
-def run_quizz(token: str, page: int | None = None, answers: str = ""):
-    examen = Examen.from_encrypted(token)
-    quizz = examen.quizz
-
-    qpth = Path(f"quizzes/{quizz}.yml")
-    user_results = FilledQuiz.from_yaml(qpth)
-    user_results.token = token
+async def run_quizz(token: str, page: int | None = None, answers: str = ""):
+    examen = await resolve_token_async(token)
+    user_results = FilledQuiz(registry.get(examen.quizz), token)
 
     if answers != "":
         user_results.set_answers_from_serialzed(answers)
@@ -245,55 +261,259 @@ def run_quizz(token: str, page: int | None = None, answers: str = ""):
     if page is None:
         page_num = 0
     else:
-        page_num = page
+        page_num = min(max(page, 0), user_results.number_of_questions - 1)
 
-    question = user_results.questions[page_num]
+    # Only the questions drawn for the student are read, never the whole bank
+    questions = user_results.questions
+    nb_chips = max(q.number_of_answers for q in questions)
 
-    with ui.column():
-        ui.markdown(f"# {question.text}")
+    class _quiz_page:
+        """Switches between the questions in place, the server is only called again on submit
 
-        for idx, answer_text in enumerate(question.answers):
-            color = active_color if idx in question.user_answers else inactive_color
-            ui.chip(answer_text, on_click=user_results.on_chip_click(page_num, idx)).props(
-                f"color={color}"
-            )
+        The page and the answers are kept in the address bar, so that the reload of a page whose
+        connection was lost, or whose worker was restarted, does not lose them.
+
+        """
+
+        def __init__(self):
+            self.page = page_num
+
+        def save(self):
+            sans = user_results.serialize_answers()
+            ui.navigate.history.replace(f"/run?token={token}&page={self.page}&answers={sans}")
+
+        def on_chip_click(self, idx: int):
+            def callback(e: events.ClickEventArguments):
+                user_results.on_chip_click(self.page, idx)(e)
+                self.save()
+
+            return callback
+
+        def on_move(self, step: int):
+            def callback(e: events.ClickEventArguments):
+                self.show(self.page + step)
+
+            return callback
+
+        def show(self, page: int):
+            self.page = page
+            question = questions[page]
+
+            text.set_content(f"# {question.text}")
+            for idx, chip in enumerate(chips):
+                if idx < question.number_of_answers:
+                    color = active_color if user_results.is_selected(page, idx) else inactive_color
+                    chip.set_text(question.answers[idx])
+                    chip.props(f"color={color}")
+                chip.set_visibility(idx < question.number_of_answers)
+
+            last = page == user_results.number_of_questions - 1
+            prev_btn.set_visibility(page > 0)
+            next_btn.set_visibility(not last)
+            submit_btn.set_visibility(last)
+            self.save()
+
+    qp = _quiz_page()
+
+    with ui.column():
+        text = ui.markdown()
+        chips = [ui.chip(on_click=qp.on_chip_click(idx)) for idx in range(nb_chips)]
 
         with ui.button_group():
-            if page_num > 0:
-                ui.button("Précédent", on_click=on_click(user_results, page_num - 1))
+            prev_btn = ui.button("Précédent", on_click=qp.on_move(-1))
+            next_btn = ui.button("Suivant", on_click=qp.on_move(1))
+            submit_btn = ui.button("Soumettre", on_click=on_submit(user_results))
 
-            if page_num < user_results.number_of_questions - 1:
-                ui.button("Suivant", on_click=on_click(user_results, page_num + 1))
-            else:
-                ui.button("Soumettre", on_click=on_submit(user_results))
+    qp.show(page_num)
 
 
 @ui.page("/accueil")
-def accueil_quizz(token: str):
-    examen = Examen.from_encrypted(token)
+async def accueil_quizz(token: str):
+    examen = await resolve_token_async(token)
 
-    quizz = examen.quizz
-    qpth = Path(f"quizzes/{quizz}.yml")
-    user_results = FilledQuiz.from_yaml(qpth)
-    user_results.token = token
+    quiz = registry.get(examen.quizz)
 
     with ui.column():
-        ui.markdown(user_results.message_accueil.format(prenom=examen.prenom))
+        ui.markdown(quiz.message_accueil.format(prenom=examen.prenom))
 
         ui.button(
-            user_results.text_bouton,
-            on_click=lambda: ui.navigate.to(f"/run?token={user_results.token}"),
+            quiz.text_bouton,
+            on_click=lambda: ui.navigate.to(f"/run?token={token}"),
         )
 
 
+async def refresh_cached_files():
+    """Refresh the GeoIP database and the OIDC discovery document once they get stale
+
+    The server starts with the local copies, so that it does not wait for the downloads.
+
+    """
+    while True:
+        await run.io_bound(config.refresh_geoip)
+        try:
+            await oidc.refresh()
+        except Exception as error:
+            logger.error(f"Could not fetch the OIDC discovery document: {error}")
+        await asyncio.sleep(config.REFRESH_INTERVAL)
+
+
+async def load_quizzes():
+    """Compile the quizzes in the background, so that the first students do not wait for a bank
+
+    With several workers, they were already compiled by the master process.
+
+    """
+    for name in registry.names():
+        try:
+            await run.io_bound(registry.get, name)
+        except Exception as error:
+            logger.error(f"Could not load the quiz {name}: {error}")
+
+
+app.on_startup(setup_logging)
+app.on_startup(lambda: background_tasks.create(refresh_cached_files(), name="refresh_cached_files"))
+app.on_startup(lambda: background_tasks.create(load_quizzes(), name="load_quizzes"))
+
+
+async def dump_metrics():
+    """Share the metrics of this worker with the others, which may be the one scraped"""
+    while True:
+        await asyncio.sleep(config.METRICS_INTERVAL)
+        try:
+            await run.io_bound(metrics.dump)
+        except OSError as error:
+            logger.error(f"Could not dump the metrics: {error}")
+
+
+@app.on_startup
+def start_dump_metrics():
+    if metrics.directory is not None:
+        background_tasks.create(dump_metrics(), name="dump_metrics")
+
+
+if config.WRITE_BEHIND:
+    app.on_startup(passage_writer.start)
+    app.on_shutdown(passage_writer.stop)
+
+# The pooled asyncpg connections belong to the event loop of the server
+app.on_shutdown(async_engine.dispose)
+app.on_shutdown(oidc.aclose)
+
 ui.run_with(
     fastapi_app,
     title="Quizzy",
     favicon="🎓",
-    storage_secret="pick your private secret here",  # NOTE setting a secret is optional but allows for persistent storage per user
+    # The same on every worker, so that the browser cookie of NiceGUI stays valid on all of them
+    storage_secret=config.storage_secret,
 )
 
-if __name__ == "__main__":
-    uvicorn.run(
-        "quizzy.__main__:fastapi_app", host="0.0.0.0", port=8000, log_level="info", reload=False
+
+def main():
+    parser = argparse.ArgumentParser(prog="quizzy")
+    subparsers = parser.add_subparsers(dest="command")
+
+    serve_parser = subparsers.add_parser("serve", help="Run the web server (default)")
+    serve_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=config.WORKERS,
+        help="Number of worker processes, 0 for one per core (default: WORKERS). Each one "
+        "listens on its own port, from --port on",
+    )
+    serve_parser.add_argument("-p", "--port", type=int, default=8000)
+
+    roster_parser = subparsers.add_parser("roster", help="Create the exam links of a CSV roster")
+    roster_parser.add_argument("quizz", help="Name of the quiz")
+    roster_parser.add_argument("roster", type=Path, help="CSV with nom, prénom and email columns")
+    roster_parser.add_argument("-o", "--output", type=Path, help="CSV of links (default: stdout)")
+    roster_parser.add_argument("--base-url", default=config.public_url)
+    roster_parser.add_argument("-j", "--workers", type=int, help="Processes minting the tokens")
+
+    rescore_parser = subparsers.add_parser("rescore", help="Score again the passages of a quiz")
+    rescore_parser.add_argument("quizz", help="Name of the quiz")
+    rescore_parser.add_argument(
+        "--version",
+        dest="versions",
+        action="append",
+        default=[],
+        help="Hash of an older version with the same questions, to score and move to the current "
+        f"one, or '{LEGACY_VERSION}' for the passages recorded before the versions. "
+        "May be repeated",
     )
+    rescore_parser.add_argument("--dry-run", action="store_true", help="Do not write the scores")
+
+    stats_parser = subparsers.add_parser("stats", help="Rebuild the statistics of a quiz")
+    stats_parser.add_argument("quizz", help="Name of the quiz")
+
+    subparsers.add_parser("migrate", help="Create the tables and the indexes which are missing")
+
+    subparsers.add_parser(
+        "migrate-answers", help="Convert the stored answers to the compact encoding"
+    )
+
+    export_parser = subparsers.add_parser("export", help="Export the passages")
+    export_parser.add_argument(
+        "-f", "--format", choices=["csv", "ndjson", "parquet"], default="csv"
+    )
+    export_parser.add_argument("-o", "--output", type=Path, help="Output file (default: stdout)")
+    export_parser.add_argument("--quizz", help="Only export the passages of this quiz")
+    export_parser.add_argument("--hash", help="Only export the passages of this quiz version")
+    export_parser.add_argument("--debut", type=datetime.fromisoformat, help="From this date")
+    export_parser.add_argument("--fin", type=datetime.fromisoformat, help="Until this date")
+
+    args = parser.parse_args()
+
+    if args.command == "roster":
+        with open(args.roster, "r", encoding="utf-8-sig", newline="") as f:
+            examens = read_roster(args.quizz, f)
+        links = generate_links(examens, args.workers)
+
+        out = sys.stdout if args.output is None else open(args.output, "w", newline="")
+        with out:
+            out.writelines(iter_links_csv(links, args.base_url))
+        return
+
+    if args.command == "rescore":
+        nb_scored, nb_changed = rescore_quiz(args.quizz, args.versions, dry_run=args.dry_run)
+        print(f"{nb_scored} passages scored, {nb_changed} scores changed")
+        return
+
+    if args.command == "stats":
+        print(f"{rebuild_stats(args.quizz)} passages counted")
+        return
+
+    if args.command == "migrate":
+        migrate()
+        return
+
+    if args.command == "migrate-answers":
+        print(f"{migrate_answers()} passages converted")
+        return
+
+    if args.command == "export":
+        query = export_query(args.quizz, args.hash, args.debut, args.fin)
+        binary = args.format == "parquet"
+        if args.output is None:
+            out = sys.stdout.buffer if binary else sys.stdout
+        elif binary:
+            out = open(args.output, "wb")
+        else:
+            out = open(args.output, "w", newline="", encoding="utf-8")
+        with out:
+            for data in iter_export(query, args.format):
+                out.write(data)
+        return
+
+    workers = getattr(args, "workers", config.WORKERS)
+    port = getattr(args, "port", 8000)
+    if workers != 1:
+        serve(fastapi_app, workers, port=port)
+        return
+
+    # The app itself, as importing "quizzy.__main__" would register the startup hooks again
+    uvicorn.run(fastapi_app, host="0.0.0.0", port=port, log_level="info", reload=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,23 @@
-import requests
+import asyncio
 import datetime  # to calculate expiration of the JWT
+import json
+import os
+from pathlib import Path
+import time
 
-from typing import Any, Union
+from typing import Any, Dict, Union
+import httpx
 from httpx import AsyncClient
-from fastapi_sso.sso.base import DiscoveryDocument, OpenID
-from fastapi_sso.sso.generic import create_provider
+from fastapi_sso.sso.base import OpenID
 from fastapi import APIRouter, HTTPException, Security, Request
 from fastapi.responses import RedirectResponse
 from fastapi.security import APIKeyCookie  # this is the part that puts the lock icon to the docs
 
-from jose import jwt  # pip install python-jose[cryptography]
+from jose import JWTError, jwt  # pip install python-jose[cryptography]
 
-from .config import config
+from .cache import TTLCache
+from .config import config, is_fresh
+from . import logger
 
 auth_router = APIRouter(prefix="/auth")
 
@@ -22,49 +28,231 @@ class RequiresLoginException(HTTPException):
 
 def convert_openid(response: dict[str, Any], _client: Union[AsyncClient, None]) -> OpenID:
     """Convert user information returned by OIDC"""
-    print(response)
     return OpenID(display_name=response["sub"])
 
 
-def load_discovery_document(oid_url: str) -> DiscoveryDocument:
-    ret = requests.get(oid_url)
+# Minimum delay between two downloads of the keys, when a token is signed with an unknown key
+JWKS_MIN_INTERVAL = 60.0
+
+
+async def load_discovery_document(
+    oid_url: str, client: AsyncClient | None = None
+) -> Dict[str, str]:
+    """Fetch the endpoints and the keys location of the identity provider"""
+    if client is None:
+        async with AsyncClient(timeout=10) as client:
+            return await load_discovery_document(oid_url, client)
+
+    ret = await client.get(oid_url)
+    ret.raise_for_status()
     dat = ret.json()
-    doc = DiscoveryDocument(
-        {
-            "authorization_endpoint": str(dat["authorization_endpoint"]),
-            "token_endpoint": str(dat["token_endpoint"]),
-            "userinfo_endpoint": str(dat["userinfo_endpoint"]),
-        }
-    )
+    doc = {
+        "authorization_endpoint": str(dat["authorization_endpoint"]),
+        "token_endpoint": str(dat["token_endpoint"]),
+        "userinfo_endpoint": str(dat["userinfo_endpoint"]),
+    }
+    for key in ("jwks_uri", "issuer"):
+        if key in dat:
+            doc[key] = str(dat[key])
+    if "id_token_signing_alg_values_supported" in dat:
+        doc["id_token_signing_alg_values_supported"] = dat["id_token_signing_alg_values_supported"]
     return doc
 
 
-discovery_document = load_discovery_document(str(config.OPENID_CONFIG_URL))
+class OIDCClient:
+    """Long-lived client of the identity provider
+
+    All the requests go through one pooled HTTP client, which keeps its connections open between
+    the logins. The discovery document is cached in *discovery_pth*, shared by the workers, and
+    the signing keys (JWKS) are kept in memory: both are refreshed by `refresh`.
+
+    Args:
+        discovery_url: URL of the discovery document
+        discovery_pth: Local copy of the discovery document
+        transport: Transport of the HTTP client, for the tests
+
+    """
+
+    def __init__(
+        self,
+        discovery_url: str,
+        discovery_pth: Path,
+        transport: httpx.AsyncBaseTransport | None = None,
+    ):
+        self.discovery_url = discovery_url
+        self.discovery_pth = discovery_pth
+        self.transport = transport
+        self.discovery_document: Dict[str, Any] | None = None
+        self.jwks: Dict[str, Any] | None = None
+        self._jwks_time = 0.0
+        self._client: AsyncClient | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    @property
+    def client(self) -> AsyncClient:
+        """The HTTP client of the running event loop, created on first use in each worker"""
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            # The connections of a client cannot be used from another event loop
+            self._client = AsyncClient(
+                timeout=10,
+                transport=self.transport,
+                limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60),
+            )
+            self._loop = loop
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            client, self._client = self._client, None
+            if self._loop is asyncio.get_running_loop():
+                await client.aclose()
+
+    async def refresh(self, force: bool = False):
+        """Fetch the discovery document if its local copy is missing or older than
+        DISCOVERY_MAX_AGE, then the signing keys
+
+        A failure is only logged when a cached document is available.
+
+        """
+        pth = self.discovery_pth
+        if force or not is_fresh(pth, config.DISCOVERY_MAX_AGE):
+            try:
+                doc = await load_discovery_document(self.discovery_url, self.client)
+            except Exception as error:
+                if not pth.exists():
+                    raise
+                logger.error(f"Could not refresh the OIDC discovery document: {error}")
+            else:
+                tmp_pth = pth.with_name(f"{pth.name}.{os.getpid()}.tmp")
+                tmp_pth.write_text(json.dumps(doc), encoding="utf-8")
+                os.replace(tmp_pth, pth)
+
+        # The copy may have been refreshed by another worker
+        self.discovery_document = json.loads(pth.read_text(encoding="utf-8"))
+
+        if "jwks_uri" in self.discovery_document:
+            try:
+                await self.refresh_jwks()
+            except Exception as error:
+                if self.jwks is None:
+                    raise
+                logger.error(f"Could not refresh the OIDC signing keys: {error}")
+
+    async def refresh_jwks(self):
+        self._jwks_time = time.monotonic()
+        res = await self.client.get(self.discovery_document["jwks_uri"])
+        res.raise_for_status()
+        self.jwks = res.json()
+
+    async def get_discovery_document(self) -> Dict[str, Any]:
+        if self.discovery_document is None:
+            if self.discovery_pth.exists():
+                self.discovery_document = json.loads(self.discovery_pth.read_text(encoding="utf-8"))
+            else:
+                await self.refresh(force=True)
 
-GenericSSO = create_provider(
-    name="oidc", discovery_document=discovery_document, response_convertor=convert_openid
-)
+        return self.discovery_document
 
-sso = GenericSSO(
-    client_id=config.CLIENT_ID,
-    client_secret=config.CLIENT_SECRET,
-    redirect_uri=config.REDIRECT_URI,
-    allow_insecure_http=True,
-)
+    async def login_url(self) -> str:
+        doc = await self.get_discovery_document()
+        url = httpx.URL(doc["authorization_endpoint"])
+        return str(
+            url.copy_merge_params(
+                dict(
+                    response_type="code",
+                    client_id=config.CLIENT_ID,
+                    redirect_uri=str(config.REDIRECT_URI),
+                    scope="openid",
+                )
+            )
+        )
+
+    async def verify_id_token(self, id_token: str, access_token: str | None) -> Dict[str, Any]:
+        """Check the signature and the claims of an ID token against the cached keys
+
+        The keys are downloaded again, at most every JWKS_MIN_INTERVAL seconds, when the token
+        is signed with an unknown one, as after a rotation of the keys of the provider.
+
+        """
+        doc = await self.get_discovery_document()
+        kid = jwt.get_unverified_header(id_token).get("kid")
+
+        def known(jwks: Dict[str, Any] | None) -> bool:
+            return jwks is not None and (
+                kid is None or any(key.get("kid") == kid for key in jwks.get("keys", []))
+            )
+
+        if not known(self.jwks) and time.monotonic() - self._jwks_time > JWKS_MIN_INTERVAL:
+            await self.refresh_jwks()
+        if not known(self.jwks):
+            raise JWTError(f"Unknown signing key {kid}")
+
+        return jwt.decode(
+            id_token,
+            self.jwks,
+            algorithms=doc.get("id_token_signing_alg_values_supported", ["RS256"]),
+            audience=config.CLIENT_ID,
+            issuer=doc.get("issuer"),
+            access_token=access_token,
+        )
+
+    async def authenticate(self, code: str) -> OpenID:
+        """Exchange the authorization code, and return the user it identifies
+
+        The user is read from the ID token when the provider publishes its keys, which saves
+        the request to the userinfo endpoint.
+
+        """
+        doc = await self.get_discovery_document()
+        res = await self.client.post(
+            doc["token_endpoint"],
+            data=dict(
+                grant_type="authorization_code",
+                code=code,
+                redirect_uri=str(config.REDIRECT_URI),
+                client_id=config.CLIENT_ID,
+            ),
+            auth=(config.CLIENT_ID, config.CLIENT_SECRET),
+        )
+        res.raise_for_status()
+        tokens = res.json()
+
+        if "id_token" in tokens and "jwks_uri" in doc:
+            claims = await self.verify_id_token(tokens["id_token"], tokens.get("access_token"))
+            return convert_openid(claims, self.client)
+
+        res = await self.client.get(
+            doc["userinfo_endpoint"],
+            headers={"Authorization": f"Bearer {tokens['access_token']}"},
+        )
+        res.raise_for_status()
+        return convert_openid(res.json(), self.client)
+
+
+oidc = OIDCClient(str(config.OPENID_CONFIG_URL), config.discovery_pth)
+
+# Verified admin cookies, with the expiration of their JWT
+session_cache = TTLCache(config.SESSION_CACHE_SIZE, config.SESSION_CACHE_TTL)
 
 
 async def get_logged_user(cookie: str = Security(APIKeyCookie(name="token"))) -> OpenID:
     """Get user's JWT stored in cookie 'token', parse it and return the user's OpenID."""
-    print("toto")
+    entry = session_cache.get(cookie)
+    if entry is not None and entry[0] > time.time():
+        return entry[1]
+
     try:
         claims = jwt.decode(cookie, key=config.JWT_SECRET, algorithms=["HS256"])
-        print(claims)
-        return OpenID(**claims["pld"])
+        user = OpenID(**claims["pld"])
     except Exception as error:
         raise RequiresLoginException(
             status_code=401, detail="Invalid authentication credentials"
         ) from error
 
+    session_cache.set(cookie, (claims["exp"], user))
+    return user
+
 
 # @auth_router.get("/protected")
 # async def protected_endpoint(user: OpenID = Depends(get_logged_user)):
@@ -77,14 +265,14 @@ async def get_logged_user(cookie: str = Security(APIKeyCookie(name="token"))) ->
 
 @auth_router.get("/login")
 async def login():
-    """Redirect the user to the Google login page."""
-    async with sso:
-        return await sso.get_login_redirect()
+    """Redirect the user to the login page of the identity provider."""
+    return RedirectResponse(await oidc.login_url(), 303)
 
 
 @auth_router.get("/logout")
-async def logout():
+async def logout(request: Request):
     """Forget the user's session."""
+    session_cache.pop(request.cookies.get("token"))
     response = RedirectResponse(url="/protected")
     response.delete_cookie(key="token")
     return response
@@ -93,10 +281,14 @@ async def logout():
 @auth_router.get("/callback")
 async def login_callback(request: Request):
     """Process login and redirect the user to the protected endpoint."""
-    async with sso:
-        openid = await sso.verify_and_process(request)
-        if not openid:
-            raise HTTPException(status_code=401, detail="Authentication failed")
+    code = request.query_params.get("code")
+    if code is None:
+        raise HTTPException(status_code=400, detail="'code' parameter was not found")
+    try:
+        openid = await oidc.authenticate(code)
+    except (httpx.HTTPError, JWTError, KeyError, ValueError) as error:
+        logger.warning(f"Authentication failed: {error!r}")
+        raise HTTPException(status_code=401, detail="Authentication failed") from error
     # Create a JWT with the user's OpenID
     expiration = datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(days=1)
     token = jwt.encode(
@@ -1,20 +1,103 @@
 from datetime import datetime
 from pathlib import Path
+import os
+import time
+from typing import Callable, List, Literal
+from urllib.parse import urlsplit
 import jwt
 import json
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from pydantic import AnyHttpUrl, BaseModel
+from pydantic import AnyHttpUrl, BaseModel, ConfigDict
 import requests
 
+from .cache import TTLCache
+from .metrics import metrics
+from . import logger
 
-def download_geoip_db(db_url: AnyHttpUrl, dest_file: Path):
-    import zlib
 
-    res = requests.get(str(db_url))
-    data = zlib.decompress(res.content, zlib.MAX_WBITS | 32)
+def is_fresh(pth: Path, max_age: float) -> bool:
+    """Tell whether *pth* exists and was written less than *max_age* seconds ago"""
+    try:
+        return time.time() - pth.stat().st_mtime < max_age
+    except FileNotFoundError:
+        return False
+
+
+# Size of the chunks read from the network and written to disk
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+
+
+def download_geoip_db(db_url: AnyHttpUrl, dest_file: Path) -> bool:
+    """Download and decompress the GeoIP database, unless it did not change since the last download
+
+    The archive is decompressed on the fly into a temporary file, which is checked before
+    replacing *dest_file*. The ETag and Last-Modified headers of the response are kept next to
+    it, to make the next request conditional.
 
-    with open(dest_file, "wb") as f:
-        f.write(data)
+    Returns:
+        Whether *dest_file* was replaced
+
+    Raises:
+        requests.HTTPError: If the server answers with an error
+        ValueError: If the downloaded file is not a valid database
+
+    """
+    import zlib
+
+    import geoip2.database
+    from maxminddb import MODE_FILE
+    from maxminddb.errors import InvalidDatabaseError
+
+    meta_file = dest_file.with_name(dest_file.name + ".json")
+    headers = {}
+    if dest_file.exists() and meta_file.exists():
+        meta = json.loads(meta_file.read_text())
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    with requests.get(str(db_url), headers=headers, stream=True, timeout=60) as res:
+        if res.status_code == 304:
+            # Unchanged: the local copy is fresh again
+            dest_file.touch()
+            return False
+        res.raise_for_status()
+
+        # The file is memory mapped by the running readers, so it must be replaced, never rewritten
+        tmp_file = dest_file.with_name(f"{dest_file.name}.{os.getpid()}.tmp")
+        try:
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+            with open(tmp_file, "wb") as f:
+                for chunk in res.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    # The output is bounded too, a small archive can inflate a lot
+                    while chunk:
+                        f.write(decompressor.decompress(chunk, DOWNLOAD_CHUNK_SIZE))
+                        chunk = decompressor.unconsumed_tail
+                f.write(decompressor.flush())
+            if not decompressor.eof:
+                raise ValueError("Truncated GeoIP archive")
+
+            try:
+                with geoip2.database.Reader(str(tmp_file), mode=MODE_FILE) as reader:
+                    database_type = reader.metadata().database_type
+            except InvalidDatabaseError as error:
+                raise ValueError(f"Invalid GeoIP database: {error}") from error
+            if "City" not in database_type:
+                raise ValueError(f"Expected a GeoIP city database, got {database_type}")
+
+            os.replace(tmp_file, dest_file)
+        finally:
+            tmp_file.unlink(missing_ok=True)
+
+        meta = dict(etag=res.headers.get("ETag"), last_modified=res.headers.get("Last-Modified"))
+        meta_file.write_text(json.dumps(meta))
+
+    return True
+
+
+# Called after each refresh of the GeoIP database
+geoip_listeners: List[Callable[[], None]] = []
 
 
 class QuizzyConfig(BaseSettings):
@@ -36,28 +119,87 @@ class QuizzyConfig(BaseSettings):
     SERVICE_USER_POSTGRESQL: str
     POSTGRES_HOST: str
     GEOIP2_DB_URL: AnyHttpUrl
+    EXAMEN_CACHE_SIZE: int = 4096
+    EXAMEN_CACHE_TTL: float = 600.0
+    TOKEN_MODE: Literal["jwt", "opaque"] = "jwt"
+    JETON_CACHE_SIZE: int = 4096
+    JETON_CACHE_TTL: float = 60.0
+    SESSION_CACHE_SIZE: int = 1024
+    SESSION_CACHE_TTL: float = 60.0
+    GEOIP_CACHE_SIZE: int = 16384
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_RECYCLE: int = 1800
+    SOUMISSION_CACHE_SIZE: int = 16384
+    SOUMISSION_CACHE_TTL: float = 3600.0
+    GEOIP_MAX_AGE: float = 7 * 24 * 3600.0
+    DISCOVERY_MAX_AGE: float = 24 * 3600.0
+    REFRESH_INTERVAL: float = 3600.0
+    WRITE_BEHIND: bool = False
+    WRITE_BEHIND_BATCH: int = 200
+    WRITE_BEHIND_INTERVAL: float = 0.25
+    WRITE_BEHIND_QUEUE_SIZE: int = 10000
+    WRITE_BEHIND_SPILL: Path = Path("passages_spill.jsonl")
+    WORKERS: int = 1
+    STORAGE_SECRET: str | None = None
+    METRICS_DIR: Path | None = None
+    METRICS_INTERVAL: float = 15.0
+
+    def refresh_geoip(self):
+        """Download the GeoIP database if the local copy is missing or older than GEOIP_MAX_AGE
+
+        The readers are only reopened when the file was replaced, possibly by another worker.
+        A failure is only logged: the current copy, if any, keeps being used.
+
+        """
+        import fcntl
+
+        if not is_fresh(self.geoip_pth, self.GEOIP_MAX_AGE):
+            try:
+                # The workers share the file: only one of them downloads it
+                with open(self.geoip_pth.with_name(self.geoip_pth.name + ".lock"), "w") as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    if not is_fresh(self.geoip_pth, self.GEOIP_MAX_AGE):
+                        download_geoip_db(self.GEOIP2_DB_URL, self.geoip_pth)
+            except Exception as error:
+                logger.error(f"Could not download the GeoIP database: {error}")
+
+        for callback in geoip_listeners:
+            callback()
 
-    def load_geoip(self):
-        download_geoip_db(self.GEOIP2_DB_URL, self.geoip_pth)
+    @property
+    def public_url(self) -> str:
+        """Root URL of the application, as seen by the students"""
+        url = urlsplit(str(self.REDIRECT_URI))
+        return f"{url.scheme}://{url.netloc}"
+
+    @property
+    def storage_secret(self) -> str:
+        """Signs the NiceGUI browser cookie, which must be valid on every worker"""
+        return self.STORAGE_SECRET or self.COOKIE_SECRET
 
     @property
     def geoip_pth(self) -> Path:
         return Path(".") / "GeoLite2-City.mmdb"
 
+    @property
+    def discovery_pth(self) -> Path:
+        return Path(".") / "oidc-discovery.json"
+
 
 class Examen(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     quizz: str
     email: str
     nom: str
     prenom: str
 
     def get_encrypted(self) -> str:
-        from .config import config
-        from .crypto import encrypt_payload
-
         dt_now = datetime.now().isoformat()
         aes_payload = dict(
-            token_creation_date=dt_now, exam_data=encrypt_payload(self.model_dump_json())
+            token_creation_date=dt_now, exam_data=crypto.encrypt_payload(self.model_dump_json())
         )
 
         encoded = jwt.encode(aes_payload, config.JWT_SECRET, algorithm="HS256")
@@ -65,17 +207,36 @@ class Examen(BaseModel):
 
     @classmethod
     def from_encrypted(cls, cipher: str):
-        from .config import config
-        from .crypto import decrypt_payload
+        start = time.perf_counter()
+        # A token is only stored once verified, so a tampered token is always a miss
+        examen = examen_cache.get(cipher)
+        if examen is not None:
+            from_encrypted_hit.observe(time.perf_counter() - start)
+            return examen
 
         aes_payload = jwt.decode(cipher, config.JWT_SECRET, algorithms="HS256")
         # sdt=aes_payload['token_creation_date']
         # token_creation_date=datetime.fromisoformat(sdt)
 
-        dat = json.loads(decrypt_payload(aes_payload["exam_data"]))
+        dat = json.loads(crypto.decrypt_payload(aes_payload["exam_data"]))
+
+        examen = cls.model_validate(dat)
+        examen_cache.set(cipher, examen)
+        from_encrypted_miss.observe(time.perf_counter() - start)
 
-        return cls.model_validate(dat)
+        return examen
 
 
 config = QuizzyConfig()
-config.load_geoip()
+
+# Verified exams, by token
+examen_cache = TTLCache(config.EXAMEN_CACHE_SIZE, config.EXAMEN_CACHE_TTL)
+
+from_encrypted_seconds = metrics.histogram(
+    "quizzy_token_decode_seconds", "Time to decode the exam tokens, by cache outcome", ("cache",)
+)
+from_encrypted_hit = from_encrypted_seconds.labels("hit")
+from_encrypted_miss = from_encrypted_seconds.labels("miss")
+
+# crypto needs the config object, hence the late import
+from . import crypto  # noqa: E402
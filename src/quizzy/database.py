@@ -1,31 +1,112 @@
+from collections import Counter
 from datetime import datetime
+from functools import lru_cache
+import secrets
+from typing import Any, Dict, List, Tuple
 
-from sqlmodel import Field, Relationship, SQLModel, create_engine
+from sqlalchemy import Insert, and_, case, column, func, inspect, text, values
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import Field, Relationship, Session, SQLModel, create_engine, select
 import geoip2.database
 import geoip2.errors
 from geoip2.models import City
+from maxminddb import MODE_MMAP
+from maxminddb.errors import InvalidDatabaseError
 
-from .config import config
+from .cache import TTLCache
+from .config import config, geoip_listeners, Examen
+from .metrics import metrics
+from .Quiz import FilledQuiz, mask_to_indices
+from . import logger
+
+
+geoip_seconds = metrics.histogram(
+    "quizzy_geoip_seconds", "Time to look up the IP addresses missing from the location cache"
+)
+
+enregistre_seconds = metrics.histogram(
+    "quizzy_enregistre_seconds", "Time spent recording the submissions, by step", ("step",)
+)
+step_geoip = enregistre_seconds.labels("geoip")
+step_record = enregistre_seconds.labels("record")
+step_statement = enregistre_seconds.labels("statement")
+step_execute = enregistre_seconds.labels("execute")
+step_batch = enregistre_seconds.labels("batch")
+
+# Shared by all the requests, and by the forked workers, which then share the mapped pages
+_geoip_reader: geoip2.database.Reader | None = None
+
+# Inode of the file mapped by _geoip_reader, which changes each time the file is replaced
+_geoip_inode: int | None = None
+
+
+def open_geoip_reader():
+    """Open the GeoIP database in memory map mode, replacing the current reader
+
+    The previous reader is not closed, as other threads may still be using it:
+    it is released once garbage collected.
+
+    """
+    global _geoip_reader, _geoip_inode
+
+    if not config.geoip_pth.exists():
+        logger.info(f"No GeoIP database yet at {config.geoip_pth}, locations are not recorded")
+        return
+
+    try:
+        reader = geoip2.database.Reader(config.geoip_pth, mode=MODE_MMAP)
+    except (OSError, InvalidDatabaseError) as error:
+        logger.error(f"Could not open GeoIP database {config.geoip_pth}: {error}")
+        return
+
+    _geoip_reader = reader
+    _geoip_inode = config.geoip_pth.stat().st_ino
+    locate_ip.cache_clear()
+
+
+def reload_geoip_reader():
+    """Reopen the GeoIP database if the file was replaced since it was opened"""
+    try:
+        inode = config.geoip_pth.stat().st_ino
+    except FileNotFoundError:
+        return
+
+    if inode != _geoip_inode:
+        open_geoip_reader()
 
 
 def get_geoip_info(ip_addr: str) -> City | None:
-    # This creates a Reader object. You should use the same object
-    # across multiple requests as creation of it is expensive.
-    with geoip2.database.Reader(config.geoip_pth) as reader:
-        try:
+    reader = _geoip_reader
+    if reader is None:
+        return None
+
+    try:
+        with geoip_seconds.time():
             response = reader.city(ip_addr)
-        except geoip2.errors.AddressNotFoundError:
-            response = None
+    except geoip2.errors.AddressNotFoundError:
+        response = None
 
     return response
 
 
+@lru_cache(maxsize=config.GEOIP_CACHE_SIZE)
+def locate_ip(ip_addr: str) -> Tuple[float | None, float | None, float | None] | None:
+    """Return the latitude, longitude and accuracy radius of an IP address"""
+    city = get_geoip_info(ip_addr)
+    if city is None or city.location is None:
+        return None
+
+    loc = city.location
+    return loc.latitude, loc.longitude, loc.accuracy_radius
+
+
 class Etudiant(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
     nom: str
     prenom: str
     passages: list["Passage"] = Relationship(back_populates="etudiant")
-    email: str
+    email: str = Field(unique=True, index=True)
 
 
 class Geoip(SQLModel, table=True):
@@ -39,17 +120,17 @@ class Geoip(SQLModel, table=True):
 
     @classmethod
     def from_ip_addr(cls, ip_addr: str) -> "Geoip":
-        city = get_geoip_info(ip_addr)
-        if city is None or city.location is None:
+        location = locate_ip(ip_addr)
+        if location is None:
             gip = Geoip(
                 ip_origine=ip_addr,
             )
         else:
             gip = Geoip(
                 ip_origine=ip_addr,
-                latitude=city.location.latitude,
-                longitude=city.location.longitude,
-                accuracy_radius=city.location.accuracy_radius,
+                latitude=location[0],
+                longitude=location[1],
+                accuracy_radius=location[2],
             )
 
         return gip
@@ -58,18 +139,550 @@ class Geoip(SQLModel, table=True):
 class Passage(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
     quiz_nom: str
-    quiz_hash: str
+    quiz_hash: str = Field(index=True)
     etudiant_id: int = Field(foreign_key="etudiant.id")
     etudiant: Etudiant = Relationship(back_populates="passages")
     ip_origine: str = Field(foreign_key="geoip.ip_origine")
     geoip: Geoip = Relationship(back_populates="passages")
     date: datetime
     reponses: str
+    # Indices of the questions drawn from the bank, in the order of the answers, encoded like
+    # them. None when the quiz has no bank: the answers are then those of all its questions
+    tirage: str | None = None
     score: float
+    # Unique per token and answers, so that reloading the results does not record them again
+    cle: str | None = Field(default=None, unique=True, index=True)
+
+
+class Jeton(SQLModel, table=True):
+    """Opaque exam token, resolved through this table instead of being decrypted"""
+
+    id: str = Field(primary_key=True)
+    quizz: str
+    email: str
+    nom: str
+    prenom: str
+    date: datetime
+    revoque: bool = False
+
+    def to_examen(self) -> Examen:
+        return Examen(quizz=self.quizz, email=self.email, nom=self.nom, prenom=self.prenom)
+
+
+class StatOption(SQLModel, table=True):
+    """Number of passages of a quiz version where an option of a question was chosen"""
+
+    quiz_hash: str = Field(primary_key=True)
+    question: int = Field(primary_key=True)
+    option: int = Field(primary_key=True)
+    nombre: int = 0
+
+
+class StatQuestion(SQLModel, table=True):
+    """Number of passages of a quiz version where a question was answered right, and where it
+    was drawn"""
 
+    quiz_hash: str = Field(primary_key=True)
+    question: int = Field(primary_key=True)
+    reussites: int = 0
+    tirages: int = 0
 
-engine = create_engine(
-    f"postgresql://{config.POSTGRES_USER}:{config.POSTGRES_PASSWORD}@{config.POSTGRES_HOST}:5432/{config.POSTGRES_DB}"
+
+class StatScore(SQLModel, table=True):
+    """Number of passages of a quiz version which got a score"""
+
+    quiz_hash: str = Field(primary_key=True)
+    score: int = Field(primary_key=True)
+    nombre: int = 0
+
+
+open_geoip_reader()
+geoip_listeners.append(reload_geoip_reader)
+
+
+def database_url(driver: str = "psycopg2") -> str:
+    return (
+        f"postgresql+{driver}://{config.POSTGRES_USER}:{config.POSTGRES_PASSWORD}"
+        f"@{config.POSTGRES_HOST}:5432/{config.POSTGRES_DB}"
+    )
+
+
+pool_options = dict(
+    pool_size=config.DB_POOL_SIZE,
+    max_overflow=config.DB_MAX_OVERFLOW,
+    pool_timeout=config.DB_POOL_TIMEOUT,
+    pool_recycle=config.DB_POOL_RECYCLE,
+    pool_pre_ping=True,
+)
+
+engine = create_engine(database_url(), **pool_options)
+
+# Used from the NiceGUI pages and the async endpoints, so that a slow database
+# does not block the event loop
+async_engine = create_async_engine(database_url("asyncpg"), **pool_options)
+
+
+def pool_usage() -> Dict[Tuple[str, str], float]:
+    usage = {}
+    for name, pool in (("sync", engine.pool), ("async", async_engine.pool)):
+        usage[name, "checked_out"] = pool.checkedout()
+        usage[name, "idle"] = pool.checkedin()
+        usage[name, "overflow"] = max(pool.overflow(), 0)
+    return usage
+
+
+metrics.gauge(
+    "quizzy_db_connections",
+    "Connections of the database pools, by engine and state",
+    pool_usage,
+    ("engine", "state"),
 )
 
-SQLModel.metadata.create_all(engine)
+
+def dedoublonne_etudiants(conn):
+    """Merge the students sharing an email into the oldest one, before the unique index is built"""
+    conn.execute(
+        text(
+            "UPDATE passage SET etudiant_id = d.garde"
+            " FROM (SELECT id, min(id) OVER (PARTITION BY email) AS garde FROM etudiant) AS d"
+            " WHERE passage.etudiant_id = d.id AND d.id <> d.garde"
+        )
+    )
+    conn.execute(
+        text(
+            "DELETE FROM etudiant USING etudiant AS e "
+            "WHERE etudiant.email = e.email AND etudiant.id > e.id"
+        )
+    )
+
+
+def migrate():
+    """Create the tables, and bring those of an older version up to date
+
+    Run by `quizzy migrate` before starting the server, rather than by every worker on import.
+
+    """
+    SQLModel.metadata.create_all(engine)
+
+    # create_all skips existing tables, so columns and indexes added to a model afterwards
+    # have to be created here
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE passage ADD COLUMN IF NOT EXISTS cle VARCHAR"))
+        conn.execute(text("ALTER TABLE passage ADD COLUMN IF NOT EXISTS tirage VARCHAR"))
+        if "tirages" not in {col["name"] for col in inspect(conn).get_columns("statquestion")}:
+            conn.execute(
+                text("ALTER TABLE statquestion ADD COLUMN tirages INTEGER NOT NULL DEFAULT 0")
+            )
+            # Before the banks, every passage of a version had all its questions
+            conn.execute(
+                text(
+                    "UPDATE statquestion SET tirages = s.total"
+                    " FROM (SELECT quiz_hash, sum(nombre) AS total FROM statscore"
+                    " GROUP BY quiz_hash) AS s WHERE statquestion.quiz_hash = s.quiz_hash"
+                )
+            )
+        if "ix_etudiant_email" not in {ix["name"] for ix in inspect(conn).get_indexes("etudiant")}:
+            dedoublonne_etudiants(conn)
+        for table in (Etudiant, Passage):
+            for index in table.__table__.indexes:
+                index.create(conn, checkfirst=True)
+
+
+def passage_record(examen: Examen, quizz: FilledQuiz, client_ip: str) -> Dict[str, Any]:
+    """Flatten a scored submission into the row recorded by `enregistre_passages_async`"""
+    with step_geoip.time():
+        latitude, longitude, accuracy_radius = locate_ip(client_ip) or (None, None, None)
+
+    with step_record.time():
+        return dict(
+            nom=examen.nom,
+            prenom=examen.prenom,
+            email=examen.email,
+            quiz_nom=examen.quizz,
+            quiz_hash=quizz.quiz.hash,
+            date=datetime.now(),
+            reponses=quizz.serialize_answers(),
+            tirage=quizz.serialize_tirage(),
+            score=quizz.get_score(),
+            ip_origine=client_ip,
+            latitude=latitude,
+            longitude=longitude,
+            accuracy_radius=accuracy_radius,
+            cle=quizz.submission_key(),
+            masques=list(quizz.masks),
+            questions=list(quizz.tirage),
+            verdicts=quizz.verdicts(),
+        )
+
+
+def compte_statistiques(records: List[Dict[str, Any]]) -> List[Dict[tuple, Tuple[int, ...]]]:
+    """Count the chosen options, the good answers, the drawn questions and the scores of some
+    submissions, by question of the bank
+
+    Returns:
+        The counters of the rows of `StatOption`, `StatQuestion` and `StatScore`, by key
+
+    """
+    options: Counter = Counter()
+    reussites: Counter = Counter()
+    tirages: Counter = Counter()
+    scores: Counter = Counter()
+    for r in records:
+        # Submissions spilled before the statistics existed
+        if "masques" not in r:
+            continue
+
+        quiz_hash = r["quiz_hash"]
+        # Submissions spilled before the banks, which had all the questions
+        questions = r.get("questions", range(len(r["masques"])))
+        for question, mask, ok in zip(questions, r["masques"], r["verdicts"]):
+            for option in mask_to_indices(mask):
+                options[quiz_hash, question, option] += 1
+            reussites[quiz_hash, question] += ok
+            tirages[quiz_hash, question] += 1
+        scores[quiz_hash, int(r["score"])] += 1
+
+    return [
+        {key: (n,) for key, n in options.items()},
+        {key: (n, tirages[key]) for key, n in reussites.items()},
+        {key: (n,) for key, n in scores.items()},
+    ]
+
+
+def statistiques_upserts(records: List[Dict[str, Any]], condition=None) -> List[Insert]:
+    """Build the statements adding the statistics of *records* to the counters
+
+    The `StatScore` upsert, which has a row per record, comes last.
+
+    """
+    statements = []
+    for table, counts in zip((StatOption, StatQuestion, StatScore), compte_statistiques(records)):
+        if not counts:
+            continue
+
+        keys = [col.name for col in table.__table__.primary_key.columns]
+        compteurs = [col.name for col in table.__table__.columns if col.name not in keys]
+        names = keys + compteurs
+        # Sorted, so that concurrent transactions lock the counters in the same order
+        rows = [key + n for key, n in sorted(counts.items())]
+        source = values(
+            *[column(name, table.__table__.c[name].type) for name in names],
+            name=f"{table.__tablename__}_valeurs",
+        ).data(rows)
+
+        query = source.select()
+        if condition is not None:
+            query = query.where(condition)
+
+        upsert = pg_insert(table).from_select(names, query)
+        statements.append(
+            upsert.on_conflict_do_update(
+                index_elements=keys,
+                set_={c: getattr(table, c) + upsert.excluded[c] for c in compteurs},
+            )
+        )
+
+    return statements
+
+
+def passage_statement(record: Dict[str, Any]) -> Insert:
+    """Build the single statement recording a submission
+
+    The student and the IP address are upserted in data-modifying CTEs, so that concurrent
+    submissions of a new student or from a new address cannot insert them twice. The
+    statistics are only counted if the passage was inserted, the last statement returning
+    one row in that case.
+
+    """
+    etudiant = (
+        pg_insert(Etudiant)
+        .values(nom=record["nom"], prenom=record["prenom"], email=record["email"])
+        # DO NOTHING would not return the id of an existing student
+        .on_conflict_do_update(index_elements=["email"], set_=dict(email=record["email"]))
+        .returning(Etudiant.id)
+        .cte("etudiant_upsert")
+    )
+
+    geoip = (
+        pg_insert(Geoip)
+        .values(
+            ip_origine=record["ip_origine"],
+            latitude=record["latitude"],
+            longitude=record["longitude"],
+            accuracy_radius=record["accuracy_radius"],
+        )
+        .on_conflict_do_nothing(index_elements=["ip_origine"])
+        .cte("geoip_upsert")
+    )
+
+    passage = (
+        pg_insert(Passage)
+        .values(
+            quiz_nom=record["quiz_nom"],
+            quiz_hash=record["quiz_hash"],
+            etudiant_id=etudiant.select().scalar_subquery(),
+            date=record["date"],
+            reponses=record["reponses"],
+            tirage=record["tirage"],
+            score=record["score"],
+            ip_origine=record["ip_origine"],
+            cle=record["cle"],
+        )
+        .on_conflict_do_nothing(index_elements=["cle"])
+        .returning(Passage.id)
+        .cte("passage_insert")
+    )
+    *statistiques, scores = statistiques_upserts([record], select(passage.c.id).exists())
+
+    return scores.add_cte(
+        etudiant,
+        geoip,
+        passage,
+        *[stmt.cte(f"{stmt.table.name}_upsert") for stmt in statistiques],
+    )
+
+
+def enregistre_examen(examen: Examen, quizz: FilledQuiz, client_ip: str) -> bool:
+    """Record a submission. Returns False if it had already been recorded"""
+    record = passage_record(examen, quizz, client_ip)
+    with step_statement.time():
+        statement = passage_statement(record)
+    with step_execute.time(), engine.begin() as conn:
+        result = conn.execute(statement)
+
+    return result.rowcount > 0
+
+
+async def enregistre_examen_async(examen: Examen, quizz: FilledQuiz, client_ip: str) -> bool:
+    """Same as `enregistre_examen`, using the async engine"""
+    record = passage_record(examen, quizz, client_ip)
+    with step_statement.time():
+        statement = passage_statement(record)
+    with step_execute.time():
+        async with async_engine.begin() as conn:
+            result = await conn.execute(statement)
+
+    return result.rowcount > 0
+
+
+async def enregistre_passages_async(records: List[Dict[str, Any]]):
+    """Record a batch of submissions in one transaction, with one multi-row statement per table"""
+    # A reload may have been queued twice in the same batch
+    records = list({r.get("cle") or id(r): r for r in records}.values())
+    if not records:
+        return
+
+    # Sorted, so that concurrent batches lock the rows in the same order
+    etudiants = sorted(
+        {
+            r["email"]: dict(nom=r["nom"], prenom=r["prenom"], email=r["email"]) for r in records
+        }.values(),
+        key=lambda row: row["email"],
+    )
+    geoips = sorted(
+        {
+            r["ip_origine"]: dict(
+                ip_origine=r["ip_origine"],
+                latitude=r["latitude"],
+                longitude=r["longitude"],
+                accuracy_radius=r["accuracy_radius"],
+            )
+            for r in records
+        }.values(),
+        key=lambda row: row["ip_origine"],
+    )
+
+    with step_batch.time():
+        async with async_engine.begin() as conn:
+            upsert = pg_insert(Etudiant).values(etudiants)
+            upsert = upsert.on_conflict_do_update(
+                index_elements=["email"], set_=dict(email=upsert.excluded.email)
+            ).returning(Etudiant.id, Etudiant.email)
+            ids = {email: id for id, email in await conn.execute(upsert)}
+
+            await conn.execute(
+                pg_insert(Geoip)
+                .values(geoips)
+                .on_conflict_do_nothing(index_elements=["ip_origine"])
+            )
+            result = await conn.execute(
+                pg_insert(Passage)
+                .on_conflict_do_nothing(index_elements=["cle"])
+                .returning(Passage.cle),
+                [
+                    dict(
+                        quiz_nom=r["quiz_nom"],
+                        quiz_hash=r["quiz_hash"],
+                        etudiant_id=ids[r["email"]],
+                        date=r["date"],
+                        reponses=r["reponses"],
+                        tirage=r.get("tirage"),
+                        score=r["score"],
+                        ip_origine=r["ip_origine"],
+                        cle=r.get("cle"),
+                    )
+                    for r in records
+                ],
+            )
+
+            # Only the submissions which were not recorded yet are counted
+            inserted = set(result.scalars().all())
+            for upsert in statistiques_upserts([r for r in records if r.get("cle") in inserted]):
+                await conn.execute(upsert)
+
+
+def statistiques_quiz(
+    quiz_hash: str,
+) -> Tuple[Dict[Tuple[int, int], int], Dict[int, int], Dict[int, int], Dict[int, int]]:
+    """Read the counters of a quiz version
+
+    Returns:
+        The number of choices by question and option, of good answers by question,
+        of passages by score, and of passages by question drawn
+
+    """
+    with Session(engine) as session:
+        options = session.exec(select(StatOption).where(StatOption.quiz_hash == quiz_hash)).all()
+        questions = session.exec(
+            select(StatQuestion).where(StatQuestion.quiz_hash == quiz_hash)
+        ).all()
+        scores = session.exec(select(StatScore).where(StatScore.quiz_hash == quiz_hash)).all()
+
+        return (
+            {(s.question, s.option): s.nombre for s in options},
+            {s.question: s.reussites for s in questions},
+            {s.score: s.nombre for s in scores},
+            {s.question: s.tirages for s in questions},
+        )
+
+
+# Stands for the passages recorded before the quizzes had a content hash, in `versions_quiz`
+# and `rescore_quiz`
+LEGACY_VERSION = "legacy"
+
+
+def versions_quiz(quizz: str) -> Dict[str, int]:
+    """Return the number of passages of each version of a quiz, by hash
+
+    The passages recorded before the content hash each got their own hash, made from the
+    answers and the token. They are identified by their lack of submission key, and counted
+    together under `LEGACY_VERSION`, unless they were since moved to a version.
+
+    """
+    versions = (
+        select(Passage.quiz_hash)
+        .where(Passage.quiz_nom == quizz, Passage.cle.is_not(None))
+        .distinct()
+        .scalar_subquery()
+    )
+    version = case(
+        (and_(Passage.cle.is_(None), Passage.quiz_hash.not_in(versions)), LEGACY_VERSION),
+        else_=Passage.quiz_hash,
+    )
+    query = select(version, func.count()).where(Passage.quiz_nom == quizz).group_by(version)
+    with Session(engine) as session:
+        return dict(session.exec(query).all())
+
+
+# Read-through cache of the opaque tokens. A revocation is seen by the other workers
+# once their entry expires
+jeton_cache = TTLCache(config.JETON_CACHE_SIZE, config.JETON_CACHE_TTL)
+
+
+def is_opaque_token(token: str) -> bool:
+    # JWTs are made of three dot separated parts, which token_urlsafe never produces
+    return "." not in token
+
+
+def create_opaque_token(examen: Examen) -> str:
+    token = secrets.token_urlsafe(12)
+    with Session(engine) as session:
+        session.add(
+            Jeton(
+                id=token,
+                quizz=examen.quizz,
+                email=examen.email,
+                nom=examen.nom,
+                prenom=examen.prenom,
+                date=datetime.now(),
+            )
+        )
+        session.commit()
+
+    return token
+
+
+def issue_token(examen: Examen) -> str:
+    """Create an exam token, of the kind selected by `TOKEN_MODE`"""
+    if config.TOKEN_MODE == "opaque":
+        return create_opaque_token(examen)
+
+    return examen.get_encrypted()
+
+
+def resolve_token(token: str) -> Examen:
+    """Return the exam of a token, be it a JWT or an opaque token
+
+    Raises:
+        ValueError: If the opaque token is unknown or revoked
+
+    """
+    if not is_opaque_token(token):
+        return Examen.from_encrypted(token)
+
+    examen = jeton_cache.get(token)
+    if examen is not None:
+        return examen
+
+    with Session(engine) as session:
+        jeton = session.get(Jeton, token)
+        if jeton is None or jeton.revoque:
+            raise ValueError("Unknown or revoked token")
+        examen = jeton.to_examen()
+
+    jeton_cache.set(token, examen)
+
+    return examen
+
+
+async def resolve_token_async(token: str) -> Examen:
+    """Same as `resolve_token`, looking the opaque tokens up with the async engine
+
+    Raises:
+        ValueError: If the opaque token is unknown or revoked
+
+    """
+    if not is_opaque_token(token):
+        return Examen.from_encrypted(token)
+
+    examen = jeton_cache.get(token)
+    if examen is not None:
+        return examen
+
+    statement = select(Jeton.quizz, Jeton.email, Jeton.nom, Jeton.prenom, Jeton.revoque).where(
+        Jeton.id == token
+    )
+    async with async_engine.connect() as conn:
+        jeton = (await conn.execute(statement)).first()
+    if jeton is None or jeton.revoque:
+        raise ValueError("Unknown or revoked token")
+    examen = Examen(quizz=jeton.quizz, email=jeton.email, nom=jeton.nom, prenom=jeton.prenom)
+
+    jeton_cache.set(token, examen)
+
+    return examen
+
+
+def revoke_token(token: str) -> bool:
+    """Revoke an opaque token. Returns False if there is no such token"""
+    jeton_cache.pop(token)
+
+    with Session(engine) as session:
+        jeton = session.get(Jeton, token)
+        if jeton is None:
+            return False
+        jeton.revoque = True
+        session.add(jeton)
+        session.commit()
+
+    return True
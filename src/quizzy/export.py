@@ -0,0 +1,194 @@
+import csv
+from datetime import datetime
+import io
+import json
+from typing import Any, Dict, Iterable, Iterator, List, Literal
+
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from fastapi_sso import OpenID
+from sqlalchemy import DateTime, Float, Integer, Select, select
+from sqlalchemy.types import TypeEngine
+
+from .auth import get_logged_user
+from .database import Etudiant, Geoip, Passage, engine
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pa = None
+    pq = None
+
+
+Format = Literal["csv", "ndjson", "parquet"]
+
+export_router = APIRouter()
+
+# Number of rows fetched from the server-side cursor at once, and written per Parquet row group
+CHUNK_SIZE = 5000
+
+# Size of the text chunks sent to the client
+FLUSH_SIZE = 1 << 16
+
+media_types = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def export_query(
+    quizz: str | None = None,
+    quiz_hash: str | None = None,
+    debut: datetime | None = None,
+    fin: datetime | None = None,
+) -> Select:
+    """Select the passages along with their student and location, in chronological order"""
+    query = (
+        select(
+            Passage.id,
+            Passage.date,
+            Passage.quiz_nom,
+            Passage.quiz_hash,
+            Etudiant.nom,
+            Etudiant.prenom,
+            Etudiant.email,
+            Passage.score,
+            Passage.reponses,
+            Passage.tirage,
+            Passage.ip_origine,
+            Geoip.latitude,
+            Geoip.longitude,
+            Geoip.city,
+            Geoip.country,
+        )
+        .join(Etudiant, Passage.etudiant_id == Etudiant.id)
+        .outerjoin(Geoip, Passage.ip_origine == Geoip.ip_origine)
+        .order_by(Passage.date, Passage.id)
+    )
+    if quizz is not None:
+        query = query.where(Passage.quiz_nom == quizz)
+    if quiz_hash is not None:
+        query = query.where(Passage.quiz_hash == quiz_hash)
+    if debut is not None:
+        query = query.where(Passage.date >= debut)
+    if fin is not None:
+        query = query.where(Passage.date < fin)
+
+    return query
+
+
+def iter_rows(query: Select, chunk_size: int = CHUNK_SIZE) -> Iterator[Dict[str, Any]]:
+    """Stream the rows of *query* through a server-side cursor"""
+    with engine.connect() as conn:
+        result = conn.execute(query.execution_options(yield_per=chunk_size))
+        for row in result.mappings():
+            yield dict(row)
+
+
+def iter_csv(rows: Iterable[Dict[str, Any]], fieldnames: List[str]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= FLUSH_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def iter_ndjson(rows: Iterable[Dict[str, Any]]) -> Iterator[str]:
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(json.dumps(row, default=str, ensure_ascii=False) + "\n")
+        if buffer.tell() >= FLUSH_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def arrow_type(sqltype: TypeEngine) -> "pa.DataType":
+    if isinstance(sqltype, Integer):
+        return pa.int64()
+    if isinstance(sqltype, Float):
+        return pa.float64()
+    if isinstance(sqltype, DateTime):
+        return pa.timestamp("us")
+    return pa.string()
+
+
+def arrow_schema(query: Select) -> "pa.Schema":
+    return pa.schema([(col.key, arrow_type(col.type)) for col in query.selected_columns])
+
+
+def iter_parquet(
+    rows: Iterable[Dict[str, Any]], schema: "pa.Schema", chunk_size: int = CHUNK_SIZE
+) -> Iterator[bytes]:
+    """Write the rows as Parquet, one row group per chunk, yielding the bytes as they are written
+
+    Raises:
+        RuntimeError: If pyarrow is not installed
+
+    """
+    if pa is None:
+        raise RuntimeError("Parquet export requires pyarrow: pip install quizzy[parquet]")
+
+    buffer = io.BytesIO()
+    writer = pq.ParquetWriter(buffer, schema)
+    chunk = []
+
+    def write_chunk() -> bytes:
+        writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+        chunk.clear()
+
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield write_chunk()
+
+    if chunk:
+        yield write_chunk()
+    writer.close()
+    yield buffer.getvalue()
+
+
+def iter_export(query: Select, format: Format) -> Iterator[str | bytes]:
+    """Stream the rows of *query*, encoded in *format*"""
+    rows = iter_rows(query)
+    if format == "csv":
+        return iter_csv(rows, list(query.selected_columns.keys()))
+    if format == "ndjson":
+        return iter_ndjson(rows)
+    return iter_parquet(rows, arrow_schema(query))
+
+
+@export_router.get("/export")
+def export_passages(
+    format: Format = "csv",
+    quizz: str | None = None,
+    quiz_hash: str | None = None,
+    debut: datetime | None = None,
+    fin: datetime | None = None,
+    user: OpenID = Depends(get_logged_user),
+):
+    """Stream the passages, optionally filtered on the quiz and on a date range"""
+    if format == "parquet" and pa is None:
+        raise HTTPException(status_code=501, detail="Parquet export requires pyarrow")
+
+    filename = f"passages.{format}"
+    return StreamingResponse(
+        iter_export(export_query(quizz, quiz_hash, debut, fin), format),
+        media_type=media_types[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
@@ -0,0 +1,232 @@
+from collections import OrderedDict
+import gzip
+import hashlib
+from html import escape
+import json
+from threading import Lock
+from typing import Dict, List, Tuple
+
+from fastapi import APIRouter, HTTPException, Request, Response
+from pydantic import BaseModel
+
+from .Quiz import FilledQuiz, Quiz
+from .config import Examen
+from .database import resolve_token, resolve_token_async
+from .registry import registry
+from .writer import enregistre_soumission
+
+
+lite_router = APIRouter(prefix="/lite")
+
+# The JSON payload of a quiz without a bank is the same for all its students. It is kept, by quiz
+# name, along with the quiz it was made from, and made again when the registry reloads the quiz
+_payloads: "OrderedDict[str, Tuple[Quiz, Tuple[bytes, bytes, str]]]" = OrderedDict()
+_payloads_lock = Lock()
+
+
+class LiteSubmission(BaseModel):
+    token: str
+    answers: List[List[int]]
+
+
+def load_quiz(examen: Examen) -> Quiz:
+    try:
+        return registry.get(examen.quizz)
+    except FileNotFoundError as error:
+        raise HTTPException(status_code=404, detail="Unknown quiz") from error
+
+
+def load_exam(token: str) -> Tuple[Examen, Quiz]:
+    try:
+        examen = resolve_token(token)
+    except Exception as error:
+        raise HTTPException(status_code=401, detail="Invalid exam token") from error
+
+    return examen, load_quiz(examen)
+
+
+async def load_exam_async(token: str) -> Tuple[Examen, Quiz]:
+    """Same as `load_exam`, without blocking the event loop on the lookup of the token"""
+    try:
+        examen = await resolve_token_async(token)
+    except Exception as error:
+        raise HTTPException(status_code=401, detail="Invalid exam token") from error
+
+    return examen, load_quiz(examen)
+
+
+def make_etag(raw: bytes) -> str:
+    return '"%s"' % hashlib.sha256(raw).hexdigest()[:32]
+
+
+def quiz_payload(examen: Examen, quiz: Quiz, token: str) -> Tuple[bytes, bytes, str]:
+    """Return the JSON payload of a quiz, its gzipped version and its ETag
+
+    The payload of a quiz without a bank is cached, as it is the same for all the students.
+
+    """
+    if quiz.tirage is None:
+        with _payloads_lock:
+            entry = _payloads.get(examen.quizz)
+            if entry is not None and entry[0] is quiz:
+                _payloads.move_to_end(examen.quizz)
+                return entry[1]
+
+    dat = dict(
+        quizz=examen.quizz,
+        hash=quiz.hash,
+        message_accueil=quiz.message_accueil,
+        text_bouton=quiz.text_bouton,
+        questions=[dict(text=q.text, answers=q.answers) for q in FilledQuiz(quiz, token).questions],
+    )
+    raw = json.dumps(dat, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    payload = (raw, gzip.compress(raw), make_etag(raw))
+
+    if quiz.tirage is None:
+        with _payloads_lock:
+            _payloads[examen.quizz] = (quiz, payload)
+            _payloads.move_to_end(examen.quizz)
+            while len(_payloads) > registry.maxsize:
+                _payloads.popitem(last=False)
+
+    return payload
+
+
+def render_quiz_html(token: str, examen: Examen, quiz: Quiz) -> bytes:
+    lines = [
+        "<!DOCTYPE html>",
+        '<html><head><meta charset="utf-8"><title>Quizzy</title></head><body>',
+        '<p style="white-space: pre-wrap">'
+        + escape(quiz.message_accueil.format(prenom=examen.prenom))
+        + "</p>",
+        '<form method="post" action="/lite/submit">',
+        f'<input type="hidden" name="token" value="{escape(token)}">',
+    ]
+    for page, question in enumerate(FilledQuiz(quiz, token).questions):
+        lines.append(f"<fieldset><legend>{escape(question.text)}</legend>")
+        for idx, answer_text in enumerate(question.answers):
+            lines.append(
+                f'<label><input type="checkbox" name="q{page}" value="{idx}"> '
+                f"{escape(answer_text)}</label><br>"
+            )
+        lines.append("</fieldset>")
+    lines.append('<button type="submit">Soumettre</button></form></body></html>')
+
+    return "\n".join(lines).encode("utf-8")
+
+
+def render_results_html(user_results: FilledQuiz, score: float) -> bytes:
+    lines = [
+        "<!DOCTYPE html>",
+        '<html><head><meta charset="utf-8"><title>Quizzy</title></head><body>',
+        "<h1>Résultats</h1>",
+        "<table><tr><th>Question</th><th>Verdict</th></tr>",
+    ]
+    for q, verdict in zip(user_results.questions, user_results.verdicts()):
+        symb = "✅" if verdict else "❌"
+        lines.append(f"<tr><td>{escape(q.text)}</td><td>{symb}</td></tr>")
+    lines.append("</table>")
+    lines.append(f"<h3>Bonnes réponses : {score}%</h3>")
+    lines.append(f"<h4>{escape(user_results.quiz.score_comment(score))}</h4>")
+    lines.append("</body></html>")
+
+    return "\n".join(lines).encode("utf-8")
+
+
+def wants_html(request: Request) -> bool:
+    return "text/html" in request.headers.get("accept", "")
+
+
+def cache_headers(etag: str) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept, Accept-Encoding"}
+
+
+def is_fresh(request: Request, etag: str) -> bool:
+    return etag in request.headers.get("if-none-match", "")
+
+
+def encoded_response(request: Request, raw: bytes, gz: bytes, etag: str, media_type: str):
+    headers = cache_headers(etag)
+
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=gz, media_type=media_type, headers=headers)
+
+    return Response(content=raw, media_type=media_type, headers=headers)
+
+
+@lite_router.get("/quiz")
+def get_quiz(request: Request, token: str):
+    """Return the questions of the exam, without the good answers"""
+    examen, quiz = load_exam(token)
+
+    if wants_html(request):
+        # The form embeds the token, so it is specific to the student
+        raw = render_quiz_html(token, examen, quiz)
+        etag = make_etag(raw)
+        if is_fresh(request, etag):
+            return Response(status_code=304, headers=cache_headers(etag))
+
+        return encoded_response(request, raw, gzip.compress(raw), etag, "text/html")
+
+    raw, gz, etag = quiz_payload(examen, quiz, token)
+    if is_fresh(request, etag):
+        return Response(status_code=304, headers=cache_headers(etag))
+
+    return encoded_response(request, raw, gz, etag, "application/json")
+
+
+async def read_submission(request: Request) -> Tuple[LiteSubmission, bool]:
+    """Parse the answers sent either as JSON, or by the HTML form of `get_quiz`"""
+    if request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            return LiteSubmission.model_validate(await request.json()), False
+        except ValueError as error:
+            raise HTTPException(status_code=422, detail="Invalid submission") from error
+
+    form = await request.form()
+    token = form.get("token")
+    if not isinstance(token, str):
+        raise HTTPException(status_code=422, detail="Missing token")
+
+    nb_questions = max(
+        [int(key[1:]) + 1 for key in form.keys() if key.startswith("q") and key[1:].isdigit()],
+        default=0,
+    )
+    try:
+        answers = [[int(idx) for idx in form.getlist(f"q{page}")] for page in range(nb_questions)]
+    except ValueError as error:
+        raise HTTPException(status_code=422, detail="Invalid submission") from error
+
+    return LiteSubmission(token=token, answers=answers), True
+
+
+@lite_router.post("/submit")
+async def submit(request: Request):
+    """Score the final answers of an exam and record them"""
+    submission, from_form = await read_submission(request)
+    examen, quiz = await load_exam_async(submission.token)
+
+    user_results = FilledQuiz(quiz, submission.token)
+    if len(submission.answers) > user_results.number_of_questions:
+        raise HTTPException(status_code=422, detail="Too many answers")
+
+    for page, qans in enumerate(submission.answers):
+        if any(idx < 0 or idx >= user_results.questions[page].number_of_answers for idx in qans):
+            raise HTTPException(status_code=422, detail=f"Invalid answer to question {page}")
+        for idx in set(qans):
+            user_results.toggle(page, idx)
+
+    score = user_results.get_score()
+    client_ip = request.client.host if request.client is not None else ""
+
+    await enregistre_soumission(examen, user_results, client_ip)
+
+    if from_form or wants_html(request):
+        return Response(content=render_results_html(user_results, score), media_type="text/html")
+
+    return dict(
+        score=score,
+        verdicts=user_results.verdicts(),
+        comment=quiz.score_comment(score),
+    )
@@ -0,0 +1,124 @@
+from datetime import datetime, timezone
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import random
+from typing import Dict, TextIO
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the structured fields of the record
+
+    The fields are given as `extra=dict(fields=...)`. A callable field is only called when the
+    record is written, so that it costs nothing to a request if the record is dropped.
+
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = dict(
+            time=datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            level=record.levelname,
+            message=record.getMessage(),
+            name=record.name,
+        )
+        for key, value in getattr(record, "fields", {}).items():
+            entry[key] = value() if callable(value) else value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction *rate* of the records below WARNING"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Hand the records over to the writer thread, dropping them when its queue is full"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The queue stays in the process: the record is formatted by the writer thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # Waits for room in the queue, the pending records are written before stopping
+        self.queue.put(self._sentinel)
+
+
+class LogPipeline:
+    """Write the records of the loggers it is attached to from a background thread
+
+    Args:
+        stream: Where the records are written
+        maxsize: Number of records waiting to be written, beyond which they are dropped
+
+    """
+
+    def __init__(self, stream: TextIO, maxsize: int):
+        self.maxsize = maxsize
+        self.stream_handler = logging.StreamHandler(stream)
+        self.stream_handler.setFormatter(JsonFormatter())
+        self.handler = NonBlockingQueueHandler(queue.Queue(maxsize))
+        self._listener: QueueListener | None = None
+
+    def start(self):
+        self._listener = _Listener(self.handler.queue, self.stream_handler)
+        self._listener.start()
+
+    def stop(self):
+        """Write the pending records, then stop the writer thread"""
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def after_fork(self):
+        """Start a new writer thread in a forked worker, where the parent's one does not exist"""
+        self.handler.queue = queue.Queue(self.maxsize)
+        self.start()
+
+    def attach(self, logger: logging.Logger):
+        """Make the pipeline the only handler of *logger*"""
+        logger.handlers = [self.handler]
+        logger.propagate = False
+
+
+def parse_settings(value: str) -> Dict[str, str]:
+    """Parse a `name=value,name=value` list of settings by logger"""
+    settings = {}
+    for item in value.split(","):
+        if "=" in item:
+            name, setting = item.split("=", 1)
+            settings[name.strip()] = setting.strip()
+    return settings
+
+
+def configure_loggers(levels: str, sampling: str):
+    """Set the level and the sampling rate of some loggers, as `name=value` lists"""
+    for name, level in parse_settings(levels).items():
+        logging.getLogger(name).setLevel(level.upper())
+    for name, rate in parse_settings(sampling).items():
+        logger = logging.getLogger(name)
+        for log_filter in logger.filters[:]:
+            if isinstance(log_filter, SamplingFilter):
+                logger.removeFilter(log_filter)
+        logger.addFilter(SamplingFilter(float(rate)))
@@ -0,0 +1,372 @@
+from bisect import bisect_left
+import json
+import math
+import os
+from pathlib import Path
+from threading import Lock
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+# Upper bounds of the latency buckets, in seconds
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+Labels = Tuple[str, ...]
+
+# Values of the metrics of a process, by metric name then by labels
+Snapshot = Dict[str, Dict[Labels, List[float]]]
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class Timer:
+    """Context manager observing its duration into a histogram"""
+
+    __slots__ = ("_observe", "_start")
+
+    def __init__(self, observe: Callable[[float], None]):
+        self._observe = observe
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._observe(time.perf_counter() - self._start)
+
+
+class Metric:
+    """Base of the metrics: a family of values, one per combination of labels
+
+    Args:
+        name: Name of the metric, as exposed
+        documentation: Help text of the metric
+        labelnames: Names of the labels
+
+    """
+
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = Lock()
+        self._children: Dict[Labels, object] = {}
+
+    def labels(self, *values: str):
+        """Return the child of the given label values, which should be kept by hot paths"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects the labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def snapshot(self) -> Dict[Labels, List[float]]:
+        return {labels: child.values() for labels, child in list(self._children.items())}
+
+    def samples(self, values: Dict[Labels, List[float]]) -> Iterator[str]:
+        for labels, (value,) in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class _CounterChild:
+    __slots__ = ("_lock", "_value")
+
+    def __init__(self):
+        self._lock = Lock()
+        self._value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self._value += amount
+
+    def values(self) -> List[float]:
+        return [self._value]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+
+class _HistogramChild:
+    __slots__ = ("_bounds", "_lock", "_counts", "_sum")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self._bounds = bounds
+        self._lock = Lock()
+        # The last bucket counts the values above the largest bound
+        self._counts = [0] * (len(bounds) + 1)
+        self._sum = 0.0
+
+    def observe(self, value: float):
+        idx = bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[idx] += 1
+            self._sum += value
+
+    def time(self) -> Timer:
+        return Timer(self.observe)
+
+    def values(self) -> List[float]:
+        with self._lock:
+            return [*self._counts, self._sum]
+
+
+class Histogram(Metric):
+    """Distribution of durations, exposed as cumulative buckets"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self) -> Timer:
+        return self.labels().time()
+
+    def samples(self, values: Dict[Labels, List[float]]) -> Iterator[str]:
+        names = (*self.labelnames, "le")
+        for labels, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                bucket_labels = _format_labels(names, (*labels, _format_value(bound)))
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            series_labels = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{series_labels} {_format_value(counts[-1])}"
+            yield f"{self.name}_count{series_labels} {cumulative}"
+
+
+class Gauge(Metric):
+    """Value read when the metrics are collected
+
+    Args:
+        callback: Returns the value of each combination of labels
+
+    """
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        callback: Callable[[], Dict[Labels, float]],
+        labelnames: Sequence[str] = (),
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def snapshot(self) -> Dict[Labels, List[float]]:
+        return {labels: [value] for labels, value in self.callback().items()}
+
+
+class MetricsRegistry:
+    """The metrics of the application, rendered in the Prometheus text format
+
+    With several workers, each one dumps its snapshot in *directory*, and the worker serving
+    `/metrics` adds up its own metrics with those of the others.
+
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self.directory: Path | None = None
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(
+        self,
+        name: str,
+        documentation: str,
+        callback: Callable[[], Dict[Labels, float]],
+        labelnames: Sequence[str] = (),
+    ) -> Gauge:
+        return self.register(Gauge(name, documentation, callback, labelnames))
+
+    def snapshot(self) -> Snapshot:
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    @property
+    def snapshot_pth(self) -> Path:
+        return self.directory / f"metrics-{os.getpid()}.json"
+
+    def dump(self):
+        """Write the snapshot of this process, for the other workers"""
+        if self.directory is None:
+            return
+
+        data = {
+            name: [[list(labels), values] for labels, values in values_by_labels.items()]
+            for name, values_by_labels in self.snapshot().items()
+        }
+        tmp_pth = self.snapshot_pth.with_suffix(".tmp")
+        tmp_pth.write_text(json.dumps(data))
+        os.replace(tmp_pth, self.snapshot_pth)
+
+    def _other_snapshots(self, max_age: float) -> Iterable[Snapshot]:
+        if self.directory is None:
+            return
+
+        now = time.time()
+        for pth in self.directory.glob("metrics-*.json"):
+            if pth == self.snapshot_pth:
+                continue
+            try:
+                if now - pth.stat().st_mtime > max_age:
+                    continue
+                data = json.loads(pth.read_text())
+            except (OSError, ValueError):
+                continue
+            yield {
+                name: {tuple(labels): values for labels, values in rows}
+                for name, rows in data.items()
+            }
+
+    def render(self, max_age: float = 60.0) -> str:
+        """Render the metrics of this process, plus the recent snapshots of the other workers"""
+        total = self.snapshot()
+        for other in self._other_snapshots(max_age):
+            for name, values_by_labels in other.items():
+                metric_values = total.get(name)
+                if metric_values is None:
+                    continue
+                for labels, values in values_by_labels.items():
+                    current = metric_values.get(labels)
+                    if current is None or len(current) != len(values):
+                        metric_values[labels] = list(values)
+                    else:
+                        metric_values[labels] = [a + b for a, b in zip(current, values)]
+
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            lines.extend(metric.samples(total[name]))
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+http_requests = metrics.counter(
+    "quizzy_http_requests_total",
+    "HTTP requests, by route and status",
+    ("method", "route", "status"),
+)
+http_duration = metrics.histogram(
+    "quizzy_http_request_duration_seconds",
+    "Time to answer the HTTP requests, NiceGUI pages included, by route",
+    ("method", "route"),
+)
+
+
+def _nicegui_clients() -> Dict[Labels, float]:
+    from nicegui import Client
+
+    return {(): len(Client.instances)}
+
+
+metrics.gauge("quizzy_nicegui_clients", "NiceGUI clients held by the server", _nicegui_clients)
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing the HTTP requests
+
+    The requests are labelled with the path of the route which answered them, so that the
+    query parameters and the path parameters do not multiply the series.
+
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = getattr(scope.get("route"), "path", None)
+            if route is None:
+                route = "/_nicegui" if scope["path"].startswith("/_nicegui") else "unmatched"
+            method = scope["method"]
+            http_duration.labels(method, route).observe(time.perf_counter() - start)
+            http_requests.labels(method, route, str(status)).inc()
@@ -0,0 +1,86 @@
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List, Tuple
+
+from .Quiz import Quiz
+from .metrics import metrics
+
+
+quiz_load_seconds = metrics.histogram("quizzy_quiz_load_seconds", "Time to parse the quiz files")
+
+
+class QuizRegistry:
+    """LRU cache of the compiled quizzes of a directory, keyed by path and modification time
+
+    Args:
+        root: Directory containing the `*.yml` quiz files
+        maxsize: Maximum number of compiled quizzes kept in memory
+
+    """
+
+    def __init__(self, root: Path, maxsize: int = 64):
+        self.root = root
+        self.maxsize = maxsize
+        self._lock = Lock()
+        self._quizzes: "OrderedDict[Path, Tuple[int, Quiz]]" = OrderedDict()
+        self._names: Tuple[int, List[str]] = (-1, [])
+        self._loading: Dict[Path, Lock] = {}
+
+    def path(self, name: str) -> Path:
+        return self.root / f"{name}.yml"
+
+    def get(self, name: str) -> Quiz:
+        """Return the compiled quiz *name*, reloading it if its file changed on disk"""
+        pth = self.path(name)
+        mtime = pth.stat().st_mtime_ns
+
+        with self._lock:
+            entry = self._quizzes.get(pth)
+            if entry is not None and entry[0] == mtime:
+                self._quizzes.move_to_end(pth)
+                return entry[1]
+            load_lock = self._loading.setdefault(pth, Lock())
+
+        # Parsing happens outside of the registry lock, so that a slow reload does not block
+        # other quizzes. The requests waiting for the same quiz let one of them parse it
+        with load_lock:
+            with self._lock:
+                entry = self._quizzes.get(pth)
+                if entry is not None and entry[0] == mtime:
+                    return entry[1]
+
+            with quiz_load_seconds.time():
+                quiz = Quiz.from_yaml(pth)
+
+            with self._lock:
+                self._quizzes[pth] = (mtime, quiz)
+                self._quizzes.move_to_end(pth)
+                while len(self._quizzes) > self.maxsize:
+                    self._quizzes.popitem(last=False)
+
+        return quiz
+
+    def names(self) -> List[str]:
+        """Return the sorted list of available quizzes. The directory is only scanned again
+        when a quiz file is added, removed or renamed"""
+        mtime = self.root.stat().st_mtime_ns
+
+        with self._lock:
+            if self._names[0] == mtime:
+                return list(self._names[1])
+
+        names = sorted(file.stem for file in self.root.glob("*.yml"))
+
+        with self._lock:
+            self._names = (mtime, names)
+
+        return list(names)
+
+    def clear(self):
+        with self._lock:
+            self._quizzes.clear()
+            self._names = (-1, [])
+
+
+registry = QuizRegistry(Path("quizzes"))
@@ -0,0 +1,284 @@
+from typing import Dict, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import (
+    Float,
+    Integer,
+    String,
+    column,
+    delete,
+    insert,
+    or_,
+    select,
+    text,
+    update,
+    values,
+)
+
+from .Quiz import ANSWERS_V1, Quiz, decode_answers, encode_answers
+from .database import LEGACY_VERSION, Passage, StatOption, StatQuestion, StatScore, engine
+from .registry import registry
+from . import logger
+
+
+def decode_masks(reponses: Sequence[str], nb_questions: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Decode serialized answers into a matrix of answer masks, one row per submission
+
+    Returns:
+        The masks, and the number of questions found in each submission, -1 for those which
+        cannot be decoded
+
+    """
+    masks = np.zeros((len(reponses), nb_questions), dtype=np.int64)
+    counts = np.zeros(len(reponses), dtype=np.int64)
+
+    # Many students give the same answers, each distinct string is only decoded once
+    rows: Dict[str, int] = {}
+    for i, answers in enumerate(reponses):
+        j = rows.get(answers)
+        if j is not None:
+            masks[i] = masks[j]
+            counts[i] = counts[j]
+            continue
+
+        try:
+            qmasks = decode_answers(answers)
+            masks[i, : min(len(qmasks), nb_questions)] = qmasks[:nb_questions]
+        except (ValueError, TypeError, OverflowError):
+            masks[i] = 0
+            counts[i] = -1
+            rows[answers] = i
+            continue
+        counts[i] = len(qmasks)
+        rows[answers] = i
+
+    return masks, counts
+
+
+def decode_tirages(tirages: Sequence[str | None], quiz: Quiz) -> Tuple[np.ndarray, np.ndarray]:
+    """Decode the drawn questions of some submissions into a matrix of indices in the bank
+
+    A submission without a draw answered the first questions of the quiz, in order.
+
+    Returns:
+        The indices, one row per submission, and whether each draw fits the current bank
+
+    """
+    nb_drawn = quiz.number_drawn
+    indices = np.tile(np.arange(nb_drawn, dtype=np.int64), (len(tirages), 1))
+    valid = np.ones(len(tirages), dtype=bool)
+
+    rows: Dict[str, int] = {}
+    for i, tirage in enumerate(tirages):
+        if tirage is None:
+            continue
+
+        j = rows.get(tirage)
+        if j is not None:
+            indices[i] = indices[j]
+            valid[i] = valid[j]
+            continue
+
+        try:
+            drawn = decode_answers(tirage)
+        except ValueError:
+            drawn = []
+        if len(drawn) == nb_drawn and max(drawn) < quiz.number_of_questions:
+            indices[i] = drawn
+        else:
+            valid[i] = False
+        rows[tirage] = i
+
+    return indices, valid
+
+
+def fit_answers(masks: np.ndarray, quiz: Quiz, indices: np.ndarray) -> np.ndarray:
+    """Whether each row of *masks* only selects answers of the questions it was given"""
+    nb_answers = np.array([q.number_of_answers for q in quiz.questions], dtype=np.int64)
+    return ((masks >> np.minimum(nb_answers[indices], 63)) == 0).all(axis=1)
+
+
+def score_masks(masks: np.ndarray, quiz: Quiz, indices: np.ndarray | None = None) -> np.ndarray:
+    """Vectorised `FilledQuiz.get_score`, for a matrix of answer masks
+
+    *indices* are the questions of the bank answered in each column, by default the questions
+    of the quiz in order.
+
+    """
+    good = np.array([q.good_mask for q in quiz.questions], dtype=np.int64)
+    good = good[: masks.shape[1]] if indices is None else good[indices]
+    count_ok = (masks == good).sum(axis=1)
+    return 100 * count_ok // masks.shape[1]
+
+
+def rescore_quiz(
+    quizz: str, versions: Sequence[str] = (), dry_run: bool = False, chunk_size: int = 10000
+) -> Tuple[int, int]:
+    """Score again the passages of a quiz against its current answer key
+
+    Only the passages of the current version are scored, and those of the older *versions*,
+    which the author knows to have the same questions, as when a good answer was corrected.
+    The latter are moved to the current version. `LEGACY_VERSION` among *versions* stands for
+    the passages recorded before the content hash, each of which has its own hash.
+
+    The passages are streamed by chunks of *chunk_size*, and the changed ones are updated
+    with one statement per chunk. Those whose answers cannot be decoded or select answers a
+    question does not have, whose number of questions differs from the current quiz, or whose
+    draw does not fit its bank, are left untouched.
+
+    Returns:
+        The number of passages scored, and the number of those whose score changed
+
+    """
+    quiz = registry.get(quizz)
+    if any(q.number_of_answers > 63 for q in quiz.questions):
+        raise ValueError("Cannot rescore questions with more than 63 answers")
+
+    nb_scored = 0
+    nb_changed = 0
+    condition = Passage.quiz_hash.in_([quiz.hash, *versions])
+    if LEGACY_VERSION in versions:
+        condition = or_(condition, Passage.cle.is_(None))
+    query = select(
+        Passage.id, Passage.reponses, Passage.tirage, Passage.score, Passage.quiz_hash
+    ).where(Passage.quiz_nom == quizz, condition)
+    with engine.begin() as conn:
+        result = conn.execute(query.execution_options(yield_per=chunk_size))
+        for partition in result.partitions():
+            ids, reponses, tirages, scores, hashes = zip(*partition)
+            masks, counts = decode_masks(reponses, quiz.number_drawn)
+            indices, drawn = decode_tirages(tirages, quiz)
+            fit = fit_answers(masks, quiz, indices)
+            new_scores = score_masks(masks, quiz, indices)
+
+            for i in np.flatnonzero((counts < 0) | ~fit).tolist():
+                logger.warning(f"Could not decode the answers of passage {ids[i]}: {reponses[i]!r}")
+
+            valid = (counts == quiz.number_drawn) & drawn & fit
+            changed = valid & (new_scores != np.array(scores))
+            stale = valid & (np.array(hashes, dtype=object) != quiz.hash)
+            nb_scored += int(valid.sum())
+            nb_changed += int(changed.sum())
+
+            rows = [
+                (ids[i], float(new_scores[i])) for i in np.flatnonzero(changed | stale).tolist()
+            ]
+            if dry_run or not rows:
+                continue
+
+            # The new scores are joined as a VALUES list: one round-trip per chunk
+            nouveaux = values(column("id", Integer), column("score", Float), name="nouveaux")
+            nouveaux = nouveaux.data(rows)
+            conn.execute(
+                update(Passage)
+                .where(Passage.id == nouveaux.c.id)
+                .values(score=nouveaux.c.score, quiz_hash=quiz.hash)
+            )
+
+    if not dry_run:
+        rebuild_stats(quizz)
+
+    return nb_scored, nb_changed
+
+
+def rebuild_stats(quizz: str) -> int:
+    """Compute again the statistics of the current version of a quiz from its passages
+
+    This counts the passages recorded before the statistics existed, and those moved to the
+    current version by `rescore_quiz`. The passages whose answers cannot be decoded are left out.
+
+    Returns:
+        The number of passages counted
+
+    """
+    quiz = registry.get(quizz)
+    nb_questions = quiz.number_of_questions
+    nb_drawn = quiz.number_drawn
+    nb_options = max(q.number_of_answers for q in quiz.questions)
+
+    with engine.begin() as conn:
+        # The submissions wait for the rebuild, so that they are counted exactly once
+        conn.execute(text("LOCK TABLE statoption, statquestion, statscore IN EXCLUSIVE MODE"))
+
+        query = select(Passage.reponses, Passage.tirage).where(Passage.quiz_hash == quiz.hash)
+        rows = conn.execute(query).all()
+        masks, counts = decode_masks([row.reponses for row in rows], nb_drawn)
+        indices, drawn = decode_tirages([row.tirage for row in rows], quiz)
+        valid = (counts == nb_drawn) & drawn & fit_answers(masks, quiz, indices)
+        masks, indices = masks[valid], indices[valid]
+
+        # The columns are added up into the questions of the bank they were drawn from
+        good = np.array([q.good_mask for q in quiz.questions], dtype=np.int64)
+        reussites = np.bincount(indices[masks == good[indices]], minlength=nb_questions)
+        tirages = np.bincount(indices.ravel(), minlength=nb_questions)
+        choices = np.zeros((nb_questions, nb_options), dtype=np.int64)
+        bits = (masks[:, :, None] >> np.arange(nb_options)) & 1
+        np.add.at(choices, indices.ravel(), bits.reshape(-1, nb_options))
+        scores, nombres = np.unique(score_masks(masks, quiz, indices), return_counts=True)
+
+        for table in (StatOption, StatQuestion, StatScore):
+            conn.execute(delete(table).where(table.quiz_hash == quiz.hash))
+        if len(masks) == 0:
+            return 0
+
+        conn.execute(
+            insert(StatOption),
+            [
+                dict(quiz_hash=quiz.hash, question=question, option=option, nombre=nombre)
+                for question, row in enumerate(choices.tolist())
+                for option, nombre in enumerate(row)
+                if nombre > 0
+            ],
+        )
+        conn.execute(
+            insert(StatQuestion),
+            [
+                dict(quiz_hash=quiz.hash, question=question, reussites=nombre, tirages=tirage)
+                for question, (nombre, tirage) in enumerate(
+                    zip(reussites.tolist(), tirages.tolist())
+                )
+                if tirage > 0
+            ],
+        )
+        conn.execute(
+            insert(StatScore),
+            [
+                dict(quiz_hash=quiz.hash, score=score, nombre=nombre)
+                for score, nombre in zip(scores.tolist(), nombres.tolist())
+            ],
+        )
+
+    return len(masks)
+
+
+def migrate_answers(chunk_size: int = 10000) -> int:
+    """Convert the answers of the passages stored in the legacy encoding
+
+    Returns:
+        The number of converted passages
+
+    """
+    nb_converted = 0
+    query = select(Passage.id, Passage.reponses).where(Passage.reponses.not_like(f"{ANSWERS_V1}%"))
+    with engine.begin() as conn:
+        result = conn.execute(query.execution_options(yield_per=chunk_size))
+        for partition in result.partitions():
+            rows = []
+            for id, reponses in partition:
+                try:
+                    rows.append((id, encode_answers(decode_answers(reponses))))
+                except ValueError:
+                    logger.warning(f"Could not decode the answers of passage {id}: {reponses!r}")
+            if not rows:
+                continue
+
+            nouveaux = values(column("id", Integer), column("reponses", String), name="nouveaux")
+            nouveaux = nouveaux.data(rows)
+            conn.execute(
+                update(Passage)
+                .where(Passage.id == nouveaux.c.id)
+                .values(reponses=nouveaux.c.reponses)
+            )
+            nb_converted += len(rows)
+
+    return nb_converted
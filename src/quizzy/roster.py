@@ -0,0 +1,144 @@
+from concurrent.futures import ProcessPoolExecutor
+import csv
+from datetime import datetime
+import multiprocessing
+import os
+import secrets
+from typing import Iterable, Iterator, List, TextIO, Tuple
+import unicodedata
+
+from sqlalchemy import insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlmodel import Session
+
+from .config import config, Examen
+from .database import Etudiant, Jeton, engine
+from .registry import registry
+
+
+# Below this size, starting the process pool costs more than minting the tokens
+POOL_THRESHOLD = 256
+
+
+def _normalize_header(name: str) -> str:
+    # "Prénom" -> "prenom"
+    name = unicodedata.normalize("NFKD", name.strip().lower())
+    return "".join(c for c in name if not unicodedata.combining(c))
+
+
+def read_roster(quizz: str, f: TextIO) -> List[Examen]:
+    """Read a CSV roster with nom, prénom and email columns, separated by commas or semicolons
+
+    Raises:
+        ValueError: If the file is not a CSV, or if a column is missing
+
+    """
+    sample = f.read(4096)
+    f.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+    except csv.Error as error:
+        raise ValueError(f"Invalid roster: {error}") from error
+
+    reader = csv.DictReader(f, dialect=dialect)
+    fields = {_normalize_header(name): name for name in reader.fieldnames or []}
+    missing = {"nom", "prenom", "email"} - set(fields)
+    if missing:
+        raise ValueError(f"Missing columns in roster: {', '.join(sorted(missing))}")
+
+    examens = []
+    for row in reader:
+        email = row[fields["email"]].strip()
+        if email == "":
+            continue
+        examens.append(
+            Examen(
+                quizz=quizz,
+                email=email,
+                nom=row[fields["nom"]].strip(),
+                prenom=row[fields["prenom"]].strip(),
+            )
+        )
+
+    return examens
+
+
+def _mint(examen: Examen) -> str:
+    return examen.get_encrypted()
+
+
+def mint_tokens(examens: List[Examen], workers: int | None = None) -> List[str]:
+    """Encrypt the tokens of *examens*, using a process pool for large rosters
+
+    The pool processes are spawned rather than forked, as forking the threads of the running
+    server, such as the log writer, can leave a lock held in the child.
+
+    """
+    if len(examens) < POOL_THRESHOLD:
+        return [_mint(examen) for examen in examens]
+
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, len(examens) // (4 * workers))
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        return list(executor.map(_mint, examens, chunksize=chunksize))
+
+
+def insert_opaque_tokens(session: Session, examens: List[Examen]) -> List[str]:
+    tokens = [secrets.token_urlsafe(12) for _ in examens]
+    now = datetime.now()
+    rows = [
+        dict(id=token, quizz=e.quizz, email=e.email, nom=e.nom, prenom=e.prenom, date=now)
+        for token, e in zip(tokens, examens)
+    ]
+    if rows:
+        session.execute(insert(Jeton), rows)
+
+    return tokens
+
+
+def upsert_etudiants(session: Session, examens: List[Examen]):
+    """Insert the students who are not known yet, in one bulk statement"""
+    rows = list(
+        {e.email: dict(nom=e.nom, prenom=e.prenom, email=e.email) for e in examens}.values()
+    )
+    if rows:
+        session.execute(pg_insert(Etudiant).on_conflict_do_nothing(index_elements=["email"]), rows)
+
+
+def generate_links(examens: List[Examen], workers: int | None = None) -> List[Tuple[Examen, str]]:
+    """Register the students of a roster and create their exam tokens"""
+    for quizz in {e.quizz for e in examens}:
+        registry.get(quizz)
+
+    opaque = config.TOKEN_MODE == "opaque"
+    with Session(engine) as session:
+        upsert_etudiants(session, examens)
+        tokens = insert_opaque_tokens(session, examens) if opaque else []
+        session.commit()
+
+    if not opaque:
+        tokens = mint_tokens(examens, workers)
+
+    return list(zip(examens, tokens))
+
+
+def iter_links_csv(links: Iterable[Tuple[Examen, str]], base_url: str) -> Iterator[str]:
+    """Yield the lines of the CSV of links, one at a time"""
+
+    class _echo:
+        def write(self, line: str) -> str:
+            return line
+
+    writer = csv.writer(_echo())
+    yield writer.writerow(["nom", "prenom", "email", "quizz", "lien"])
+    for examen, token in links:
+        yield writer.writerow(
+            [
+                examen.nom,
+                examen.prenom,
+                examen.email,
+                examen.quizz,
+                f"{base_url}/accueil?token={token}",
+            ]
+        )
@@ -0,0 +1,177 @@
+import os
+from pathlib import Path
+import shutil
+import signal
+import tempfile
+import time
+from typing import Dict, Tuple
+
+from fastapi import FastAPI
+import uvicorn
+
+from .config import config
+from .database import async_engine, engine, open_geoip_reader
+from .metrics import metrics
+from .registry import registry
+from . import log_pipeline, logger
+
+
+# A worker exiting sooner than this after being started failed to boot: the server is stopped
+# rather than starting it again and again
+BOOT_TIMEOUT = 10.0
+
+
+def preload():
+    """Load the shared state in the master process, before the workers are forked
+
+    The workers then share the compiled quizzes and the mapped pages of the GeoIP database,
+    copy-on-write, instead of each loading its own copy. Only the local copy of the GeoIP
+    database is mapped: the workers download a newer one in the background, so that the
+    server does not wait for it to start.
+
+    """
+    open_geoip_reader()
+    for name in registry.names():
+        registry.get(name)
+    logger.info(f"Preloaded {len(registry.names())} quizzes")
+
+    metrics_dir(os.getpid()).mkdir(parents=True, exist_ok=True)
+
+
+def metrics_dir(master_pid: int) -> Path:
+    """Where the workers share their metrics, specific to the master process by default"""
+    if config.METRICS_DIR is not None:
+        return config.METRICS_DIR
+    return Path(tempfile.gettempdir()) / f"quizzy-metrics-{master_pid}"
+
+
+def post_fork(master_pid: int):
+    # The pools were created in the master: the connections must not be shared with the workers
+    engine.dispose(close=False)
+    async_engine.sync_engine.dispose(close=False)
+
+    metrics.directory = metrics_dir(master_pid)
+    log_pipeline.after_fork()
+
+
+def child_exit(master_pid: int, pid: int):
+    # The counters of a dead worker are lost, as after a restart
+    (metrics_dir(master_pid) / f"metrics-{pid}.json").unlink(missing_ok=True)
+
+
+def on_exit(master_pid: int):
+    if config.METRICS_DIR is None:
+        shutil.rmtree(metrics_dir(master_pid), ignore_errors=True)
+
+
+class Supervisor:
+    """Fork the uvicorn workers of an already loaded app, and start them again when they die
+
+    Each worker listens on its own port: see `serve`.
+
+    Args:
+        app: The application, imported in the master process
+        workers: Number of workers
+        host: Address the workers listen on
+        port: Port of the first worker, the others listening on the next ones
+
+    """
+
+    def __init__(self, app: FastAPI, workers: int, host: str, port: int):
+        self.app = app
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.pid = os.getpid()
+        self.stopping = False
+        # Port and start time of the workers, by pid
+        self.children: Dict[int, Tuple[int, float]] = {}
+
+    def spawn(self, port: int):
+        pid = os.fork()
+        if pid != 0:
+            self.children[pid] = (port, time.monotonic())
+            return
+
+        code = 1
+        try:
+            # Out of the process group of the master, so that a Ctrl+C only reaches the master,
+            # which then stops each worker once
+            os.setpgid(0, 0)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            post_fork(self.pid)
+            uvicorn.run(self.app, host=self.host, port=port, log_level="info")
+            code = 0
+        except Exception:
+            logger.exception(f"Worker {os.getpid()} on port {port} crashed")
+        finally:
+            log_pipeline.stop()
+            os._exit(code)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        """Run the workers until the master is asked to stop
+
+        Raises:
+            RuntimeError: If a worker failed to boot
+
+        """
+        preload()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for idx in range(self.workers):
+            self.spawn(self.port + idx)
+        logger.info(f"Started {self.workers} workers on the ports {self.port} to {self.port + idx}")
+
+        failed = None
+        try:
+            while self.children:
+                try:
+                    pid, status = os.wait()
+                except ChildProcessError:
+                    break
+                port, started = self.children.pop(pid, (None, 0.0))
+                child_exit(self.pid, pid)
+                if port is None or self.stopping:
+                    continue
+
+                code = os.waitstatus_to_exitcode(status)
+                if time.monotonic() - started < BOOT_TIMEOUT:
+                    logger.error(f"Worker {pid} on port {port} failed to boot (exit code {code})")
+                    failed = port
+                    self.stop()
+                else:
+                    logger.error(
+                        f"Worker {pid} on port {port} exited (exit code {code}), restarting"
+                    )
+                    self.spawn(port)
+        finally:
+            on_exit(self.pid)
+
+        if failed is not None:
+            raise RuntimeError(f"The worker on port {failed} failed to boot")
+
+
+def serve(app: FastAPI, workers: int, host: str = "0.0.0.0", port: int = 8000):
+    """Run *app* in *workers* processes, one per core if *workers* is 0
+
+    NiceGUI keeps the state of a page in the process which rendered it, and refuses the
+    websocket of the page in any other process. So the workers do not share a socket: the
+    worker *i* listens on *port* + *i*, and the reverse proxy must always send a browser to the
+    same port, for instance with `hash $remote_addr consistent;` in an nginx upstream. Only the
+    stateless routes, `/lite`, `/export`, `/health` and `/metrics`, may be balanced freely.
+
+    The quizzes and the local GeoIP database are loaded before forking, and shared copy-on-write.
+    Each worker has its own database pools of `DB_POOL_SIZE` + `DB_MAX_OVERFLOW` connections.
+
+    """
+    Supervisor(app, workers or os.cpu_count() or 1, host, port).run()
@@ -0,0 +1,192 @@
+import asyncio
+from datetime import datetime
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List
+
+from .Quiz import FilledQuiz
+from .cache import TTLCache
+from .config import config, Examen
+from .database import enregistre_examen_async, enregistre_passages_async, passage_record
+from . import logger
+
+
+class PassageWriter:
+    """Write-behind queue of the submissions, flushed in batches by a background task
+
+    A batch is written every *batch_size* submissions, or *interval* seconds after its first one.
+    The queue holds at most *maxsize* submissions: once full, `put` waits for the next flush.
+    The batches that cannot be written are appended to the *spill* file, which is replayed
+    after the next successful flush, and when the writer starts.
+
+    """
+
+    def __init__(self, batch_size: int, interval: float, maxsize: int, spill: Path):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.maxsize = maxsize
+        self.spill = spill
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if self.running:
+            return
+
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._task = asyncio.create_task(self._run())
+        await self._replay()
+
+    async def stop(self):
+        """Flush the pending submissions, then stop the background task"""
+        if not self.running:
+            return
+
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def put(self, record: Dict[str, Any]):
+        if not self.running:
+            await enregistre_passages_async([record])
+            return
+
+        await self._queue.put(record)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            record = await self._queue.get()
+            if record is None:
+                break
+
+            batch = [record]
+            deadline = loop.time() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    record = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if record is None:
+                    stopping = True
+                    break
+                batch.append(record)
+
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Dict[str, Any]]):
+        try:
+            await enregistre_passages_async(batch)
+        except Exception as error:
+            logger.error(
+                f"Could not record {len(batch)} submissions, spilled to {self.spill}: {error}"
+            )
+            self._write_spill(batch)
+            return
+
+        if self.spill.exists():
+            await self._replay()
+
+    def _write_spill(self, batch: List[Dict[str, Any]]):
+        lines = "".join(json.dumps(r, default=datetime.isoformat) + "\n" for r in batch)
+        created = not self.spill.exists()
+        # A single unbuffered append, so that the lines of concurrent workers do not interleave.
+        # It is synced to the disk, as the submissions are lost if the process then crashes
+        with open(self.spill, "ab", buffering=0) as f:
+            f.write(lines.encode("utf-8"))
+            os.fsync(f.fileno())
+
+        if created:
+            # The new entry of the directory must reach the disk too
+            fd = os.open(self.spill.parent, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    async def _replay(self):
+        # Taken over first, as the other workers may append to the spill file meanwhile
+        replaying = self.spill.with_name(f"{self.spill.name}.{os.getpid()}")
+        try:
+            os.replace(self.spill, replaying)
+        except FileNotFoundError:
+            return
+
+        with open(replaying, "r", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip() != ""]
+        for record in records:
+            record["date"] = datetime.fromisoformat(record["date"])
+
+        for start in range(0, len(records), self.batch_size):
+            try:
+                await enregistre_passages_async(records[start : start + self.batch_size])
+            except Exception as error:
+                logger.error(f"Could not replay the submissions of {self.spill}: {error}")
+                # Only keep the batches that were not written
+                self._write_spill(records[start:])
+                replaying.unlink()
+                return
+
+        replaying.unlink()
+        logger.info(f"Replayed {len(records)} submissions from {self.spill}")
+
+
+passage_writer = PassageWriter(
+    config.WRITE_BEHIND_BATCH,
+    config.WRITE_BEHIND_INTERVAL,
+    config.WRITE_BEHIND_QUEUE_SIZE,
+    config.WRITE_BEHIND_SPILL,
+)
+
+
+# Keys of the recent submissions, so that reloading the results page does not reach the database
+soumissions_recentes = TTLCache(config.SOUMISSION_CACHE_SIZE, config.SOUMISSION_CACHE_TTL)
+
+
+async def enregistre_soumission(examen: Examen, quizz: FilledQuiz, client_ip: str) -> bool:
+    """Record a submission, through the write-behind queue if `WRITE_BEHIND` is set
+
+    Returns False if the same answers were already submitted with this token.
+
+    """
+    key = quizz.submission_key()
+    if soumissions_recentes.get(key) is not None:
+        return False
+    soumissions_recentes.set(key, True)
+
+    try:
+        if config.WRITE_BEHIND:
+            await passage_writer.put(passage_record(examen, quizz, client_ip))
+            recorded = True
+        else:
+            recorded = await enregistre_examen_async(examen, quizz, client_ip)
+    except Exception:
+        soumissions_recentes.pop(key)
+        raise
+
+    if recorded:
+        # The answers and the score are only computed if the record is written
+        logger.info(
+            "Exam taken",
+            extra=dict(
+                fields=dict(
+                    prenom=examen.prenom,
+                    nom=examen.nom,
+                    email=examen.email,
+                    ip=client_ip,
+                    token=quizz.token,
+                    answers=quizz.serialize_answers,
+                    score=quizz.get_score,
+                )
+            ),
+        )
+    return recorded
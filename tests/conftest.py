@@ -0,0 +1,22 @@
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from quizzy.config import config
+from quizzy.database import migrate
+
+
+@pytest.fixture(scope="session")
+def database():
+    """The application no longer creates the tables on import. Skips when PostgreSQL is down"""
+    try:
+        migrate()
+    except OperationalError as error:
+        pytest.skip(f"PostgreSQL is not reachable: {error.orig}")
+
+
+@pytest.fixture(scope="session")
+def geoip():
+    """The application no longer downloads the GeoIP database on import. Skips when offline"""
+    config.refresh_geoip()
+    if not config.geoip_pth.exists():
+        pytest.skip("The GeoIP database could not be downloaded")
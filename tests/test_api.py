@@ -1,7 +1,9 @@
+from base64 import b64encode
+import json
 from pathlib import Path
 import unittest
 
-from quizzy.Quiz import Quiz
+from quizzy.Quiz import FilledQuiz, Quiz, decode_answers, encode_answers
 
 
 class TestQuizzy(unittest.TestCase):
@@ -13,9 +15,112 @@ class TestQuizzy(unittest.TestCase):
         quiz = Quiz.from_yaml(Path("quizzes/micronutrition.yml"))
         print(quiz)
 
+    def test_filled_quiz(self):
+        quiz = Quiz.from_yaml(Path("quizzes/micronutrition.yml"))
+        user_results = FilledQuiz(quiz, "token")
+
+        self.assertTrue(user_results.toggle(1, 2))
+        self.assertTrue(user_results.toggle(1, 1))
+        self.assertTrue(user_results.toggle(0, 3))
+        self.assertFalse(user_results.toggle(0, 3))
+        self.assertTrue(user_results.toggle(0, 2))
+        self.assertEqual(user_results.extract_answers()[:2], [[2], [1, 2]])
+
+        user_results2 = FilledQuiz(quiz)
+        user_results2.set_answers_from_serialzed(user_results.serialize_answers())
+        self.assertEqual(user_results2.masks, user_results.masks)
+        self.assertIs(user_results2.quiz, user_results.quiz)
+
+        nb_ok = sum(user_results.verdicts())
+        self.assertEqual(nb_ok, 2)
+        self.assertEqual(user_results.get_score(), int(100 * nb_ok / quiz.number_of_questions))
+
+    def test_hash(self):
+        quiz = Quiz.from_yaml(Path("quizzes/example.yml"))
+        self.assertEqual(quiz.hash, Quiz.from_yaml(Path("quizzes/example.yml")).hash)
+
+        dat = quiz.model_dump()
+        dat["message_accueil"] = "Bonjour"
+        self.assertEqual(Quiz.model_validate(dat).hash, quiz.hash)
+
+        dat["questions"][1]["good_answers"] = [0]
+        self.assertNotEqual(Quiz.model_validate(dat).hash, quiz.hash)
+
+    def test_tirage(self):
+        quiz = Quiz.from_yaml(Path("quizzes/example.yml"))
+        self.assertEqual(quiz.draw("token"), range(2))
+
+        dat = quiz.model_dump()
+        dat["questions"] = [
+            dict(text=f"Question {i}", answers=["a", "b"], good_answers=[i % 2])
+            for i in range(10000)
+        ]
+        dat["tirage"] = 5
+        bank = Quiz.model_validate(dat)
+        self.assertEqual(bank.number_drawn, 5)
+
+        user_results = FilledQuiz(bank, "token")
+        self.assertEqual(user_results.tirage, bank.draw("token"))
+        self.assertEqual(len(set(user_results.tirage)), 5)
+        self.assertNotEqual(bank.draw("other"), user_results.tirage)
+        self.assertEqual(
+            [q.text for q in user_results.questions][0], f"Question {user_results.tirage[0]}"
+        )
+        self.assertEqual(
+            tuple(decode_answers(user_results.serialize_tirage())), user_results.tirage
+        )
+
+        for page, idx in enumerate(user_results.tirage):
+            user_results.toggle(page, idx % 2)
+        self.assertEqual(user_results.get_score(), 100)
+
+        dat["tirage"] = 6
+        self.assertNotEqual(Quiz.model_validate(dat).hash, bank.hash)
+        self.assertIsNone(FilledQuiz(quiz).serialize_tirage())
+
+    def test_encode_answers(self):
+        masks = [0, 1, 5, 127, 128, 1 << 40, 0]
+        encoded = encode_answers(masks)
+        self.assertTrue(encoded.startswith("1."))
+        self.assertTrue(all(c.isalnum() or c in "-_." for c in encoded))
+        self.assertEqual(decode_answers(encoded), masks)
+        self.assertEqual(decode_answers(encode_answers([])), [])
+
+        legacy = b64encode(json.dumps([[], [0], [0, 2]]).encode("utf-8")).decode("utf-8")
+        self.assertEqual(decode_answers(legacy), [0, 1, 5])
+        self.assertLess(len(encode_answers([5] * 60)), len(legacy) * 20)
+
+        user_results = FilledQuiz(Quiz.from_yaml(Path("quizzes/example.yml")))
+        user_results.set_answers_from_serialzed(legacy)
+        self.assertEqual(user_results.extract_answers(), [[], [0]])
+
+    def test_decode_invalid_answers(self):
+        self.assertEqual(decode_answers(encode_answers([(1 << 63) - 1])), [(1 << 63) - 1])
+        for answers in (
+            encode_answers([1 << 63]),
+            encode_answers([1 << 500, 3]),
+            encode_answers([128])[:-1],
+            "1." + "A" * 20000,
+            b64encode(b'{"a": 1}').decode("utf-8"),
+            b64encode(b"[[0], 3]").decode("utf-8"),
+            b64encode(b"[[0], [63]]").decode("utf-8"),
+        ):
+            with self.assertRaises(ValueError):
+                decode_answers(answers)
+
+        # The answers beyond those of the question are dropped
+        user_results = FilledQuiz(Quiz.from_yaml(Path("quizzes/example.yml")))
+        user_results.set_answers_from_serialzed(encode_answers([1 << 40 | 1, 1 << 4 | 2]))
+        self.assertEqual(user_results.extract_answers(), [[0], [1]])
+
 
 if __name__ == "__main__":
     a = TestQuizzy()
 
     a.test_read_example_quiz()
     a.test_read_micronutrition_quiz()
+    a.test_filled_quiz()
+    a.test_hash()
+    a.test_tirage()
+    a.test_encode_answers()
+    a.test_decode_invalid_answers()
@@ -1,6 +1,6 @@
 import unittest
 
-from quizzy.config import Examen
+from quizzy.config import Examen, examen_cache
 from quizzy.crypto import encrypt_payload, decrypt_payload
 
 
@@ -25,9 +25,23 @@ class TestCrypto(unittest.TestCase):
         self.assertEqual(e.prenom, e2.prenom)
         self.assertEqual(e.nom, e2.nom)
 
+    def test_examen_cache(self):
+        e = Examen(quizz="micronutrition", email="ydethe@gmail.com", nom="de Thé", prenom="Yann")
+        m = e.get_encrypted()
+
+        hits = examen_cache.hits
+        e2 = Examen.from_encrypted(m)
+        self.assertIs(Examen.from_encrypted(m), e2)
+        self.assertEqual(examen_cache.hits, hits + 1)
+
+        tampered = m[:-2] + ("AA" if m[-2:] != "AA" else "BB")
+        with self.assertRaises(Exception):
+            Examen.from_encrypted(tampered)
+
 
 if __name__ == "__main__":
     a = TestCrypto()
 
     a.test_aes()
     a.test_etudiant()
+    a.test_examen_cache()
@@ -1,10 +1,29 @@
+import asyncio
 from pathlib import Path
+import secrets
 import unittest
 
-from quizzy.__main__ import FilledQuiz, enregistre_examen
+import pytest
+from sqlmodel import Session, func, select
+
+from quizzy.Quiz import FilledQuiz
+from quizzy.database import (
+    Etudiant,
+    Passage,
+    async_engine,
+    create_opaque_token,
+    engine,
+    enregistre_examen,
+    enregistre_examen_async,
+    resolve_token,
+    resolve_token_async,
+    revoke_token,
+    statistiques_quiz,
+)
 from quizzy.config import Examen
 
 
+@pytest.mark.usefixtures("database")
 class TestDatabase(unittest.TestCase):
     def test_database(self):
         examen = Examen(
@@ -14,8 +33,92 @@ class TestDatabase(unittest.TestCase):
         quizz = FilledQuiz.from_yaml(qpth)
         enregistre_examen(examen, quizz, "127.0.0.1")
 
+    def test_statistiques(self):
+        quizz = FilledQuiz.from_yaml(Path("quizzes/example.yml"))
+        quizz.token = secrets.token_urlsafe(12)
+        quizz.toggle(0, 1)
+        quizz.toggle(1, 0)
+        quizz.toggle(1, 1)
+        examen = Examen(quizz="example", email="ydethe@gmail.com", nom="de Thé", prenom="Yann")
+
+        options, reussites, scores, tirages = statistiques_quiz(quizz.quiz.hash)
+        self.assertTrue(enregistre_examen(examen, quizz, "127.0.0.1"))
+        self.assertFalse(enregistre_examen(examen, quizz, "127.0.0.1"))
+        options2, reussites2, scores2, tirages2 = statistiques_quiz(quizz.quiz.hash)
+
+        score = quizz.get_score()
+        self.assertEqual(scores2[score], scores.get(score, 0) + 1)
+        self.assertEqual(options2[1, 1], options.get((1, 1), 0) + 1)
+        self.assertEqual(options2.get((0, 0), 0), options.get((0, 0), 0))
+        for page, verdict in enumerate(quizz.verdicts()):
+            self.assertEqual(reussites2.get(page, 0), reussites.get(page, 0) + verdict)
+            self.assertEqual(tirages2[page], tirages.get(page, 0) + 1)
+
+    def test_opaque_token(self):
+        examen = Examen(
+            quizz="micronutrition", email="ydethe@gmail.com", nom="de Thé", prenom="Yann"
+        )
+        token = create_opaque_token(examen)
+        self.assertLess(len(token), 20)
+        self.assertEqual(resolve_token(token), examen)
+        self.assertEqual(resolve_token(examen.get_encrypted()), examen)
+
+        self.assertTrue(revoke_token(token))
+        with self.assertRaises(ValueError):
+            resolve_token(token)
+        self.assertFalse(revoke_token("unknown"))
+
+
+@pytest.mark.usefixtures("database")
+class TestDatabaseAsync(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self):
+        await async_engine.dispose()
+
+    async def test_database_async(self):
+        examen = Examen(
+            quizz="micronutrition", email="ydethe@gmail.com", nom="de Thé", prenom="Yann"
+        )
+        qpth = Path(f"quizzes/{examen.quizz}.yml")
+        quizz = FilledQuiz.from_yaml(qpth)
+        await enregistre_examen_async(examen, quizz, "127.0.0.1")
+
+    async def test_opaque_token_async(self):
+        examen = Examen(
+            quizz="micronutrition", email="ydethe@gmail.com", nom="de Thé", prenom="Yann"
+        )
+        token = create_opaque_token(examen)
+        self.assertEqual(await resolve_token_async(token), examen)
+
+        revoke_token(token)
+        with self.assertRaises(ValueError):
+            await resolve_token_async(token)
+
+    async def test_concurrent_submissions(self):
+        examen = Examen(
+            quizz="micronutrition",
+            email=f"{secrets.token_hex(8)}@quizzy.fr",
+            nom="de Thé",
+            prenom="Yann",
+        )
+        quizz = FilledQuiz.from_yaml(Path(f"quizzes/{examen.quizz}.yml"))
+        quizz.token = examen.get_encrypted()
+        recorded = await asyncio.gather(
+            *[enregistre_examen_async(examen, quizz, "81.2.69.142") for _ in range(5)]
+        )
+        self.assertEqual(sum(recorded), 1)
+
+        quizz.toggle(0, 0)
+        self.assertTrue(await enregistre_examen_async(examen, quizz, "81.2.69.142"))
+
+        with Session(engine) as session:
+            etudiants = session.exec(select(Etudiant).where(Etudiant.email == examen.email)).all()
+            self.assertEqual(len(etudiants), 1)
+            query = select(func.count()).where(Passage.etudiant_id == etudiants[0].id)
+            self.assertEqual(session.exec(query).one(), 2)
+
 
 if __name__ == "__main__":
     a = TestDatabase()
 
     a.test_database()
+    a.test_opaque_token()
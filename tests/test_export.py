@@ -0,0 +1,56 @@
+import csv
+import io
+import json
+import unittest
+
+import pytest
+from fastapi.testclient import TestClient
+from fastapi_sso import OpenID
+import pyarrow.parquet as pq
+
+from quizzy.__main__ import fastapi_app
+from quizzy.auth import get_logged_user
+from quizzy.export import export_query, iter_export
+
+
+@pytest.mark.usefixtures("database")
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        fastapi_app.dependency_overrides[get_logged_user] = lambda: OpenID(email="admin@quizzy.fr")
+        self.client = TestClient(fastapi_app)
+
+    def tearDown(self):
+        fastapi_app.dependency_overrides.clear()
+
+    def test_csv(self):
+        res = self.client.get("/export", params={"quizz": "example"})
+        self.assertEqual(res.status_code, 200)
+
+        rows = list(csv.DictReader(io.StringIO(res.text)))
+        self.assertTrue(all(row["quiz_nom"] == "example" for row in rows))
+        self.assertIn("email", rows[0])
+
+        res = self.client.get("/export", params={"quizz": "example", "fin": "2000-01-01"})
+        self.assertEqual(res.text.strip(), ",".join(export_query().selected_columns.keys()))
+
+    def test_ndjson(self):
+        res = self.client.get("/export", params={"format": "ndjson", "debut": "2000-01-01"})
+        self.assertEqual(res.status_code, 200)
+        rows = [json.loads(line) for line in res.text.splitlines()]
+        self.assertGreater(len(rows), 0)
+
+    def test_parquet(self):
+        query = export_query("example")
+        data = b"".join(iter_export(query, "parquet"))
+        table = pq.read_table(io.BytesIO(data))
+        self.assertEqual(table.schema.names, list(query.selected_columns.keys()))
+        self.assertGreater(table.num_rows, 0)
+
+    def test_login_required(self):
+        fastapi_app.dependency_overrides.clear()
+        res = self.client.get("/export", follow_redirects=False)
+        self.assertIn(res.status_code, (401, 403))
+
+
+if __name__ == "__main__":
+    unittest.main()
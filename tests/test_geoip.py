@@ -1,6 +1,26 @@
-from quizzy.database import get_geoip_info
+import gzip
+import os
+from pathlib import Path
+import tempfile
+import time
+from unittest.mock import MagicMock, patch
 
+import pytest
+import requests
 
+from quizzy.config import config, download_geoip_db
+from quizzy import database
+from quizzy.database import (
+    Geoip,
+    geoip_seconds,
+    get_geoip_info,
+    locate_ip,
+    open_geoip_reader,
+    reload_geoip_reader,
+)
+
+
+@pytest.mark.usefixtures("geoip")
 def test_geoip():
     city = get_geoip_info("8.8.8.8")
     print(city.city)
@@ -10,5 +30,102 @@ def test_geoip():
     print(city.postal)
 
 
+@pytest.mark.usefixtures("geoip")
+def test_geoip_cache():
+    open_geoip_reader()
+    gip = Geoip.from_ip_addr("8.8.8.8")
+    gip2 = Geoip.from_ip_addr("8.8.8.8")
+
+    assert gip2.latitude == gip.latitude
+    assert locate_ip.cache_info().hits == 1
+
+    # Reopening the database empties the cache
+    open_geoip_reader()
+    assert locate_ip.cache_info().currsize == 0
+
+
+def geoip_lookups() -> int:
+    """Number of lookups timed by quizzy_geoip_seconds, the sum of its buckets"""
+    return sum(geoip_seconds.snapshot().get((), [0])[:-1])
+
+
+def test_geoip_seconds():
+    reader = MagicMock()
+    reader.city.return_value.location = None
+    count = geoip_lookups()
+    with patch.object(database, "_geoip_reader", reader):
+        locate_ip.cache_clear()
+        try:
+            # As recorded by each submission, only the lookups missing from the cache are timed
+            for _ in range(2):
+                assert locate_ip("192.0.2.1") is None
+        finally:
+            locate_ip.cache_clear()
+
+    assert reader.city.call_count == 1
+    assert geoip_lookups() == count + 1
+
+
+@pytest.mark.usefixtures("geoip")
+def test_reload_geoip_reader():
+    open_geoip_reader()
+    reader = database._geoip_reader
+    reload_geoip_reader()
+    assert database._geoip_reader is reader
+
+    # Replaced by another worker
+    tmp_pth = config.geoip_pth.with_name("replaced.tmp")
+    tmp_pth.write_bytes(config.geoip_pth.read_bytes())
+    os.replace(tmp_pth, config.geoip_pth)
+    reload_geoip_reader()
+    assert database._geoip_reader is not reader
+
+
+@pytest.mark.usefixtures("geoip")
+def test_refresh_geoip():
+    with patch("quizzy.config.download_geoip_db") as download:
+        config.refresh_geoip()
+        download.assert_not_called()
+
+        # A stale copy is downloaded again, and a failure keeps it
+        mtime = time.time() - config.GEOIP_MAX_AGE - 1
+        os.utime(config.geoip_pth, (mtime, mtime))
+        download.side_effect = OSError("offline")
+        config.refresh_geoip()
+        download.assert_called_once()
+        assert config.geoip_pth.exists()
+
+
+def test_download_geoip_db():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dest = Path(tmpdir) / "GeoLite2-City.mmdb"
+        try:
+            assert download_geoip_db(config.GEOIP2_DB_URL, dest)
+        except requests.ConnectionError as error:
+            pytest.skip(f"The GeoIP server is not reachable: {error}")
+        data = dest.read_bytes()
+
+        # The second request is conditional
+        with patch("quizzy.config.requests.get", wraps=requests.get) as get:
+            download_geoip_db(config.GEOIP2_DB_URL, dest)
+        headers = get.call_args.kwargs["headers"]
+        assert "If-None-Match" in headers or "If-Modified-Since" in headers
+        assert dest.read_bytes() == data
+
+        # A corrupted archive leaves the current copy in place
+        response = MagicMock(status_code=200, headers={})
+        response.__enter__.return_value = response
+        response.iter_content.return_value = [gzip.compress(b"garbage")]
+        with patch("quizzy.config.requests.get", return_value=response):
+            with pytest.raises(ValueError):
+                download_geoip_db(config.GEOIP2_DB_URL, dest)
+        assert dest.read_bytes() == data
+        assert list(Path(tmpdir).glob("*.tmp")) == []
+
+
 if __name__ == "__main__":
     test_geoip()
+    test_geoip_cache()
+    test_reload_geoip_reader()
+    test_refresh_geoip()
+    test_download_geoip_db()
@@ -0,0 +1,111 @@
+import os
+from pathlib import Path
+import shutil
+import unittest
+
+import pytest
+from fastapi.testclient import TestClient
+
+from quizzy.__main__ import fastapi_app
+from quizzy.config import Examen
+
+
+@pytest.mark.usefixtures("database")
+class TestLite(unittest.TestCase):
+    def setUp(self):
+        self.client = TestClient(fastapi_app, client=("127.0.0.1", 50000)).__enter__()
+        e = Examen(quizz="example", email="ydethe@gmail.com", nom="de Thé", prenom="Yann")
+        self.token = e.get_encrypted()
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+
+    def test_quiz_json(self):
+        res = self.client.get("/lite/quiz", params={"token": self.token})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers["content-encoding"], "gzip")
+        dat = res.json()
+        self.assertEqual(len(dat["questions"]), 2)
+        self.assertNotIn("good_answers", dat["questions"][0])
+
+        res = self.client.get(
+            "/lite/quiz",
+            params={"token": self.token},
+            headers={"If-None-Match": res.headers["etag"]},
+        )
+        self.assertEqual(res.status_code, 304)
+
+    def test_quiz_reload(self):
+        pth = Path("quizzes/copie.yml")
+        shutil.copy("quizzes/example.yml", pth)
+        try:
+            e = Examen(quizz="copie", email="ydethe@gmail.com", nom="de Thé", prenom="Yann")
+            token = e.get_encrypted()
+            res = self.client.get("/lite/quiz", params={"token": token})
+            self.assertEqual(res.json()["quizz"], "copie")
+
+            pth.write_text(pth.read_text().replace("Bienvenue", "Bonjour"))
+            st = pth.stat()
+            os.utime(pth, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+
+            res2 = self.client.get(
+                "/lite/quiz",
+                params={"token": token},
+                headers={"If-None-Match": res.headers["etag"]},
+            )
+            self.assertEqual(res2.status_code, 200)
+            self.assertIn("Bonjour", res2.json()["message_accueil"])
+            self.assertEqual(res2.json()["hash"], res.json()["hash"])
+        finally:
+            pth.unlink()
+
+    def test_bank(self):
+        e = Examen(quizz="banque", email="ydethe@gmail.com", nom="de Thé", prenom="Yann")
+        token = e.get_encrypted()
+        res = self.client.get("/lite/quiz", params={"token": token})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.json()["questions"]), 3)
+        self.assertEqual(res.json(), self.client.get("/lite/quiz", params={"token": token}).json())
+
+        res = self.client.post("/lite/submit", json={"token": token, "answers": [[0]] * 4})
+        self.assertEqual(res.status_code, 422)
+        res = self.client.post("/lite/submit", json={"token": token, "answers": [[0]] * 3})
+        self.assertEqual(len(res.json()["verdicts"]), 3)
+
+    def test_quiz_html(self):
+        res = self.client.get(
+            "/lite/quiz", params={"token": self.token}, headers={"Accept": "text/html"}
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('name="q1" value="1"', res.text)
+
+    def test_invalid_token(self):
+        res = self.client.get("/lite/quiz", params={"token": "foo"})
+        self.assertEqual(res.status_code, 401)
+
+    def test_submit_json(self):
+        res = self.client.post("/lite/submit", json={"token": self.token, "answers": [[0], [0]]})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()["score"], 50)
+        self.assertEqual(res.json()["verdicts"], [True, False])
+
+        res = self.client.post("/lite/submit", json={"token": self.token, "answers": [[7]]})
+        self.assertEqual(res.status_code, 422)
+
+    def test_submit_twice(self):
+        with self.assertLogs("uvicorn.error", level="INFO") as logs:
+            for _ in range(3):
+                res = self.client.post(
+                    "/lite/submit", json={"token": self.token, "answers": [[1], [0, 1]]}
+                )
+                self.assertEqual(res.status_code, 200)
+        self.assertEqual(len([line for line in logs.output if "Exam taken" in line]), 1)
+
+    def test_submit_form(self):
+        res = self.client.post("/lite/submit", data={"token": self.token, "q0": "0", "q1": "1"})
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("Bonnes réponses : 100%", res.text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import io
+import json
+import logging
+import queue
+import unittest
+
+from quizzy.logs import JsonFormatter, LogPipeline, NonBlockingQueueHandler, SamplingFilter
+from quizzy.logs import configure_loggers, parse_settings
+
+
+class TestLogs(unittest.TestCase):
+    def test_json(self):
+        calls = []
+
+        def score():
+            calls.append(1)
+            return 0.5
+
+        record = logging.LogRecord("quizzy", logging.INFO, __file__, 1, "Exam %s", ("taken",), None)
+        record.fields = dict(nom='O"Brien\n', score=score)
+        self.assertEqual(calls, [])
+
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual(entry["message"], "Exam taken")
+        self.assertEqual(entry["level"], "INFO")
+        self.assertEqual(entry["nom"], 'O"Brien\n')
+        self.assertEqual(entry["score"], 0.5)
+        self.assertEqual(calls, [1])
+
+    def test_sampling(self):
+        sampling = SamplingFilter(0)
+        info = logging.LogRecord("quizzy", logging.INFO, __file__, 1, "info", (), None)
+        warning = logging.LogRecord("quizzy", logging.WARNING, __file__, 1, "warning", (), None)
+        self.assertFalse(sampling.filter(info))
+        self.assertTrue(sampling.filter(warning))
+        self.assertTrue(SamplingFilter(1).filter(info))
+
+    def test_full_queue(self):
+        handler = NonBlockingQueueHandler(queue.Queue(1))
+        logger = logging.getLogger("quizzy.test_full_queue")
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            for _ in range(3):
+                logger.warning("Slow collector")
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(handler.queue.qsize(), 1)
+        self.assertEqual(handler.dropped, 2)
+
+    def test_pipeline(self):
+        stream = io.StringIO()
+        pipeline = LogPipeline(stream, 100)
+        logger = logging.getLogger("quizzy.test_pipeline")
+        pipeline.attach(logger)
+        pipeline.start()
+        logger.warning("Written by the %s", "writer thread", extra=dict(fields=dict(ip="::1")))
+        pipeline.stop()
+
+        entry = json.loads(stream.getvalue())
+        self.assertEqual(entry["message"], "Written by the writer thread")
+        self.assertEqual(entry["ip"], "::1")
+
+    def test_settings(self):
+        self.assertEqual(parse_settings(""), {})
+        self.assertEqual(
+            parse_settings("uvicorn.access=warning, quizzy = 0.5"),
+            {"uvicorn.access": "warning", "quizzy": "0.5"},
+        )
+
+        logger = logging.getLogger("quizzy.test_settings")
+        configure_loggers("quizzy.test_settings=error", "quizzy.test_settings=0.1")
+        configure_loggers("", "quizzy.test_settings=0.2")
+        self.assertEqual(logger.level, logging.ERROR)
+        self.assertEqual([f.rate for f in logger.filters], [0.2])
@@ -0,0 +1,75 @@
+from pathlib import Path
+import tempfile
+import unittest
+
+from fastapi.testclient import TestClient
+
+from quizzy.__main__ import fastapi_app
+from quizzy.config import Examen
+from quizzy.metrics import MetricsRegistry
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        registry = MetricsRegistry()
+        requests = registry.counter("requests_total", "Requests", ("route",))
+        duration = registry.histogram("duration_seconds", "Duration", buckets=(0.1, 1.0))
+        registry.gauge("clients", "Clients", lambda: {(): 3})
+
+        requests.labels('/a"b').inc()
+        requests.labels('/a"b').inc(2)
+        duration.observe(0.05)
+        duration.observe(0.5)
+        duration.observe(5)
+
+        text = registry.render()
+        self.assertIn("# TYPE requests_total counter", text)
+        self.assertIn('requests_total{route="/a\\"b"} 3.0', text)
+        self.assertIn('duration_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('duration_seconds_bucket{le="1.0"} 2', text)
+        self.assertIn('duration_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn("duration_seconds_sum 5.55", text)
+        self.assertIn("duration_seconds_count 3", text)
+        self.assertIn("clients 3.0", text)
+
+        with self.assertRaises(ValueError):
+            requests.labels()
+
+    def test_workers(self):
+        registry = MetricsRegistry()
+        requests = registry.counter("requests_total", "Requests")
+        requests.inc(2)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            registry.directory = Path(tmpdir)
+
+            # Another worker, with the same metrics
+            other = MetricsRegistry()
+            other.directory = Path(tmpdir)
+            other.counter("requests_total", "Requests").inc(5)
+            other.dump()
+            other.snapshot_pth.rename(Path(tmpdir) / "metrics-0.json")
+
+            self.assertIn("requests_total 7.0", registry.render())
+
+    def test_endpoint(self):
+        with TestClient(fastapi_app) as client:
+            token = Examen(
+                quizz="example", email="ydethe@gmail.com", nom="de Thé", prenom="Yann"
+            ).get_encrypted()
+            self.assertEqual(client.get("/lite/quiz", params={"token": token}).status_code, 200)
+
+            res = client.get("/metrics")
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(res.headers["content-type"].startswith("text/plain"))
+            self.assertIn(
+                'quizzy_http_requests_total{method="GET",route="/lite/quiz",status="200"}',
+                res.text,
+            )
+            self.assertIn('quizzy_token_decode_seconds_count{cache="miss"}', res.text)
+            self.assertIn('quizzy_db_connections{engine="sync",state="idle"}', res.text)
+            self.assertIn("quizzy_nicegui_clients", res.text)
+
+
+if __name__ == "__main__":
+    unittest.main()
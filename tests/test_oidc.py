@@ -1,15 +1,142 @@
+import asyncio
+import json
+from pathlib import Path
+import tempfile
+import time
 import unittest
 
-from quizzy.auth import load_discovery_document
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+import httpx
+from jose import jwk, jwt
+
+from quizzy.auth import OIDCClient, get_logged_user, load_discovery_document, session_cache
+from quizzy.auth import RequiresLoginException
+from quizzy.config import config
+
+ISSUER = "https://idp.quizzy.test"
+
+
+class IdentityProvider:
+    """Answers the requests of the OIDC client, and counts them by path"""
+
+    def __init__(self):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.pem = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ).decode()
+        public = jwk.construct(self.pem, "RS256").public_key().to_dict()
+        self.jwks = {"keys": [dict(public, kid="k1", use="sig")]}
+        self.kid = "k1"
+        self.requests = []
+
+    def id_token(self, **claims) -> str:
+        claims = dict(
+            dict(iss=ISSUER, aud=config.CLIENT_ID, sub="admin", exp=int(time.time()) + 60),
+            **claims,
+        )
+        return jwt.encode(claims, self.pem, algorithm="RS256", headers=dict(kid=self.kid))
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request.url.path)
+        if request.url.path == "/.well-known/openid-configuration":
+            return httpx.Response(
+                200,
+                json=dict(
+                    issuer=ISSUER,
+                    authorization_endpoint=f"{ISSUER}/authorize",
+                    token_endpoint=f"{ISSUER}/token",
+                    userinfo_endpoint=f"{ISSUER}/userinfo",
+                    jwks_uri=f"{ISSUER}/jwks",
+                ),
+            )
+        if request.url.path == "/jwks":
+            return httpx.Response(200, json=self.jwks)
+        if request.url.path == "/token":
+            return httpx.Response(200, json=dict(access_token="at", id_token=self.id_token()))
+        return httpx.Response(404)
 
 
 class TestOIDC(unittest.TestCase):
     def test_config(self):
-        doc = load_discovery_document(
-            "https://authentik.johncloud.fr/application/o/quizzy/.well-known/openid-configuration"
-        )
+        url = "https://authentik.johncloud.fr/application/o/quizzy/.well-known/openid-configuration"
+        try:
+            doc = asyncio.run(load_discovery_document(url))
+        except httpx.TransportError as error:
+            self.skipTest(f"The identity provider is not reachable: {error}")
         print(doc)
 
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.idp = IdentityProvider()
+        self.oidc = OIDCClient(
+            f"{ISSUER}/.well-known/openid-configuration",
+            Path(self.tmpdir.name) / "oidc-discovery.json",
+            transport=httpx.MockTransport(self.idp.handler),
+        )
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_authenticate(self):
+        async def logins():
+            users = [await self.oidc.authenticate("code") for _ in range(3)]
+            client = self.oidc.client
+            await self.oidc.aclose()
+            return users, client
+
+        users, client = asyncio.run(logins())
+        self.assertEqual([user.display_name for user in users], ["admin"] * 3)
+        self.assertTrue(client.is_closed)
+        # The user is read from the ID token: the userinfo endpoint is never called
+        self.assertEqual(
+            self.idp.requests,
+            ["/.well-known/openid-configuration", "/jwks", "/token", "/token", "/token"],
+        )
+        self.assertIn("jwks_uri", json.loads(self.oidc.discovery_pth.read_text()))
+
+        url = asyncio.run(self.oidc.login_url())
+        self.assertTrue(url.startswith(f"{ISSUER}/authorize?response_type=code"))
+
+    def test_verify_id_token(self):
+        async def verify(token: str):
+            return await self.oidc.verify_id_token(token, None)
+
+        asyncio.run(self.oidc.refresh())
+        with self.assertRaises(jwt.JWTError):
+            asyncio.run(verify(self.idp.id_token(aud="other")))
+
+        # After a rotation, the keys are downloaded again, but not at each login
+        self.idp.kid = "k2"
+        self.idp.jwks["keys"][0]["kid"] = "k2"
+        self.oidc._jwks_time = 0.0
+        self.assertEqual(asyncio.run(verify(self.idp.id_token()))["sub"], "admin")
+        self.idp.kid = "k3"
+        with self.assertRaises(jwt.JWTError):
+            asyncio.run(verify(self.idp.id_token()))
+        self.assertEqual(self.idp.requests.count("/jwks"), 2)
+
+    def test_session_cache(self):
+        session_cache.clear()
+        cookie = jwt.encode(
+            dict(pld=dict(display_name="admin"), exp=int(time.time()) + 60),
+            key=config.JWT_SECRET,
+            algorithm="HS256",
+        )
+        for _ in range(3):
+            self.assertEqual(asyncio.run(get_logged_user(cookie)).display_name, "admin")
+        self.assertEqual((session_cache.hits, session_cache.misses), (2, 1))
+
+        expired = jwt.encode(
+            dict(pld=dict(display_name="admin"), exp=int(time.time()) - 1),
+            key=config.JWT_SECRET,
+            algorithm="HS256",
+        )
+        with self.assertRaises(RequiresLoginException):
+            asyncio.run(get_logged_user(expired))
+
 
 if __name__ == "__main__":
     a = TestOIDC()
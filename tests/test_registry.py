@@ -0,0 +1,57 @@
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import unittest
+
+from quizzy.registry import QuizRegistry
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        shutil.copy("quizzes/example.yml", self.root / "example.yml")
+        self.registry = QuizRegistry(self.root, maxsize=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_cached(self):
+        quiz = self.registry.get("example")
+        self.assertIs(self.registry.get("example"), quiz)
+
+    def test_reload_on_change(self):
+        pth = self.root / "example.yml"
+        quiz = self.registry.get("example")
+
+        pth.write_text(pth.read_text().replace("Paris", "Lutèce"))
+        st = pth.stat()
+        os.utime(pth, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+
+        quiz2 = self.registry.get("example")
+        self.assertIsNot(quiz2, quiz)
+        self.assertEqual(quiz2.questions[0].answers[0], "Lutèce")
+
+    def test_names(self):
+        self.assertEqual(self.registry.names(), ["example"])
+
+        shutil.copy("quizzes/micronutrition.yml", self.root / "micronutrition.yml")
+        st = self.root.stat()
+        os.utime(self.root, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+
+        self.assertEqual(self.registry.names(), ["example", "micronutrition"])
+
+    def test_lru(self):
+        for name in ("a", "b", "c"):
+            shutil.copy("quizzes/example.yml", self.root / f"{name}.yml")
+            self.registry.get(name)
+
+        self.assertEqual(len(self.registry._quizzes), 2)
+
+    def test_missing(self):
+        with self.assertRaises(FileNotFoundError):
+            self.registry.get("nope")
+
+
+if __name__ == "__main__":
+    unittest.main()
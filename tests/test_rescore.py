@@ -0,0 +1,254 @@
+from base64 import b64encode
+import json
+from pathlib import Path
+import secrets
+import unittest
+
+import pytest
+from sqlmodel import Session, select
+
+from quizzy.Quiz import FilledQuiz, encode_answers
+from quizzy.config import Examen
+from quizzy.database import (
+    LEGACY_VERSION,
+    Passage,
+    engine,
+    enregistre_examen,
+    statistiques_quiz,
+    versions_quiz,
+)
+from quizzy.rescore import (
+    decode_masks,
+    migrate_answers,
+    rebuild_stats,
+    rescore_quiz,
+    score_masks,
+)
+
+
+@pytest.mark.usefixtures("database")
+class TestRescore(unittest.TestCase):
+    def test_score_masks(self):
+        quiz = FilledQuiz.from_yaml(Path("quizzes/micronutrition.yml")).quiz
+
+        reponses = []
+        scores = []
+        for page in range(quiz.number_of_questions):
+            user_results = FilledQuiz(quiz)
+            for p in range(page + 1):
+                for idx in quiz.questions[p].good_answers:
+                    user_results.toggle(p, idx)
+            reponses.append(user_results.serialize_answers())
+            scores.append(user_results.get_score())
+
+        masks, counts = decode_masks(reponses, quiz.number_of_questions)
+        self.assertTrue((counts == quiz.number_of_questions).all())
+        self.assertEqual(score_masks(masks, quiz).tolist(), scores)
+
+    def test_rescore_quiz(self):
+        user_results = FilledQuiz.from_yaml(Path("quizzes/example.yml"))
+        user_results.token = secrets.token_urlsafe(12)
+        examen = Examen(quizz="example", email="ydethe@gmail.com", nom="de Thé", prenom="Yann")
+        enregistre_examen(examen, user_results, "127.0.0.1")
+
+        with Session(engine) as session:
+            passage = session.exec(
+                select(Passage).where(Passage.cle == user_results.submission_key())
+            ).one()
+            passage.score = 42
+            session.add(passage)
+            session.commit()
+
+            nb_scored, nb_changed = rescore_quiz("example")
+            self.assertGreaterEqual(nb_scored, 1)
+            self.assertGreaterEqual(nb_changed, 1)
+
+            session.refresh(passage)
+            self.assertEqual(passage.score, user_results.get_score())
+            self.assertEqual(rescore_quiz("example")[1], 0)
+
+    def test_versions(self):
+        examen = Examen(quizz="example", email="ydethe@gmail.com", nom="de Thé", prenom="Yann")
+        ancienne = FilledQuiz.from_yaml(Path("quizzes/example.yml"))
+        ancienne.token = secrets.token_urlsafe(12)
+        enregistre_examen(examen, ancienne, "127.0.0.1")
+        illisible = FilledQuiz.from_yaml(Path("quizzes/example.yml"))
+        illisible.token = secrets.token_urlsafe(12)
+        enregistre_examen(examen, illisible, "127.0.0.1")
+
+        version = secrets.token_hex(8)
+        with Session(engine) as session:
+            passages = [
+                session.exec(select(Passage).where(Passage.cle == q.submission_key())).one()
+                for q in (ancienne, illisible)
+            ]
+            passages[0].quiz_hash = version
+            passages[0].score = 42
+            passages[1].reponses = "%%%"
+            session.add_all(passages)
+            session.commit()
+
+            try:
+                with self.assertLogs("uvicorn.error", level="WARNING") as logs:
+                    rescore_quiz("example")
+                self.assertIn(f"passage {passages[1].id}", logs.output[0])
+                session.refresh(passages[0])
+                self.assertEqual((passages[0].quiz_hash, passages[0].score), (version, 42))
+
+                rescore_quiz("example", [version])
+                session.refresh(passages[0])
+                self.assertEqual(passages[0].quiz_hash, ancienne.quiz.hash)
+                self.assertEqual(passages[0].score, ancienne.get_score())
+            finally:
+                for passage in passages:
+                    session.delete(passage)
+                session.commit()
+                rebuild_stats("example")
+
+    def test_legacy(self):
+        examen = Examen(quizz="example", email="ydethe@gmail.com", nom="de Thé", prenom="Yann")
+        attempts = []
+        for _ in range(2):
+            user_results = FilledQuiz.from_yaml(Path("quizzes/example.yml"))
+            user_results.token = secrets.token_urlsafe(12)
+            user_results.toggle(1, 1)
+            enregistre_examen(examen, user_results, "127.0.0.1")
+            attempts.append(user_results)
+
+        # Recorded before the content hash: one hash per attempt, no key, legacy answers
+        with Session(engine) as session:
+            passages = [
+                session.exec(select(Passage).where(Passage.cle == q.submission_key())).one()
+                for q in attempts
+            ]
+            for passage, answers in zip(passages, ([[], [1]], [[], [1], [0]])):
+                passage.quiz_hash = secrets.token_hex(32)
+                passage.cle = None
+                passage.reponses = b64encode(json.dumps(answers).encode("utf-8")).decode("utf-8")
+                passage.score = 42
+            session.add_all(passages)
+            session.commit()
+
+            try:
+                versions = versions_quiz("example")
+                self.assertGreaterEqual(versions[LEGACY_VERSION], 2)
+                self.assertNotIn(passages[0].quiz_hash, versions)
+
+                rescore_quiz("example")
+                session.refresh(passages[0])
+                self.assertEqual(passages[0].score, 42)
+
+                # Only the passage with as many questions as the quiz is moved
+                rescore_quiz("example", [LEGACY_VERSION])
+                for passage in passages:
+                    session.refresh(passage)
+                self.assertEqual(passages[0].quiz_hash, attempts[0].quiz.hash)
+                self.assertEqual(passages[0].score, attempts[0].get_score())
+                self.assertNotEqual(passages[1].quiz_hash, attempts[1].quiz.hash)
+                self.assertEqual(passages[1].score, 42)
+            finally:
+                for passage in passages:
+                    session.delete(passage)
+                session.commit()
+                rebuild_stats("example")
+
+    def test_oversized_masks(self):
+        masks, counts = decode_masks([encode_answers([1 << 63, 1]), encode_answers([1, 2])], 2)
+        self.assertEqual(counts.tolist(), [-1, 2])
+        self.assertEqual(masks.tolist(), [[0, 0], [1, 2]])
+
+        user_results = FilledQuiz.from_yaml(Path("quizzes/example.yml"))
+        user_results.token = secrets.token_urlsafe(12)
+        examen = Examen(quizz="example", email="ydethe@gmail.com", nom="de Thé", prenom="Yann")
+        enregistre_examen(examen, user_results, "127.0.0.1")
+
+        with Session(engine) as session:
+            passage = session.exec(
+                select(Passage).where(Passage.cle == user_results.submission_key())
+            ).one()
+            try:
+                # The first question only has 4 answers
+                for reponses in (encode_answers([1 << 62, 1]), encode_answers([1 << 4, 2])):
+                    passage.reponses = reponses
+                    passage.score = 42
+                    session.add(passage)
+                    session.commit()
+
+                    with self.assertLogs("uvicorn.error", level="WARNING") as logs:
+                        rescore_quiz("example")
+                    self.assertIn(f"passage {passage.id}", "".join(logs.output))
+                    session.refresh(passage)
+                    self.assertEqual(passage.score, 42)
+            finally:
+                session.delete(passage)
+                session.commit()
+                rebuild_stats("example")
+
+    def test_rebuild_stats(self):
+        user_results = FilledQuiz.from_yaml(Path("quizzes/example.yml"))
+        user_results.token = secrets.token_urlsafe(12)
+        user_results.toggle(0, 0)
+        examen = Examen(quizz="example", email="ydethe@gmail.com", nom="de Thé", prenom="Yann")
+
+        nb_passages = rebuild_stats("example")
+        enregistre_examen(examen, user_results, "127.0.0.1")
+        incremental = statistiques_quiz(user_results.quiz.hash)
+
+        self.assertEqual(rebuild_stats("example"), nb_passages + 1)
+        self.assertEqual(statistiques_quiz(user_results.quiz.hash), incremental)
+        self.assertEqual(sum(incremental[2].values()), nb_passages + 1)
+
+    def test_bank(self):
+        user_results = FilledQuiz.from_yaml(Path("quizzes/banque.yml"))
+        user_results = FilledQuiz(user_results.quiz, secrets.token_urlsafe(12))
+        for page, question in enumerate(user_results.questions):
+            user_results.toggle(page, question.good_answers[0])
+        examen = Examen(quizz="banque", email="ydethe@gmail.com", nom="de Thé", prenom="Yann")
+
+        nb_passages = rebuild_stats("banque")
+        enregistre_examen(examen, user_results, "127.0.0.1")
+        incremental = statistiques_quiz(user_results.quiz.hash)
+        for idx in user_results.tirage:
+            self.assertGreaterEqual(incremental[3][idx], 1)
+
+        self.assertEqual(rebuild_stats("banque"), nb_passages + 1)
+        self.assertEqual(statistiques_quiz(user_results.quiz.hash), incremental)
+
+        with Session(engine) as session:
+            passage = session.exec(
+                select(Passage).where(Passage.cle == user_results.submission_key())
+            ).one()
+            self.assertEqual(passage.tirage, user_results.serialize_tirage())
+            passage.score = 42
+            session.add(passage)
+            session.commit()
+
+            self.assertGreaterEqual(rescore_quiz("banque")[1], 1)
+            session.refresh(passage)
+            self.assertEqual(passage.score, user_results.get_score())
+
+    def test_migrate_answers(self):
+        user_results = FilledQuiz.from_yaml(Path("quizzes/example.yml"))
+        user_results.token = secrets.token_urlsafe(12)
+        user_results.toggle(1, 0)
+        user_results.toggle(1, 1)
+        examen = Examen(quizz="example", email="ydethe@gmail.com", nom="de Thé", prenom="Yann")
+        enregistre_examen(examen, user_results, "127.0.0.1")
+
+        legacy = json.dumps(user_results.extract_answers()).encode("utf-8")
+        with Session(engine) as session:
+            passage = session.exec(
+                select(Passage).where(Passage.cle == user_results.submission_key())
+            ).one()
+            passage.reponses = b64encode(legacy).decode("utf-8")
+            session.add(passage)
+            session.commit()
+
+            self.assertGreaterEqual(migrate_answers(), 1)
+            session.refresh(passage)
+            self.assertEqual(passage.reponses, user_results.serialize_answers())
+            self.assertEqual(migrate_answers(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
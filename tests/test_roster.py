@@ -0,0 +1,45 @@
+import io
+import unittest
+
+import pytest
+
+from quizzy.config import Examen
+from quizzy.roster import generate_links, iter_links_csv, read_roster
+
+
+class TestRoster(unittest.TestCase):
+    def test_read_roster(self):
+        f = io.StringIO("Nom;Prénom;Email\nde Thé;Yann;ydethe@gmail.com\n;;\n")
+        examens = read_roster("example", f)
+
+        self.assertEqual(
+            examens,
+            [Examen(quizz="example", email="ydethe@gmail.com", nom="de Thé", prenom="Yann")],
+        )
+
+        with self.assertRaises(ValueError):
+            read_roster("example", io.StringIO("nom,email\nfoo,bar@baz.fr\n"))
+
+    def test_malformed_roster(self):
+        with self.assertRaises(ValueError):
+            read_roster("example", io.StringIO("ceci n'est pas un fichier CSV\n"))
+        with self.assertRaises(ValueError):
+            read_roster("example", io.StringIO(""))
+
+    @pytest.mark.usefixtures("database")
+    def test_generate_links(self):
+        examens = [
+            Examen(quizz="example", email=f"etudiant{i}@quizzy.fr", nom=f"Nom{i}", prenom="Jean")
+            for i in range(300)
+        ]
+        links = generate_links(examens, workers=2)
+        self.assertEqual(len(links), 300)
+        self.assertEqual(Examen.from_encrypted(links[-1][1]), examens[-1])
+
+        lines = list(iter_links_csv(links[:2], "https://quizzy.fr"))
+        self.assertEqual(lines[0], "nom,prenom,email,quizz,lien\r\n")
+        self.assertTrue(lines[1].startswith("Nom0,Jean,etudiant0@quizzy.fr,example,https://"))
+
+
+if __name__ == "__main__":
+    unittest.main()
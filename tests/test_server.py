@@ -0,0 +1,96 @@
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import time
+import unittest
+from unittest.mock import patch
+
+import pytest
+import requests
+
+from quizzy import database
+from quizzy.config import config
+from quizzy.metrics import metrics
+from quizzy.registry import registry
+from quizzy.server import metrics_dir, post_fork, preload
+
+
+def free_ports(count: int) -> int:
+    """First of *count* consecutive free ports"""
+    while True:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        if port + count > 65535:
+            continue
+        try:
+            for idx in range(1, count):
+                with socket.socket() as s:
+                    s.bind(("127.0.0.1", port + idx))
+        except OSError:
+            continue
+        return port
+
+
+class TestServer(unittest.TestCase):
+    @pytest.mark.usefixtures("geoip")
+    def test_preload(self):
+        registry.clear()
+        with patch.object(type(config), "refresh_geoip") as refresh_geoip:
+            preload()
+        shutil.rmtree(metrics_dir(os.getpid()), ignore_errors=True)
+
+        # The download is left to the background refresh of the workers
+        refresh_geoip.assert_not_called()
+
+        self.assertIsNotNone(database._geoip_reader)
+        self.assertEqual(len(registry._quizzes), len(registry.names()))
+
+    def test_post_fork(self):
+        # The listener of the tests must not be replaced by a second one
+        with patch("quizzy.server.log_pipeline.after_fork") as after_fork, patch.object(
+            database.engine, "dispose"
+        ) as dispose, patch.object(database.async_engine.sync_engine, "dispose") as async_dispose:
+            try:
+                post_fork(os.getpid())
+                self.assertEqual(metrics.directory, metrics_dir(os.getpid()))
+            finally:
+                metrics.directory = None
+        after_fork.assert_called_once_with()
+        dispose.assert_called_once_with(close=False)
+        async_dispose.assert_called_once_with(close=False)
+
+    def test_serve(self):
+        port = free_ports(2)
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "quizzy", "serve", "--workers", "2", "--port", str(port)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            # Each worker answers on its own port
+            for p in (port, port + 1):
+                deadline = time.monotonic() + 60
+                while True:
+                    try:
+                        res = requests.get(f"http://127.0.0.1:{p}/health", timeout=1)
+                        break
+                    except requests.ConnectionError:
+                        if proc.poll() is not None or time.monotonic() > deadline:
+                            self.fail(f"No worker on port {p}")
+                        time.sleep(0.2)
+                self.assertEqual(res.status_code, 200)
+
+            proc.send_signal(signal.SIGTERM)
+            self.assertEqual(proc.wait(timeout=30), 0)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,16 @@
+import asyncio
+from unittest.mock import patch
+
+from fastapi_sso import OpenID
 import pytest
-from nicegui import ui
+from nicegui import app, ui
 from nicegui.testing import User
 
 from quizzy import __main__
-from quizzy.config import Examen
+from quizzy.auth import get_logged_user
+from quizzy.config import Examen, config
+from quizzy.database import issue_token, resolve_token, statistiques_quiz, versions_quiz
+from quizzy.registry import registry
 
 pytest_plugins = ["nicegui.testing.user_plugin"]
 
@@ -17,3 +24,103 @@ async def test_click(user: User) -> None:
     await user.should_see("C'est parti !")
     user.find(ui.button).click()
     await user.should_see("Avec environ combien de follicules commence-t-on la puberté ?")
+
+
+@pytest.mark.module_under_test(__main__)
+async def test_navigation(user: User) -> None:
+    e = Examen(quizz="example", email="ydethe@gmail.com", nom="de Thé", prenom="Yann")
+    token = e.get_encrypted()
+
+    await user.open(f"/run?token={token}")
+    await user.should_see("Quelle est la capitale de la France ?")
+    await user.should_not_see("Soumettre")
+    user.find("Paris").click()
+
+    user.find("Suivant").click()
+    await user.should_see("Qui est le premier homme à avoir marché sur la Lune ?")
+    await user.should_see("Soumettre")
+    await user.should_not_see("Paris")
+
+    user.find("Précédent").click()
+    await user.should_see("Quelle est la capitale de la France ?")
+    await user.should_see(kind=ui.chip, content="Paris")
+
+
+@pytest.mark.module_under_test(__main__)
+async def test_reopen(user: User) -> None:
+    e = Examen(quizz="example", email="ydethe@gmail.com", nom="de Thé", prenom="Yann")
+    token = e.get_encrypted()
+
+    with patch.object(user.navigate.history, "replace") as replace:
+        await user.open(f"/run?token={token}")
+        await user.should_see("Quelle est la capitale de la France ?")
+        user.find("Paris").click()
+        user.find("Suivant").click()
+        await user.should_see("Qui est le premier homme à avoir marché sur la Lune ?")
+    url = replace.call_args.args[0]
+
+    # As NiceGUI reloads the page once its client was deleted, or its worker restarted
+    await user.open(url)
+    await user.should_see("Qui est le premier homme à avoir marché sur la Lune ?")
+    user.find("Précédent").click()
+    await user.should_see("Quelle est la capitale de la France ?")
+    (chip,) = user.find(kind=ui.chip, content="Paris").elements
+    assert chip.props["color"] == "blue"
+    (chip,) = user.find(kind=ui.chip, content="Rome").elements
+    assert chip.props["color"] == "grey"
+
+
+@pytest.mark.usefixtures("database")
+@pytest.mark.module_under_test(__main__)
+async def test_admin(user: User) -> None:
+    app.dependency_overrides[get_logged_user] = lambda: OpenID(email="ydethe@gmail.com")
+
+    await user.open("/admin")
+    await user.should_see("Statistiques")
+    await user.should_see("passages de la version actuelle du quiz")
+
+    # The statistics and the versions are read again, in a thread, for the chosen quiz
+    quiz_select = user.find(kind=ui.select, content="Nom du quiz").elements.pop()
+    with patch.object(
+        __main__, "statistiques_quiz", wraps=statistiques_quiz
+    ) as stats, patch.object(__main__, "versions_quiz", wraps=versions_quiz) as versions:
+        quiz_select.value = "example"
+        for _ in range(50):
+            if stats.called and versions.called:
+                break
+            await asyncio.sleep(0.02)
+    stats.assert_called_once_with(registry.get("example").hash)
+    versions.assert_called_once_with("example")
+    await user.should_see("passages de la version actuelle du quiz")
+
+    app.dependency_overrides.clear()
+
+
+@pytest.mark.usefixtures("database")
+@pytest.mark.module_under_test(__main__)
+async def test_admin_token(user: User) -> None:
+    app.dependency_overrides[get_logged_user] = lambda: OpenID(email="ydethe@gmail.com")
+    tokens = []
+
+    def issue(examen: Examen) -> str:
+        tokens.append(issue_token(examen))
+        return tokens[-1]
+
+    with patch.object(config, "TOKEN_MODE", "opaque"), patch.object(__main__, "issue_token", issue):
+        await user.open("/admin")
+        user.find(kind=ui.input, content="Nom").type("de Thé")
+        user.find(kind=ui.input, content="Prénom").type("Yann")
+        user.find(kind=ui.input, content="Email").type("ydethe@gmail.com")
+        user.find("Créer lien").click()
+        for _ in range(50):
+            if tokens:
+                break
+            await asyncio.sleep(0.02)
+        await user.should_see(tokens[0])
+        assert resolve_token(tokens[0]).nom == "de Thé"
+
+        user.find(kind=ui.input, content="Jeton").type(tokens[0])
+        user.find("Révoquer").click()
+        await user.should_see("Lien révoqué")
+
+    app.dependency_overrides.clear()
@@ -0,0 +1,101 @@
+import os
+from pathlib import Path
+import secrets
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import pytest
+from sqlmodel import Session, func, select
+
+from quizzy.Quiz import FilledQuiz
+from quizzy.config import Examen
+from quizzy.database import (
+    Etudiant,
+    Passage,
+    async_engine,
+    engine,
+    passage_record,
+    statistiques_quiz,
+)
+from quizzy.writer import PassageWriter
+
+
+@pytest.mark.usefixtures("database")
+class TestPassageWriter(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.spill = Path(self.tmpdir.name) / "spill.jsonl"
+        self.writer = PassageWriter(batch_size=3, interval=0.05, maxsize=4, spill=self.spill)
+
+        self.examen = Examen(
+            quizz="example",
+            email=f"{secrets.token_hex(8)}@quizzy.fr",
+            nom="de Thé",
+            prenom="Yann",
+        )
+        self.quizz = FilledQuiz.from_yaml(Path("quizzes/example.yml"))
+        self.quizz.token = self.examen.get_encrypted()
+
+    async def asyncTearDown(self):
+        await async_engine.dispose()
+        self.tmpdir.cleanup()
+
+    def count_passages(self) -> int:
+        with Session(engine) as session:
+            query = (
+                select(func.count())
+                .select_from(Passage)
+                .join(Etudiant)
+                .where(Etudiant.email == self.examen.email)
+            )
+            return session.exec(query).one()
+
+    async def test_flush(self):
+        await self.writer.start()
+        for _ in range(10):
+            self.quizz.token = secrets.token_urlsafe(12)
+            await self.writer.put(passage_record(self.examen, self.quizz, "81.2.69.142"))
+        await self.writer.stop()
+
+        self.assertEqual(self.count_passages(), 10)
+        self.assertFalse(self.spill.exists())
+
+    async def test_spill(self):
+        await self.writer.start()
+        with (
+            patch("quizzy.writer.enregistre_passages_async", side_effect=OSError("down")),
+            patch("quizzy.writer.os.fsync", wraps=os.fsync) as fsync,
+        ):
+            for _ in range(5):
+                self.quizz.token = secrets.token_urlsafe(12)
+                await self.writer.put(passage_record(self.examen, self.quizz, "127.0.0.1"))
+            await self.writer.stop()
+
+        self.assertEqual(self.count_passages(), 0)
+        # Each spilled batch, of at most 3 submissions, and the directory once the file is created
+        self.assertGreaterEqual(fsync.call_count, 3)
+        self.assertEqual(len(self.spill.read_text().splitlines()), 5)
+
+        await self.writer.start()
+        await self.writer.stop()
+
+        self.assertEqual(self.count_passages(), 5)
+        self.assertFalse(self.spill.exists())
+
+    async def test_duplicates(self):
+        scores = statistiques_quiz(self.quizz.quiz.hash)[2]
+
+        await self.writer.start()
+        for _ in range(4):
+            await self.writer.put(passage_record(self.examen, self.quizz, "81.2.69.142"))
+        await self.writer.stop()
+
+        self.assertEqual(self.count_passages(), 1)
+        self.assertEqual(
+            sum(statistiques_quiz(self.quizz.quiz.hash)[2].values()), sum(scores.values()) + 1
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()